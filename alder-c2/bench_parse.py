@@ -0,0 +1,62 @@
+# Parser benchmark for sim2. Compares the standalone LALR parser (used by
+# sim2.Engine) against the Earley parser that lark builds from sim2.lark
+# by default, on the typewriter module and on synthetic modules of
+# increasing size.
+#
+#   python bench_parse.py [line_count]
+#
+import sys
+import time
+import lark
+import sim2
+import sim2_parser
+
+typewriter_file_name = "../daves-1f/typewriter-mechanical.v"
+
+# Builds a module in the style of the generated relay logic with roughly
+# the requested number of lines.
+def make_synthetic_module(line_count: int) -> str:
+    lines = []
+    lines.append("module bench();")
+    lines.append("  wire a, b;")
+    lines.append("  wire n0 = a;")
+    lines.append("  wire n1 = b;")
+    lines.append("  reg r_state;")
+    lines.append("  always @(a, b) begin r_state <= a & !b; end")
+    i = 2
+    while len(lines) < line_count - 1:
+        lines.append("  wire n" + str(i) + " = (n" + str(i - 1) + " & a) | !(b == n" +
+                     str(i - 2) + ") ^ r_state;")
+        i = i + 1
+    lines.append("endmodule")
+    return "\n".join(lines) + "\n"
+
+def time_parse(name: str, parse, text: str) -> float:
+    start = time.perf_counter()
+    parse(text)
+    elapsed = time.perf_counter() - start
+    line_count = text.count("\n")
+    print(name.ljust(30), str(line_count).rjust(8), "lines",
+          "{:8.3f} s".format(elapsed),
+          "{:10.0f} lines/s".format(line_count / elapsed))
+    return elapsed
+
+max_line_count = 50000
+if len(sys.argv) > 1:
+    max_line_count = int(sys.argv[1])
+
+lalr = sim2_parser.Lark_StandAlone(transformer=sim2.Transformer())
+earley = lark.Lark.open(sim2.GRAMMAR_FILE_NAME)
+
+typewriter_text = open(typewriter_file_name).read()
+time_parse("typewriter (LALR)", lalr.parse, typewriter_text)
+time_parse("typewriter (Earley)", earley.parse, typewriter_text)
+
+# Earley takes far too long on the big modules, so it only gets a small one
+time_parse("synthetic (Earley)", earley.parse, make_synthetic_module(1000))
+
+# The time per line should stay flat as the module grows
+line_count = max_line_count // 8
+while line_count <= max_line_count:
+    time_parse("synthetic (LALR)", lalr.parse, make_synthetic_module(line_count))
+    line_count = line_count * 2
@@ -336,6 +336,10 @@ lb = sim2.Engine()
 lb.load_module_files(fns)
 lb.start()
 
+# The switches are the only things that need to be transferred back into 
+# the analog model
+switch_watch = lb.watch(pattern="tw.*_sw")
+
 max_iter = 50
 
 start = time.perf_counter()
@@ -356,8 +360,7 @@ for i in range(0, 3 * len(significant_angles)):
     angle = significant_angles[i % len(significant_angles)]
     cycle = math.floor(i / len(significant_angles))
 
-    lb.set_value("tw._cycle", sim2.Value(cycle))
-    lb.set_value("tw._angle", sim2.Value(angle))
+    lb.set_values({ "tw._cycle": sim2.Value(cycle), "tw._angle": sim2.Value(angle) })
 
     print("-----", i, lb.get_int("tw._cycle"), lb.get_int("tw._angle"), "---------")
 
@@ -431,38 +434,39 @@ for i in range(0, 3 * len(significant_angles)):
             if e[i] > 0.1:
                 print(i, mapper.index_to_name(i), e[i])
 
-    # Push coil/solenoid state into logic 
-    for dev in net_devices:
-        if dev.can_get_current() and ("_coil" in dev.get_name() or "_sol" in dev.get_name()):
-            if lb.is_valid_signal("tw." + dev.get_name()):
-                i = dev.get_current(x)
-                if abs(i) > 0.1:
-                    #print("Current in device", dev.get_name(), i)
-                    lb.set_value("tw." + dev.get_name(), sim2.LOGIC_1)
-                    if "_sol" in dev.get_name():
-                        print("Energized solenoid", dev.get_name())
+    # Push coil/solenoid state into logic. The logic is settled once after 
+    # all of the values are in.
+    with lb.deferred_updates():
+        for dev in net_devices:
+            if dev.can_get_current() and ("_coil" in dev.get_name() or "_sol" in dev.get_name()):
+                if lb.is_valid_signal("tw." + dev.get_name()):
+                    i = dev.get_current(x)
+                    if abs(i) > 0.1:
+                        #print("Current in device", dev.get_name(), i)
+                        lb.set_value("tw." + dev.get_name(), sim2.LOGIC_1)
+                        if "_sol" in dev.get_name():
+                            print("Energized solenoid", dev.get_name())
+                    else:
+                        lb.set_value("tw." + dev.get_name(), sim2.LOGIC_0)
                 else:
-                    lb.set_value("tw." + dev.get_name(), sim2.LOGIC_0)
-            else:
-                print("Device is not found in logic", "tw." + dev.get_name())
+                    print("Device is not found in logic", "tw." + dev.get_name())
 
     # Advance the logic by one step
     lb.tick()
 
-    # Transfer all of the switch values from the digital domain back 
-    # into the analog model
-    for logic_name in lb.get_signal_names():
-        if logic_name.startswith("tw.") and logic_name.endswith("_sw"):
-            # Strip off the leading "tw."
-            device_name = logic_name[3:]
-            if not device_name in name_to_device:
-                #print("Can't find switch", device_name)
-                pass
-            else:
-                v = lb.get_bool(logic_name)
-                changed = name_to_device[device_name].set_state(v)
-                if changed:
-                    print("CHANGED", device_name, "to", lb.get_bool(logic_name))
+    # Transfer the switch values that changed from the digital domain back 
+    # into the analog model (all of them the first time around)
+    for logic_name, value in switch_watch.poll().items():
+        # Strip off the leading "tw."
+        device_name = logic_name[3:]
+        if not device_name in name_to_device:
+            #print("Can't find switch", device_name)
+            pass
+        else:
+            v = value.get_bool()
+            changed = name_to_device[device_name].set_state(v)
+            if changed:
+                print("CHANGED", device_name, "to", v)
 
 end = time.perf_counter()
 print(end - start)
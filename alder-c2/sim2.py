@@ -11,7 +11,17 @@ use or sale of any part is prohibited.
 """
 
 from enum import Enum
+from array import array
+import heapq
+import contextlib
+import fnmatch
+import hashlib
+import os
+import pickle
+import time
 import lark 
+import numpy as np
+import sim2_parser
 
 class Value:    
 
@@ -61,6 +71,65 @@ LOGIC_1 = Value(1)
 LOGIC_X = Value("X")
 LOGIC_Z = Value("Z")
 
+# ----- Compact Value Encoding -----------------------------------------------
+#
+# Inside of the simulator values are held as small integer codes so that 
+# the hot loop never needs to allocate Value objects or call Value.__eq__.
+# The four logic states use codes 0-3. Any other integer n is stored as 
+# n + 2 when n > 1 (negative integers are stored unchanged). This keeps the
+# encoding one-to-one and order-preserving, so integer comparisons can be 
+# done directly on the codes.
+
+CODE_0 = 0
+CODE_1 = 1
+CODE_X = 2
+CODE_Z = 3
+
+CODE_VALUES = (LOGIC_0, LOGIC_1, LOGIC_X, LOGIC_Z)
+
+def encode_value(v: Value) -> int:
+    x = v.value
+    if x == "X":
+        return CODE_X
+    elif x == "Z":
+        return CODE_Z
+    elif type(x) is bool:
+        return int(x)
+    elif type(x) is int:
+        if x > 1:
+            return x + 2
+        return x
+    else:
+        raise Exception("Unable to encode value " + str(x))
+
+def decode_value(code: int) -> Value:
+    if code >= 0 and code <= 3:
+        return CODE_VALUES[code]
+    elif code > 3:
+        return Value(code - 2)
+    else:
+        return Value(code)
+
+# Same as encode_value(), but a plain integer (i.e. from a NumPy array) can 
+# be used in place of a Value
+def encode_stimulus(v) -> int:
+    if type(v) is Value:
+        return encode_value(v)
+    x = int(v)
+    if x > 1:
+        return x + 2
+    return x
+
+# Converts an array of codes (i.e. from Engine.run()) to the values they 
+# stand for: 0/1 for the logic values and the integer for the rest. X and Z
+# have no integer value, so they are masked out.
+def decode_code_array(codes: np.ndarray) -> np.ma.MaskedArray:
+    values = np.where(codes > CODE_Z, codes - 2, codes)
+    return np.ma.masked_array(values, mask=(codes == CODE_X) | (codes == CODE_Z))
+
+def is_xz_code(code: int) -> bool:
+    return code == CODE_X or code == CODE_Z
+
 def parse_binary_constant(c):
     # TODO: COMPLETE
     if c.startswith("1'b"):
@@ -78,118 +147,239 @@ def parse_binary_constant(c):
     else:
         raise Exception("Binary constant format error " + c)
 
+# Truth tables for the logic operators, indexed by code. These are only 
+# defined for the four logic states.
+
+# See IEEE Standard Section 5.1.10
+OR_TABLE = (
+    # 0       1       X       Z
+    (CODE_0, CODE_1, CODE_X, CODE_X), # 0
+    (CODE_1, CODE_1, CODE_1, CODE_1), # 1
+    (CODE_X, CODE_1, CODE_X, CODE_X), # X
+    (CODE_X, CODE_1, CODE_X, CODE_X)  # Z
+)
+
+# See IEEE Standard Section 5.1.10
+AND_TABLE = (
+    # 0       1       X       Z
+    (CODE_0, CODE_0, CODE_0, CODE_0), # 0
+    (CODE_0, CODE_1, CODE_X, CODE_X), # 1
+    (CODE_0, CODE_X, CODE_X, CODE_X), # X
+    (CODE_0, CODE_X, CODE_X, CODE_X)  # Z
+)
+
+XOR_TABLE = (
+    # 0       1       X       Z
+    (CODE_0, CODE_1, CODE_X, CODE_X), # 0
+    (CODE_1, CODE_0, CODE_X, CODE_X), # 1
+    (CODE_X, CODE_X, CODE_X, CODE_X), # X
+    (CODE_X, CODE_X, CODE_X, CODE_X)  # Z
+)
+
 # See IEEE standard section 5.1.8
-def logic_eval_eq(a: Value, b: Value):
-    if a == LOGIC_X or a == LOGIC_Z or b == LOGIC_X or b == LOGIC_Z:
-        return LOGIC_X
-    if a == b:
-        return LOGIC_1
+EQ_TABLE = (
+    # 0       1       X       Z
+    (CODE_1, CODE_0, CODE_X, CODE_X), # 0
+    (CODE_0, CODE_1, CODE_X, CODE_X), # 1
+    (CODE_X, CODE_X, CODE_X, CODE_X), # X
+    (CODE_X, CODE_X, CODE_X, CODE_X)  # Z
+)
+
+# See Table 5-16
+NOT_TABLE = (CODE_1, CODE_0, CODE_X, CODE_X)
+
+# ----- Operators on Codes ---------------------------------------------------
+
+def code_eval_eq(a: int, b: int) -> int:
+    if a >= 0 and a <= 3 and b >= 0 and b <= 3:
+        return EQ_TABLE[a][b]
+    elif is_xz_code(a) or is_xz_code(b):
+        return CODE_X
+    elif a == b:
+        return CODE_1
     else:
-        return LOGIC_0
+        return CODE_0
 
-def logic_eval_neq(a: Value, b: Value):
-    if a == LOGIC_X or a == LOGIC_Z or b == LOGIC_X or b == LOGIC_Z:
-        return LOGIC_X
+def code_eval_neq(a: int, b: int) -> int:
+    return NOT_TABLE[code_eval_eq(a, b)]
+
+def code_case_eq(a: int, b: int) -> int:
     if a == b:
-        return LOGIC_0
+        return CODE_1
     else:
-        return LOGIC_1
+        return CODE_0
 
-def case_eval_eq(a: Value, b: Value):
+def code_case_neq(a: int, b: int) -> int:
     if a == b:
-        return LOGIC_1
+        return CODE_0
     else:
-        return LOGIC_0
+        return CODE_1
 
-def case_eval_neq(a: Value, b: Value):
-    if a == b:
-        return LOGIC_0
+# NOTE: The ordering comparisons work directly on the codes because 
+# the encoding preserves the order of the integers.
+
+def code_eval_lt(a: int, b: int) -> int:
+    if is_xz_code(a) or is_xz_code(b):
+        return CODE_X
+    elif a < b:
+        return CODE_1
     else:
-        return LOGIC_1
+        return CODE_0
+
+def code_eval_lte(a: int, b: int) -> int:
+    if is_xz_code(a) or is_xz_code(b):
+        return CODE_X
+    elif a <= b:
+        return CODE_1
+    else:
+        return CODE_0
+
+def code_eval_gt(a: int, b: int) -> int:
+    if is_xz_code(a) or is_xz_code(b):
+        return CODE_X
+    elif a > b:
+        return CODE_1
+    else:
+        return CODE_0
+
+def code_eval_gte(a: int, b: int) -> int:
+    if is_xz_code(a) or is_xz_code(b):
+        return CODE_X
+    elif a >= b:
+        return CODE_1
+    else:
+        return CODE_0
+
+# ----- Operators on Values --------------------------------------------------
+
+# Converts a value to a code that can be used to index the truth tables.
+# Values other than the four logic states are treated as X.
+def encode_logic(v: Value) -> int:
+    return logic_code(encode_value(v))
+
+# Integers are treated as X where a logic value is needed
+def logic_code(code: int) -> int:
+    if code < 0 or code > CODE_Z:
+        return CODE_X
+    return code
+
+def logic_eval_eq(a: Value, b: Value):
+    return decode_value(code_eval_eq(encode_value(a), encode_value(b)))
+
+def logic_eval_neq(a: Value, b: Value):
+    return decode_value(code_eval_neq(encode_value(a), encode_value(b)))
+
+def case_eval_eq(a: Value, b: Value):
+    return decode_value(code_case_eq(encode_value(a), encode_value(b)))
+
+def case_eval_neq(a: Value, b: Value):
+    return decode_value(code_case_neq(encode_value(a), encode_value(b)))
 
-# See IEEE Standard Section 5.1.10
 def logic_eval_or(a: Value, b: Value) -> Value:
-    if a == LOGIC_0:
-        if   (b == LOGIC_0): return LOGIC_0
-        elif (b == LOGIC_1): return LOGIC_1
-        elif (b == LOGIC_X): return LOGIC_X
-        elif (b == LOGIC_Z): return LOGIC_X
-    elif a == LOGIC_1:
-        if   (b == LOGIC_0): return LOGIC_1
-        elif (b == LOGIC_1): return LOGIC_1
-        elif (b == LOGIC_X): return LOGIC_1
-        elif (b == LOGIC_Z): return LOGIC_1
-    elif a == LOGIC_X or a == LOGIC_Z:
-        if   (b == LOGIC_0): return LOGIC_X
-        elif (b == LOGIC_1): return LOGIC_1
-        elif (b == LOGIC_X): return LOGIC_X
-        elif (b == LOGIC_Z): return LOGIC_X
+    return CODE_VALUES[OR_TABLE[encode_logic(a)][encode_logic(b)]]
 
-# See IEEE Standard Section 5.1.10
 def logic_eval_and(a: Value, b: Value) -> Value:
-    if a == LOGIC_0:
-        if   (b == LOGIC_0): return LOGIC_0
-        elif (b == LOGIC_1): return LOGIC_0
-        elif (b == LOGIC_X): return LOGIC_0
-        elif (b == LOGIC_Z): return LOGIC_0
-    elif a == LOGIC_1:
-        if   (b == LOGIC_0): return LOGIC_0
-        elif (b == LOGIC_1): return LOGIC_1
-        elif (b == LOGIC_X): return LOGIC_X
-        elif (b == LOGIC_Z): return LOGIC_X
-    elif a == LOGIC_X or a == LOGIC_Z:
-        if   (b == LOGIC_0): return LOGIC_0
-        elif (b == LOGIC_1): return LOGIC_X
-        elif (b == LOGIC_X): return LOGIC_X
-        elif (b == LOGIC_Z): return LOGIC_X
+    return CODE_VALUES[AND_TABLE[encode_logic(a)][encode_logic(b)]]
+
+def logic_eval_xor(a: Value, b: Value) -> Value:
+    return CODE_VALUES[XOR_TABLE[encode_logic(a)][encode_logic(b)]]
 
-# See Table 5-16
 def logic_eval_not(a: Value) -> Value:
-    if a == LOGIC_0:
-        return LOGIC_1
-    elif a == LOGIC_1:
-        return LOGIC_0
-    else:
-        return LOGIC_X
+    return CODE_VALUES[NOT_TABLE[encode_logic(a)]]
 
 def logic_eval_lt(a: Value, b: Value) -> Value:
-    if a.is_x() or a.is_z() or b.is_x() or b.is_z():
-        return LOGIC_X
-    else:
-        if a.get_int() < b.get_int():
-            return LOGIC_1
-        else:
-            return LOGIC_0
+    return decode_value(code_eval_lt(encode_value(a), encode_value(b)))
 
 def logic_eval_lte(a: Value, b: Value) -> Value:
-    if a.is_x() or a.is_z() or b.is_x() or b.is_z():
-        return LOGIC_X
-    else:
-        if a.get_int() <= b.get_int():
-            return LOGIC_1
-        else:
-            return LOGIC_0
+    return decode_value(code_eval_lte(encode_value(a), encode_value(b)))
 
 def logic_eval_gt(a: Value, b: Value) -> Value:
-    if a.is_x() or a.is_z() or b.is_x() or b.is_z():
-        return LOGIC_X
-    else:
-        if a.get_int() > b.get_int():
-            return LOGIC_1
-        else:
-            return LOGIC_0
+    return decode_value(code_eval_gt(encode_value(a), encode_value(b)))
     
 def logic_eval_gte(a: Value, b: Value) -> Value:
-    if a.is_x() or a.is_z() or b.is_x() or b.is_z():
-        return LOGIC_X
-    else:
-        if a.get_int() >= b.get_int():
-            return LOGIC_1
-        else:
-            return LOGIC_0
+    return decode_value(code_eval_gte(encode_value(a), encode_value(b)))
+
+# Used to resolve the operator of a BinaryExpression at compile time. The 
+# operators that have truth tables are handled separately.
+# The logic operators treat an integer operand as X (like encode_logic()). 
+# Operators always produce a 0/1/X/Z code, so only the other operands need 
+# checking before they are used to index a table.
+def compile_logic_operand(exp: Expression, f):
+    if type(exp) is BinaryExpression or type(exp) is UnaryExpression:
+        return f
+    def g():
+        code = f()
+        if code < 0 or code > CODE_Z:
+            return CODE_X
+        return code
+    return g
+
+# The compile_relocatable() version of compile_logic_operand()
+def compile_relocatable_logic_operand(exp: Expression, f):
+    if type(exp) is BinaryExpression or type(exp) is UnaryExpression:
+        return f
+    def g(base: int):
+        code = f(base)
+        if code < 0 or code > CODE_Z:
+            return CODE_X
+        return code
+    return g
+
+# Raised by a two-state evaluator that runs into an integer operand of a 
+# logic operator. The result would be X, so the net is evaluated again 
+# with the four-state evaluator (see EvalContext.evaluate_level()).
+class TwoStateFallback(Exception):
+    pass
+
+# The two-state version of compile_logic_operand(). Returns None if the 
+# operand is a constant that isn't 0 or 1.
+def compile_two_state_logic_operand(exp: Expression, f):
+    if type(exp) is BinaryExpression or type(exp) is UnaryExpression:
+        return f
+    if type(exp) is ConstantExpression:
+        if encode_value(exp.value) > CODE_1 or encode_value(exp.value) < 0:
+            return None
+        return f
+    def g():
+        code = f()
+        if code < 0 or code > CODE_1:
+            raise TwoStateFallback()
+        return code
+    return g
+
+BINARY_TABLES = {
+    "|": OR_TABLE,
+    "&": AND_TABLE,
+    "^": XOR_TABLE
+}
+
+BINARY_OPERATORS = {
+    "==": code_eval_eq,
+    "!=": code_eval_neq,
+    "===": code_case_eq,
+    "!==": code_case_neq,
+    "<": code_eval_lt,
+    "<=": code_eval_lte,
+    ">": code_eval_gt,
+    ">=": code_eval_gte
+}
+
+# The operators where the order of the operands doesn't matter
+COMMUTATIVE_OPERATORS = [ "|", "&", "^", "==", "!=", "===", "!==" ]
 
 # ----- Expression Related ----------------------------------------------
 
+# Function calls that expand to more nodes than this are not inlined
+INLINE_SIZE_LIMIT = 64
+# How deep to go when inlining function calls found inside of functions
+INLINE_DEPTH_LIMIT = 8
+# Maximum number of results remembered for each pure function
+MEMO_SIZE_LIMIT = 1024
+# Number of delta cycles to wait for the design to settle down
+DEFAULT_DELTA_LIMIT = 1000
+# Number of extra rounds used to find the signals of an oscillation
+OSCILLATION_SAMPLE_ROUNDS = 4
+
 def join_name(path: str, name: str, name2: str = None) -> str:
 
     s = None
@@ -230,6 +420,76 @@ class Expression:
     def globalize(self, name_prefix: str, local_variables: list[str]) -> Expression:
         raise Exception("Missing implementation")
 
+    # Turns an elaborated (i.e. globalized) expression into a callable that 
+    # takes no arguments and returns the value of the expression as a code
+    # (see encode_value()). All of the name resolution and operator dispatch 
+    # happens here, once, instead of on every evaluation.
+    def compile(self, context: EvalContext):
+        raise Exception("Missing implementation")
+
+    # Like compile(), but for an expression of a module template (see 
+    # InstanceExpression). The names are local to the module and are found
+    # at their offsets from the first slot of an instance, which is passed
+    # to the callable. The callable works for every instance of the module.
+    def compile_relocatable(self, context: EvalContext, offsets: dict[str, int]):
+        raise Exception("Missing implementation")
+
+    # Like compile(), but the callable only works when none of the signals 
+    # read are X or Z (see EvalContext.two_state). Returns None if the 
+    # expression can't be evaluated that way.
+    def compile_two_state(self, context: EvalContext):
+        return None
+
+    # Batch mode version of compile() (see BatchEvalContext). The callable 
+    # returns the value of the expression in every lane as a (lo, hi) pair 
+    # of planes.
+    def compile_batch(self, batch: BatchEvalContext):
+        raise Exception("Missing implementation")
+
+    # Same as compile_batch() except that the callable returns a list of 
+    # codes, one per lane. This is used where integers may be involved.
+    def compile_batch_lanes(self, batch: BatchEvalContext):
+        f = self.compile_batch(batch)
+        lane_count = batch.lane_count
+        def g():
+            lo, hi = f()
+            return planes_to_lanes(lo, hi, lane_count)
+        return g
+
+    # Indicates that the expression may produce integer values, which 
+    # can't be represented in the planes.
+    def is_batch_wide(self, batch: BatchEvalContext) -> bool:
+        return False
+
+    # Returns the names of the functions called anywhere in the expression
+    def get_function_names(self) -> list[str]:
+        return [ ]
+
+    # Number of nodes in the expression
+    def get_size(self) -> int:
+        return 1
+
+    # Creates a new version of the expression with the variables in the 
+    # mapping replaced by the corresponding expressions.
+    def substitute(self, mapping: dict[str, Expression]) -> Expression:
+        raise Exception("Missing implementation")
+
+    # Creates a new version of the (elaborated) expression with calls to 
+    # small functions replaced by the bodies of the functions (see 
+    # FunctionDefinition.inline()).
+    def inline_functions(self, context: EvalContext, depth: int = 0) -> Expression:
+        return self
+
+    # Creates a new version of the expression with the constant parts 
+    # folded and double negations removed (see EvalContext.optimize()).
+    def simplify(self, stats: OptimizerStats) -> Expression:
+        return self
+
+    # Returns the shared copy of this expression from the table (see 
+    # ExpressionTable). Expressions that can't be shared return themselves.
+    def intern(self, table: ExpressionTable) -> Expression:
+        return self
+
 class VariableExpression(Expression):
 
     def __init__(self, name):
@@ -249,6 +509,58 @@ class VariableExpression(Expression):
 
     def globalize(self, name_prefix: str, local_variables: list[str]) -> Expression:
         return VariableExpression(globalize_name_if_necessary(name_prefix, local_variables, self.name))
+
+    def substitute(self, mapping: dict[str, Expression]) -> Expression:
+        if self.name in mapping:
+            return mapping[self.name]
+        return self
+
+    def intern(self, table: ExpressionTable) -> Expression:
+        return table.add(("var", self.name), self)
+
+    def compile(self, context: EvalContext):
+        if not context.value_state.is_value_available(self.name):
+            raise Exception("No value available for " + self.name)
+        codes = context.value_state.codes
+        slot = context.value_state.get_slot(self.name)
+        def f():
+            return codes[slot]
+        return f
+
+    def compile_relocatable(self, context: EvalContext, offsets: dict[str, int]):
+        codes = context.value_state.codes
+        offset = offsets[self.name]
+        def f(base: int):
+            return codes[base + offset]
+        return f
+
+    def compile_two_state(self, context: EvalContext):
+        return self.compile(context)
+
+    def compile_batch(self, batch: BatchEvalContext):
+        slot = batch.get_slot(self.name)
+        if batch.wide[slot] is not None:
+            wide = batch.wide
+            def f():
+                return lanes_to_planes(wide[slot])
+            return f
+        lo = batch.lo
+        hi = batch.hi
+        def f():
+            return (lo[slot], hi[slot])
+        return f
+
+    def compile_batch_lanes(self, batch: BatchEvalContext):
+        slot = batch.get_slot(self.name)
+        if batch.wide[slot] is None:
+            return Expression.compile_batch_lanes(self, batch)
+        wide = batch.wide
+        def f():
+            return wide[slot]
+        return f
+
+    def is_batch_wide(self, batch: BatchEvalContext) -> bool:
+        return batch.is_wide_signal(batch.context.get_signal_info(self.name))
     
 
 class ConstantExpression(Expression):
@@ -267,6 +579,45 @@ class ConstantExpression(Expression):
 
     def globalize(self, name_prefix: str, local_variables: list[str]) -> Expression:
         return ConstantExpression(self.value)
+
+    def substitute(self, mapping: dict[str, Expression]) -> Expression:
+        return self
+
+    def intern(self, table: ExpressionTable) -> Expression:
+        return table.add(("const", encode_value(self.value)), self)
+
+    def compile(self, context: EvalContext):
+        code = encode_value(self.value)
+        def f():
+            return code
+        return f
+
+    def compile_relocatable(self, context: EvalContext, offsets: dict[str, int]):
+        code = encode_value(self.value)
+        def f(base: int):
+            return code
+        return f
+
+    def compile_two_state(self, context: EvalContext):
+        if is_xz_code(encode_value(self.value)):
+            return None
+        return self.compile(context)
+
+    def compile_batch(self, batch: BatchEvalContext):
+        planes = lanes_to_planes([encode_value(self.value)] * batch.lane_count)
+        def f():
+            return planes
+        return f
+
+    def compile_batch_lanes(self, batch: BatchEvalContext):
+        lanes = [encode_value(self.value)] * batch.lane_count
+        def f():
+            return lanes
+        return f
+
+    def is_batch_wide(self, batch: BatchEvalContext) -> bool:
+        code = encode_value(self.value)
+        return code < CODE_0 or code > CODE_Z
     
 
 class BinaryExpression(Expression):
@@ -289,6 +640,8 @@ class BinaryExpression(Expression):
             return logic_eval_or(lhs, rhs)
         elif self.type == "&":
             return logic_eval_and(lhs, rhs)
+        elif self.type == "^":
+            return logic_eval_xor(lhs, rhs)
         elif self.type == "==":
             return logic_eval_eq(lhs, rhs)
         elif self.type == "!=":
@@ -307,6 +660,112 @@ class BinaryExpression(Expression):
             return logic_eval_gte(lhs, rhs)
         else:
             raise Exception("Invalid operation type")
+
+    def compile(self, context: EvalContext):
+        lhs = self.lhs.compile(context)
+        rhs = self.rhs.compile(context)
+        if self.type in BINARY_TABLES:
+            table = BINARY_TABLES[self.type]
+            lhs = compile_logic_operand(self.lhs, lhs)
+            rhs = compile_logic_operand(self.rhs, rhs)
+            def f():
+                return table[lhs()][rhs()]
+            return context.share(self, f)
+        elif self.type in BINARY_OPERATORS:
+            op = BINARY_OPERATORS[self.type]
+            def f():
+                return op(lhs(), rhs())
+            return context.share(self, f)
+        else:
+            raise Exception("Invalid operation type")
+
+    # The expressions of a template aren't shared (see 
+    # EvalContext.share_expressions()) since they are evaluated for many 
+    # instances
+    def compile_relocatable(self, context: EvalContext, offsets: dict[str, int]):
+        lhs = self.lhs.compile_relocatable(context, offsets)
+        rhs = self.rhs.compile_relocatable(context, offsets)
+        if self.type in BINARY_TABLES:
+            table = BINARY_TABLES[self.type]
+            lhs = compile_relocatable_logic_operand(self.lhs, lhs)
+            rhs = compile_relocatable_logic_operand(self.rhs, rhs)
+            def f(base: int):
+                return table[lhs(base)][rhs(base)]
+            return f
+        elif self.type in BINARY_OPERATORS:
+            op = BINARY_OPERATORS[self.type]
+            def f(base: int):
+                return op(lhs(base), rhs(base))
+            return f
+        else:
+            raise Exception("Invalid operation type")
+
+    # Without X or Z the operators are the same as Python's (the results of
+    # the comparisons are bools, which work as codes 0 and 1).
+    def compile_two_state(self, context: EvalContext):
+        lhs = self.lhs.compile_two_state(context)
+        rhs = self.rhs.compile_two_state(context)
+        if lhs is None or rhs is None:
+            return None
+        if self.type in BINARY_TABLES:
+            lhs = compile_two_state_logic_operand(self.lhs, lhs)
+            rhs = compile_two_state_logic_operand(self.rhs, rhs)
+            if lhs is None or rhs is None:
+                return None
+        if self.type == "|":
+            def f():
+                return lhs() | rhs()
+        elif self.type == "&":
+            def f():
+                return lhs() & rhs()
+        elif self.type == "^":
+            def f():
+                return lhs() ^ rhs()
+        elif self.type == "==" or self.type == "===":
+            def f():
+                return lhs() == rhs()
+        elif self.type == "!=" or self.type == "!==":
+            def f():
+                return lhs() != rhs()
+        elif self.type == "<":
+            def f():
+                return lhs() < rhs()
+        elif self.type == "<=":
+            def f():
+                return lhs() <= rhs()
+        elif self.type == ">":
+            def f():
+                return lhs() > rhs()
+        elif self.type == ">=":
+            def f():
+                return lhs() >= rhs()
+        else:
+            raise Exception("Invalid operation type")
+        return context.share(self, f)
+
+    def compile_batch(self, batch: BatchEvalContext):
+        mask = batch.mask
+        # The equality operators can only work on the planes if no integers
+        # are involved. The logic operators treat integers as X anyway.
+        if self.type in PLANE_OPERATORS and \
+            (self.type in BINARY_TABLES or 
+             not (self.lhs.is_batch_wide(batch) or self.rhs.is_batch_wide(batch))):
+            op = PLANE_OPERATORS[self.type]
+            lhs = self.lhs.compile_batch(batch)
+            rhs = self.rhs.compile_batch(batch)
+            def f():
+                return op(lhs(), rhs(), mask)
+            return f
+        elif self.type in BINARY_OPERATORS:
+            # Fall back to evaluating the lanes one at a time
+            op = BINARY_OPERATORS[self.type]
+            lhs = self.lhs.compile_batch_lanes(batch)
+            rhs = self.rhs.compile_batch_lanes(batch)
+            def f():
+                return lanes_to_planes([op(a, b) for a, b in zip(lhs(), rhs())])
+            return f
+        else:
+            raise Exception("Invalid operation type")
         
     def __repr__(self):
         return "(" + str(self.lhs) + " " + self.type + " " + str(self.rhs) + ")"
@@ -317,10 +776,54 @@ class BinaryExpression(Expression):
         return result 
 
     def globalize(self, name_prefix: str, local_variables: list[str]) -> Expression:
-        print(self.lhs)
         return BinaryExpression(self.type, 
                                 self.lhs.globalize(name_prefix, local_variables),
                                 self.rhs.globalize(name_prefix, local_variables))
+
+    def get_function_names(self) -> list[str]:
+        result = self.lhs.get_function_names()
+        result.extend(self.rhs.get_function_names())
+        return result 
+
+    def get_size(self) -> int:
+        return 1 + self.lhs.get_size() + self.rhs.get_size()
+
+    def substitute(self, mapping: dict[str, Expression]) -> Expression:
+        return BinaryExpression(self.type, 
+                                self.lhs.substitute(mapping),
+                                self.rhs.substitute(mapping))
+
+    def inline_functions(self, context: EvalContext, depth: int = 0) -> Expression:
+        return BinaryExpression(self.type, 
+                                self.lhs.inline_functions(context, depth),
+                                self.rhs.inline_functions(context, depth))
+
+    def simplify(self, stats: OptimizerStats) -> Expression:
+        lhs = self.lhs.simplify(stats)
+        rhs = self.rhs.simplify(stats)
+        if type(lhs) is ConstantExpression and type(rhs) is ConstantExpression:
+            stats.folded_constants = stats.folded_constants + 1
+            return ConstantExpression(self.eval(lhs.value, rhs.value))
+        # A 0 decides an AND and a 1 decides an OR, whatever the other side is
+        for side in [ lhs, rhs ]:
+            if type(side) is ConstantExpression:
+                code = encode_value(side.value)
+                if (self.type == "&" and code == CODE_0) or (self.type == "|" and code == CODE_1):
+                    stats.folded_constants = stats.folded_constants + 1
+                    return side
+        return BinaryExpression(self.type, lhs, rhs)
+
+    def intern(self, table: ExpressionTable) -> Expression:
+        lhs = self.lhs.intern(table)
+        rhs = self.rhs.intern(table)
+        # a | b is the same as b | a 
+        if self.type in COMMUTATIVE_OPERATORS and id(rhs) < id(lhs):
+            key = (self.type, id(rhs), id(lhs))
+        else:
+            key = (self.type, id(lhs), id(rhs))
+        if lhs is self.lhs and rhs is self.rhs:
+            return table.add(key, self)
+        return table.add(key, BinaryExpression(self.type, lhs, rhs))
    
 
 class UnaryExpression(Expression):
@@ -342,6 +845,47 @@ class UnaryExpression(Expression):
         else:
             raise Exception("Invalid operation type")
 
+    def compile(self, context: EvalContext):
+        if self.type == "!":
+            table = NOT_TABLE
+        else:
+            raise Exception("Invalid operation type")
+        lhs = compile_logic_operand(self.lhs, self.lhs.compile(context))
+        def f():
+            return table[lhs()]
+        return context.share(self, f)
+
+    def compile_relocatable(self, context: EvalContext, offsets: dict[str, int]):
+        if self.type != "!":
+            raise Exception("Invalid operation type")
+        table = NOT_TABLE
+        lhs = compile_relocatable_logic_operand(self.lhs, self.lhs.compile_relocatable(context, offsets))
+        def f(base: int):
+            return table[lhs(base)]
+        return f
+
+    def compile_two_state(self, context: EvalContext):
+        if self.type != "!":
+            raise Exception("Invalid operation type")
+        lhs = self.lhs.compile_two_state(context)
+        if lhs is None:
+            return None
+        lhs = compile_two_state_logic_operand(self.lhs, lhs)
+        if lhs is None:
+            return None
+        def f():
+            return lhs() ^ 1
+        return context.share(self, f)
+
+    def compile_batch(self, batch: BatchEvalContext):
+        if self.type != "!":
+            raise Exception("Invalid operation type")
+        mask = batch.mask
+        lhs = self.lhs.compile_batch(batch)
+        def f():
+            return plane_not(lhs(), mask)
+        return f
+
     def __repr__(self):
         return "(" + self.type + str(self.lhs) + ")"
 
@@ -352,6 +896,63 @@ class UnaryExpression(Expression):
         return UnaryExpression(self.type, 
                                self.lhs.globalize(name_prefix, local_variables))
 
+    def get_function_names(self) -> list[str]:
+        return self.lhs.get_function_names()
+
+    def get_size(self) -> int:
+        return 1 + self.lhs.get_size()
+
+    def substitute(self, mapping: dict[str, Expression]) -> Expression:
+        return UnaryExpression(self.type, self.lhs.substitute(mapping))
+
+    def inline_functions(self, context: EvalContext, depth: int = 0) -> Expression:
+        return UnaryExpression(self.type, self.lhs.inline_functions(context, depth))
+
+    def simplify(self, stats: OptimizerStats) -> Expression:
+        lhs = self.lhs.simplify(stats)
+        if type(lhs) is ConstantExpression:
+            stats.folded_constants = stats.folded_constants + 1
+            return ConstantExpression(self.eval(lhs.value))
+        # !!e is the same as e only if e can't be Z or an integer, which is
+        # the case for the result of any operator.
+        if self.type == "!" and type(lhs) is UnaryExpression and lhs.type == "!" and \
+           (type(lhs.lhs) is BinaryExpression or type(lhs.lhs) is UnaryExpression):
+            stats.double_negations = stats.double_negations + 1
+            return lhs.lhs
+        return UnaryExpression(self.type, lhs)
+
+    def intern(self, table: ExpressionTable) -> Expression:
+        lhs = self.lhs.intern(table)
+        if lhs is self.lhs:
+            return table.add((self.type, id(lhs)), self)
+        return table.add((self.type, id(lhs)), UnaryExpression(self.type, lhs))
+
+# Table of the distinct expressions in the design (hash-consing). Two 
+# expressions that have the same operator and the same (shared) operands 
+# are represented by the same object, so the expressions of the design 
+# form a DAG. 
+class ExpressionTable:
+
+    def __init__(self):
+        self.nodes: dict[tuple, Expression] = {}
+        # Number of expressions that turned out to be copies of another
+        self.duplicates = 0
+        # Number of expressions that are read by more than one net (or more
+        # than once by the same net) and are evaluated once per delta cycle
+        self.shared = 0
+
+    def add(self, key: tuple, exp: Expression) -> Expression:
+        if key in self.nodes:
+            self.duplicates = self.duplicates + 1
+            return self.nodes[key]
+        self.nodes[key] = exp
+        return exp
+
+    def __repr__(self) -> str:
+        return "nodes=" + str(len(self.nodes)) + \
+            " duplicates=" + str(self.duplicates) + \
+            " shared=" + str(self.shared)
+
 class FunctionExpression(Expression):
 
     def __init__(self, name: str, params: list[Expression]):
@@ -372,6 +973,61 @@ class FunctionExpression(Expression):
         # Extract the return value based on the name of the function
         return function_context.get_value(function_def.get_name())
 
+    def compile(self, context: EvalContext):
+        params = [param.compile(context) for param in self.params]
+        function_def = context.get_function_def(self.name)
+        return_name = function_def.get_name()
+        # The body of the function is still interpreted
+        def call(param_codes):
+            param_values = [decode_value(code) for code in param_codes]
+            function_context = FunctionEvalContext(function_def, context, param_values)
+            function_def.procedure_block.execute(function_context)
+            return encode_value(function_context.get_value(return_name))
+        if not function_def.is_pure(context):
+            def f():
+                return call([param() for param in params])
+            return f
+        # The result of a pure function only depends on the arguments, and 
+        # there are only a few combinations of four-state values, so the 
+        # results are remembered.
+        memo = function_def.memo
+        def f():
+            param_codes = tuple([param() for param in params])
+            if param_codes in memo:
+                return memo[param_codes]
+            code = call(param_codes)
+            if len(memo) < MEMO_SIZE_LIMIT:
+                memo[param_codes] = code
+            return code
+        return f
+
+    def compile_batch(self, batch: BatchEvalContext):
+        f = self.compile_batch_lanes(batch)
+        def g():
+            return lanes_to_planes(f())
+        return g
+
+    def compile_batch_lanes(self, batch: BatchEvalContext):
+        params = [param.compile_batch_lanes(batch) for param in self.params]
+        function_def = batch.context.get_function_def(self.name)
+        return_name = function_def.get_name()
+        lane_contexts = [BatchLaneContext(batch, lane) for lane in range(0, batch.lane_count)]
+        # The body of the function is interpreted once for each lane
+        def f():
+            param_lanes = [param() for param in params]
+            result = []
+            for lane_context in lane_contexts:
+                param_values = [decode_value(p[lane_context.lane]) for p in param_lanes]
+                function_context = FunctionEvalContext(function_def, lane_context, param_values)
+                function_def.procedure_block.execute(function_context)
+                result.append(encode_value(function_context.get_value(return_name)))
+            return result
+        return f
+
+    # Functions don't declare a return type, so assume the worst
+    def is_batch_wide(self, batch: BatchEvalContext) -> bool:
+        return True
+
     def is_constant(self) -> bool:
         for param in self.params:
             if not param.is_constant():
@@ -389,6 +1045,39 @@ class FunctionExpression(Expression):
         return FunctionExpression(name_prefix + "." + self.name, 
                 [p.globalize(name_prefix, local_variables) for p in self.params])
 
+    def get_function_names(self) -> list[str]:
+        result = [ self.name ]
+        for param in self.params:
+            result.extend(param.get_function_names())
+        return result
+
+    def get_size(self) -> int:
+        size = 1
+        for param in self.params:
+            size = size + param.get_size()
+        return size
+
+    def substitute(self, mapping: dict[str, Expression]) -> Expression:
+        return FunctionExpression(self.name, [p.substitute(mapping) for p in self.params])
+
+    def simplify(self, stats: OptimizerStats) -> Expression:
+        return FunctionExpression(self.name, [p.simplify(stats) for p in self.params])
+
+    # The call itself isn't shared since the function may have side effects
+    def intern(self, table: ExpressionTable) -> Expression:
+        return FunctionExpression(self.name, [p.intern(table) for p in self.params])
+
+    def inline_functions(self, context: EvalContext, depth: int = 0) -> Expression:
+        params = [p.inline_functions(context, depth) for p in self.params]
+        # The depth limit stops recursive functions from expanding forever
+        if depth < INLINE_DEPTH_LIMIT:
+            inlined = context.get_function_def(self.name).inline(params)
+            if inlined is not None and inlined.get_size() <= INLINE_SIZE_LIMIT:
+                context.inlined_calls = context.inlined_calls + 1
+                # The body may call other functions
+                return inlined.inline_functions(context, depth + 1)
+        return FunctionExpression(self.name, params)
+
     def __repr__(self):
         s = self.name + "("
         first = True
@@ -422,30 +1111,37 @@ class VariableType(Enum):
     INTEGER = 1
 
 # TODO: WORK ON STRENGTH
-def wire_logic_eval(drivers: list[Value], net_type: NetType):
+def wire_code_eval(drivers: list[int], net_type: NetType) -> int:
     if net_type == NetType.SUPPLY0:
         if len(drivers) > 0:
             raise Exception("Not allowed to drive a supply net")
-        return Value(0)
+        return CODE_0
     elif net_type == NetType.SUPPLY1:
         if len(drivers) > 0:
             raise Exception("Not allowed to drive a supply net")
-        return Value(1)
+        return CODE_1
     elif net_type == NetType.WIRE:
         if len(drivers) > 1:
-            return LOGIC_X
+            return CODE_X
         return drivers[0]
     elif net_type == NetType.WOR:
-        l = drivers[0]
+        l = logic_code(drivers[0])
         for i in range(1, len(drivers)):
-            l = logic_eval_or(l, drivers[i])
+            l = OR_TABLE[l][logic_code(drivers[i])]
         return l
     elif net_type == NetType.WAND:
-        l = drivers[0]
+        l = logic_code(drivers[0])
         for i in range(1, len(drivers)):
-            l = logic_eval_and(l, drivers[i])
+            l = AND_TABLE[l][logic_code(drivers[i])]
         return l
 
+def wire_logic_eval(drivers: list[Value], net_type: NetType) -> Value:
+    if net_type == NetType.WOR or net_type == NetType.WAND:
+        codes = [encode_logic(driver) for driver in drivers]
+    else:
+        codes = [encode_value(driver) for driver in drivers]
+    return decode_value(wire_code_eval(codes, net_type))
+
 # ----- Declarations -----------------------------------------------------
 
 class SignalDeclaration:
@@ -479,9 +1175,9 @@ class IdentifierWithInit:
         self.init_exp = init_exp
 
     def __repr__(self):      
-        s = self.id.name
-        if self.id.init_exp:
-            s = s + " = " + str(self.id.init_exp)
+        s = self.name
+        if self.init_exp:
+            s = s + " = " + str(self.init_exp)
         return s
 
 class VariableDeclaration:
@@ -575,6 +1271,39 @@ class ProcedureAssignment(ProcedureStatement):
     def get_references(self):
         return self.rhs.get_references()
 
+    # Returns a callable that executes the statement in the (global) context
+    def compile(self, context: EvalContext):
+        if not context.is_valid_signal(self.lhs):
+            raise Exception("Signal not defined " + self.lhs)
+        lhs_info = context.signal_reg.reg[self.lhs]
+        rhs = self.rhs.compile(context)
+        if self.blocking:
+            set_signal_code = context.set_signal_code_blocking
+        else:
+            set_signal_code = context.set_signal_code_non_blocking
+        def f():
+            set_signal_code(lhs_info, rhs())
+        return f
+
+    def inline_functions(self, context: EvalContext) -> ProcedureAssignment:
+        return ProcedureAssignment(self.lhs, self.rhs.inline_functions(context), self.blocking)
+
+    # Returns a callable that executes the statement in the lanes selected 
+    # by the mask.
+    def compile_batch(self, batch: BatchEvalContext):
+        lhs_info = batch.context.get_signal_info(self.lhs)
+        if batch.is_wide_signal(lhs_info):
+            rhs = self.rhs.compile_batch_lanes(batch)
+        else:
+            rhs = self.rhs.compile_batch(batch)
+        if self.blocking:
+            set_signal = batch.set_signal_blocking
+        else:
+            set_signal = batch.set_signal_non_blocking
+        def f(mask):
+            set_signal(lhs_info, rhs(), mask)
+        return f
+
     def __repr__(self):
         s = self.lhs
         if self.blocking:
@@ -596,15 +1325,116 @@ class ProcedureAssignment(ProcedureStatement):
         return ProcedureAssignment(elaborated_lhs, 
                                    self.rhs.globalize(base_name, local_variables), self.blocking)
 
+# A delay in a procedure block (i.e. #64;). The block handles these (see 
+# ProcedureBlock.make_process()).
+class ProcedureDelay(ProcedureStatement):
+
+    def __init__(self, delay: int):
+        self.delay = delay
+
+    def execute(self, context):
+        raise Exception("Delays are only allowed in procedure blocks")
+
+    def get_references(self):
+        return []
+
+    def compile(self, context: EvalContext):
+        return None
+
+    def inline_functions(self, context: EvalContext) -> ProcedureDelay:
+        return self
+
+    def compile_batch(self, batch: BatchEvalContext):
+        raise Exception("Delays are not supported in batch mode")
+
+    def __repr__(self):
+        return "#" + str(self.delay)
+
+    def elaborate(self, base_name: str, local_variables: list[str], context: EvalContext) -> ProcedureDelay:
+        return self
+
+# $finish, which stops the timed scheduler (see EvalContext.finish())
+class ProcedureFinish(ProcedureStatement):
+
+    def execute(self, context):
+        context.finish()
+
+    def get_references(self):
+        return []
+
+    def compile(self, context: EvalContext):
+        def f():
+            context.finish()
+        return f
+
+    def inline_functions(self, context: EvalContext) -> ProcedureFinish:
+        return self
+
+    def compile_batch(self, batch: BatchEvalContext):
+        raise Exception("$finish is not supported in batch mode")
+
+    def __repr__(self):
+        return "$finish"
+
+    def elaborate(self, base_name: str, local_variables: list[str], context: EvalContext) -> ProcedureFinish:
+        return self
+
 class ProcedureBlock:
 
     def __init__(self, statements: list[ProcedureStatement]):
         self.statements = statements
+        # Used by the scheduler to avoid queuing the same block twice
+        self.queued = False
+        # Filled in by EvalContext.compile()
+        self.compiled = None
+        # Indicates that the block is waiting out a delay 
+        self.suspended = False
+        # Continues a suspended block from a statement (see make_process())
+        self.resume = None
 
     def execute(self, context):
         for statement in self.statements:
             statement.execute(context)
 
+    def compile(self, context: EvalContext):
+        return self.make_process(context, [statement.compile(context) for statement in self.statements])
+
+    # Returns a callable that runs the block, given a callable for each 
+    # statement (None for the delays). A block with delays is suspended at 
+    # each delay and resumed later by the timed scheduler (see 
+    # EvalContext.schedule_at()). A suspended block ignores its triggers.
+    def make_process(self, context: EvalContext, steps: list):
+        delays = [statement.delay if type(statement) is ProcedureDelay else None 
+                  for statement in self.statements]
+        if not any([delay is not None for delay in delays]):
+            if len(steps) == 1:
+                return steps[0]
+            def f():
+                for step in steps:
+                    step()
+            return f
+        def run(i: int):
+            while i < len(steps) and not context.finished:
+                if delays[i] is not None:
+                    self.suspended = True
+                    context.schedule_at(context.time + delays[i], ResumeEvent(self, i + 1))
+                    return
+                steps[i]()
+                i = i + 1
+            self.suspended = False
+        self.resume = run
+        def f():
+            if not self.suspended:
+                run(0)
+        return f
+
+    def compile_batch(self, batch: BatchEvalContext):
+        steps = [statement.compile_batch(batch) for statement in self.statements]
+        def f(mask):
+            for step in steps:
+                step(mask)
+        return f
+
     def get_references(self):
         result = []
         for statement in self.statements:
@@ -640,10 +1470,18 @@ class FunctionDefinition:
 
         self.procedure_block: ProcedureBlock = procedure_block
 
+        # Filled in by is_pure()
+        self.pure: bool = None
+        # Remembered results of calls, by argument codes (pure functions only)
+        self.memo: dict[tuple, int] = {}
+
     def get_name(self) -> str: return self.name
 
     def is_local_variable(self, name: str): return name in self.local_variables
 
+    def is_local_name(self, name: str):
+        return name == self.name or self.is_local_variable(name) or self.is_param_name(name)
+
     def is_param_name(self, name: str):
         # TODO: FASTER
         for param in self.params:
@@ -685,6 +1523,47 @@ class FunctionDefinition:
             refs.remove(fp.get_name())
         return refs
 
+    # Returns an expression that computes the result of calling the function
+    # with the argument expressions, or None if that isn't possible. The body
+    # is run symbolically: each assignment replaces the expression held for
+    # a local variable. Functions with side effects can't be inlined.
+    def inline(self, args: list[Expression]) -> Expression:
+        if len(args) != len(self.params):
+            raise Exception("Wrong number of parameters passed to " + self.get_name())
+        # Locals start out as X, just like in FunctionEvalContext
+        mapping: dict[str, Expression] = {}
+        mapping[self.name] = ConstantExpression(LOGIC_X)
+        for name in self.local_variables:
+            mapping[name] = ConstantExpression(LOGIC_X)
+        for i in range(0, len(self.params)):
+            mapping[self.params[i].get_name()] = args[i]
+        for statement in self.procedure_block.statements:
+            if not type(statement) is ProcedureAssignment or not statement.blocking or \
+               not self.is_local_name(statement.lhs):
+                return None
+            mapping[statement.lhs] = statement.rhs.substitute(mapping)
+        return mapping[self.name]
+
+    # A pure function only reads its parameters and local variables, only 
+    # assigns to local variables and only calls other pure functions. 
+    def is_pure(self, context: EvalContext) -> bool:
+        if self.pure is None:
+            # Assume not while looking, in case of recursion
+            self.pure = False
+            pure = True
+            for statement in self.procedure_block.statements:
+                if not type(statement) is ProcedureAssignment or not self.is_local_name(statement.lhs):
+                    pure = False
+                    break
+                for name in statement.rhs.get_references():
+                    if not self.is_local_name(name):
+                        pure = False
+                for name in statement.rhs.get_function_names():
+                    if not context.get_function_def(name).is_pure(context):
+                        pure = False
+            self.pure = pure
+        return self.pure
+
 class FunctionEvalContext:
 
     def __init__(self, function_def: FunctionDefinition, parent_eval_context: EvalContext, 
@@ -731,6 +1610,10 @@ class FunctionEvalContext:
         else:
             self.parent_eval_context.set_value_blocking(name, value)
 
+    # Needed for calls to other functions
+    def get_function_def(self, name: str):
+        return self.parent_eval_context.get_function_def(name)
+
 class NetAssignment:
 
     def __init__(self, name: str, exp: Expression):
@@ -753,6 +1636,15 @@ class PortAssignment:
     def __repr__(self):
         return "." + self.inside_name + "(" + self.outside_name + ")"
 
+# An initial block, which runs once when the design starts
+class InitialProcedure:
+
+    def __init__(self, procedure_block: ProcedureBlock):
+        self.procedure_block = procedure_block
+
+    def __repr__(self) -> str:
+        return "initial\nbegin\n" + str(self.procedure_block) + "end\n"
+
 # TODO: Create always/initial subclasses?
 class TriggeredProcedure:
 
@@ -796,6 +1688,157 @@ class ModuleInstantiation:
         s = s + ")"
         return s
     
+class TemplateSignal:
+
+    def __init__(self, name: str, data_type: DataType, net_type: NetType, var_type: VariableType):
+        self.name = name
+        self.data_type = data_type
+        self.net_type = net_type
+        self.var_type = var_type
+        # Initial value (variables only)
+        self.code = CODE_X
+
+class TemplateAssignment:
+
+    def __init__(self, name: str, exp: Expression):
+        self.name = name
+        self.exp = exp
+        # Calls need the function name globalized, which substitute() 
+        # doesn't do
+        self.has_calls = len(exp.get_function_names()) > 0
+        # The (local) names read by the expression
+        self.references = list(dict.fromkeys(exp.get_references()))
+        # Set by ModuleTemplate.add_assignment() when the expression can be 
+        # shared by the instances (see InstanceExpression)
+        self.relocatable = False
+
+# The parts of a module definition that are the same for every instance, 
+# worked out once per module rather than once per instance (see 
+# ModuleDefinition.elaborate()). Each local signal has a fixed offset in 
+# the block of slots that an instance gets, so an expression that only 
+# reads local signals can be shared by all of the instances and compiled 
+# once (see InstanceExpression). Each instance still gets its own 
+# SignalInformation entries (the scheduler works on those) and procedure
+# blocks.
+class ModuleTemplate:
+
+    def __init__(self, module_def: ModuleDefinition):
+        self.port_types: dict[str, PortType] = {}
+        self.signals: list[TemplateSignal] = []
+        self.offsets: dict[str, int] = {}
+        self.assignments: list[TemplateAssignment] = []
+        # The names read by the assignments
+        self.references: dict[str, bool] = {}
+
+        for pd in module_def.port_declarations:
+            self.port_types[pd.get_name()] = pd.port_type
+            self.add_signal(pd.get_name(), DataType.NET, NetType.WIRE, None)
+        for nd in module_def.net_declarations:
+            self.add_signal(nd.get_name(), DataType.NET, nd.get_net_type(), None)
+        for vd in module_def.var_declarations:
+            ts = self.add_signal(vd.get_name(), DataType.VARIABLE, None, vd.get_var_type())
+            if vd.id.init_exp:
+                # Make sure the expression is a constant
+                if not vd.id.init_exp.is_constant():
+                    raise Exception("Non-constant initialization of variable " + 
+                                    join_name(module_def.name, vd.get_name()))
+                # No context is being passed - should not be needed for a constant!
+                ts.code = encode_value(vd.id.init_exp.evaluate(None))
+
+        for na in module_def.net_assignments:
+            self.add_assignment(na.get_name(), na.exp)
+        for nd in module_def.net_declarations:
+            if nd.exp:
+                self.add_assignment(nd.get_name(), nd.exp)
+
+    # A name that is declared more than once (i.e. a port that is also 
+    # declared as a wire or a reg) only gets one slot. The last declaration
+    # decides the type.
+    def add_signal(self, name: str, data_type: DataType, net_type: NetType, 
+                   var_type: VariableType) -> TemplateSignal:
+        if name in self.offsets:
+            ts = self.signals[self.offsets[name]]
+            ts.data_type = data_type
+            ts.net_type = net_type
+            ts.var_type = var_type
+            return ts
+        self.offsets[name] = len(self.signals)
+        self.signals.append(TemplateSignal(name, data_type, net_type, var_type))
+        return self.signals[-1]
+
+    def add_assignment(self, name: str, exp: Expression):
+        ta = TemplateAssignment(name, exp)
+        # A lone name or constant is no bigger than its own copy
+        ta.relocatable = not ta.has_calls and \
+            (type(exp) is BinaryExpression or type(exp) is UnaryExpression) and \
+            all([ref_name in self.offsets for ref_name in ta.references])
+        self.assignments.append(ta)
+        for ref_name in ta.references:
+            self.references[ref_name] = True
+
+# An assignment of one instance of a module. The expression tree belongs to
+# the module template and is shared by all of the instances, and so is its
+# compiled form (see Expression.compile_relocatable()). The instance only 
+# adds the first slot of its block. The passes that rewrite expressions 
+# (i.e. EvalContext.optimize()) and the evaluators that aren't relocatable
+# work on a copy with the instance's names (see expand()).
+class InstanceExpression(Expression):
+
+    def __init__(self, assignment: TemplateAssignment, template: ModuleTemplate, prefix: str, base: int):
+        self.assignment = assignment
+        self.template = template
+        self.prefix = prefix
+        self.base = base
+
+    # Returns a copy of the expression with the names of the instance
+    def expand(self) -> Expression:
+        return self.assignment.exp.globalize(self.prefix, [])
+
+    def evaluate(self, context: EvalContext) -> Value:
+        return self.expand().evaluate(context)
+
+    def is_constant(self) -> bool:
+        return False
+
+    def __repr__(self) -> str:
+        return str(self.expand())
+
+    def get_references(self) -> list[str]:
+        return [join_name(self.prefix, name) for name in self.assignment.references]
+
+    def get_size(self) -> int:
+        return self.assignment.exp.get_size()
+
+    # The compiled template is shared by the instances of the module in the
+    # context
+    def compile(self, context: EvalContext):
+        f = context.template_code.get(self.assignment)
+        if f is None:
+            f = self.assignment.exp.compile_relocatable(context, self.template.offsets)
+            context.template_code[self.assignment] = f
+        base = self.base
+        def g():
+            return f(base)
+        return g
+
+    def compile_two_state(self, context: EvalContext):
+        return self.expand().compile_two_state(context)
+
+    def compile_batch(self, batch: BatchEvalContext):
+        return self.expand().compile_batch(batch)
+
+    def compile_batch_lanes(self, batch: BatchEvalContext):
+        return self.expand().compile_batch_lanes(batch)
+
+    def is_batch_wide(self, batch: BatchEvalContext) -> bool:
+        return self.expand().is_batch_wide(batch)
+
+    def substitute(self, mapping: dict[str, Expression]) -> Expression:
+        return self.expand().substitute(mapping)
+
+    def simplify(self, stats: OptimizerStats) -> Expression:
+        return self.expand().simplify(stats)
+
 class ModuleDefinition:
 
     def __init__(self, 
@@ -806,7 +1849,8 @@ class ModuleDefinition:
                  module_instantiations: list[ModuleInstantiation],
                  function_definitions: list[FunctionDefinition],
                  var_declarations: list[VariableDeclaration],
-                 triggered_procedures: list[TriggeredProcedure]):
+                 triggered_procedures: list[TriggeredProcedure],
+                 initial_procedures: list[InitialProcedure] = None):
 
         self.name = name
         self.module_instantiations = module_instantiations
@@ -816,9 +1860,28 @@ class ModuleDefinition:
         self.net_assignments: list[NetAssignment] = net_assignments
         self.var_declarations: list[VariableDeclaration] = var_declarations
         self.triggered_procedures: list[TriggeredProcedure] = triggered_procedures
+        self.initial_procedures: list[InitialProcedure] = initial_procedures or []
+        # Filled in by get_template()
+        self.template: ModuleTemplate = None
 
     def get_name(self): return self.name
 
+    # Returns the parts of the module that are the same for every instance
+    def get_template(self) -> ModuleTemplate:
+        if self.template is None:
+            self.template = ModuleTemplate(self)
+        return self.template
+
+    # Counts the instances of each module in the design below (and 
+    # including) this module
+    def count_instances(self, module_defs: dict[str, ModuleDefinition], counts: dict[str, int]):
+        counts[self.name] = counts.get(self.name, 0) + 1
+        for mi in self.module_instantiations:
+            module_defs[mi.name].count_instances(module_defs, counts)
+
+    # Creates an instance of the module in the design. The instance gets a
+    # block of consecutive slots laid out by the module template and its
+    # ports are wired to the signals of the parent named in param_map.
     def elaborate(self, 
                   path: str, 
                   name: str,
@@ -826,103 +1889,94 @@ class ModuleDefinition:
                   module_defs: dict[str, ModuleDefinition], 
                   context: EvalContext):
 
+        template = self.get_template()
+        prefix = join_name(path, name)
+        # The top of the design counts the instances
+        if context.instance_counts is None:
+            context.instance_counts = {}
+            self.count_instances(module_defs, context.instance_counts)
+        # The expressions are shared by the instances when they are compiled
+        # as they are. The optimizer rewrites them for each instance anyway.
+        shared = context.compiled and not context.optimize_netlist and \
+            context.instance_counts.get(self.name, 0) > 1
+
         # Register the function definitions into a global repository
         for fd in self.function_definitions:
-            context.func_def_reg.add_function(join_name(path, name, fd.get_name()), 
-                fd.elaborate(join_name(path, name), context))
-        
-        # Create some additional assignments to wire the module parameters. 
-        # These assignments depend on the direction of the port.
-        for inner_name, global_outer_name in param_map.items():
+            context.func_def_reg.add_function(join_name(prefix, fd.get_name()), 
+                fd.elaborate(prefix, context))
 
-            # Globalize the names involved in the port assignment
-            global_inner_name = join_name(path, name, inner_name)
-
-            # Find the appropriate port 
-            pd = None
-            for potential_pd in self.port_declarations:
-                if potential_pd.get_name() == inner_name:
-                    pd = potential_pd
-                    break
-            if not pd:
+        for inner_name in param_map:
+            if not inner_name in template.port_types:
                 raise Exception("Port not defined " + inner_name)
 
-            if pd.port_type == PortType.INPUT:
+        # Register the signals of the instance, including any ports that 
+        # aren't connected.
+        # Ex:
+        #   wire a;
+        #   reg b = 1;
+        base = context.value_state.allocate_block(len(template.signals))
+        for offset, ts in enumerate(template.signals):
+            global_signal_name = join_name(prefix, ts.name)
+            if ts.data_type == DataType.NET:
+                context.signal_reg.declare_net(global_signal_name, ts.net_type, base + offset)
+            else:
+                context.signal_reg.declare_variable(global_signal_name, ts.var_type, base + offset)
+                context.value_state.codes[base + offset] = ts.code
+
+        # Create some additional assignments to wire the module parameters. 
+        # These assignments depend on the direction of the port.
+        # NOTE: We assume that the outer name is already declared
+        for inner_name, global_outer_name in param_map.items():
+            global_inner_name = join_name(prefix, inner_name)
+            if template.port_types[inner_name] == PortType.INPUT:
                 # Register the assignment: inner <- outer
-                # NOTE: We assume that the outer name is already declared
-                context.signal_reg.declare_net(global_inner_name, NetType.WIRE)
                 context.signal_reg.add_assignment(global_inner_name,
                                               VariableExpression(global_outer_name))                                                 
-            elif pd.port_type == PortType.OUTPUT:
+            elif template.port_types[inner_name] == PortType.OUTPUT:
                 # Register the assignment: outer <- inner
-                # NOTE: We assume that the outer name is already declared
                 # TODO: THE PORT ASSIGNMENTS CAN BE VARIABLES OR WIRES
-                context.signal_reg.declare_net(global_inner_name, NetType.WIRE)
                 context.signal_reg.add_assignment(global_outer_name,
                                               VariableExpression(global_inner_name))                                                 
             else:
                 raise Exception("Invalid port type")
 
-        # Register the net declarations into a global repository
-        # Ex:
-        #   wire a;
-        for nd in self.net_declarations:
-            global_net_name = join_name(path, name, nd.get_name())
-            context.signal_reg.declare_net(global_net_name, nd.get_net_type())
-            # Set the initial value
-            context.value_state.set_value(global_net_name, LOGIC_X)
-
-        # Register the variable declarations into a global repository
-        # Ex:
-        #   reg a;
-        #   reg b = 1;
-        for vd in self.var_declarations:
-            global_signal_name = join_name(path, name, vd.get_name())
-            context.signal_reg.declare_variable(global_signal_name, vd.get_var_type())
-            # Set the initial value
-            if vd.id.init_exp:
-                # Make sure the expression is a constant
-                if not vd.id.init_exp.is_constant():
-                    raise Exception("Non-constant initialization of variable " + global_signal_name)
-                # No context is being passed - should not be needed for a constant!
-                context.value_state.set_value(global_signal_name, vd.id.init_exp.evaluate(None))
-            # Default initial value is X
-            else:
-                context.value_state.set_value(global_signal_name, LOGIC_X)
-
-        # Instantiate the required global assignments (stand-alone assignments)
+        # Instantiate the required global assignments, both the stand-alone 
+        # ones and the ones that are part of the declarations.
         # Ex:
         #   assign a = (b | c);
-        for na in self.net_assignments:
-            global_net_name = join_name(path, name, na.get_name())
-            # Globalize the RHS of the assignment
-            # TODO: DEAL WITH LOCAL VARIABLE LIST
-            global_exp = na.exp.globalize(join_name(path, name), [])
-            # Add the assignment to the global registry
-            context.signal_reg.add_assignment(global_net_name, global_exp)
-
-        # Instantiate the required global assignments (assignments that are part of the declarations)
-        # Ex: 
         #   wire a = (b | c);
-        for nd in self.net_declarations:
-            if nd.exp:
-                global_net_name = join_name(path, name, nd.get_name())
-                # Globalize the RHS of the assignment
-                # TODO: DEAL WITH LOCAL VARIABLE LIST
-                global_exp = nd.exp.globalize(join_name(path, name), [])
-                # Add the assignment to the global registry
-                context.signal_reg.add_assignment(global_net_name, global_exp)
+        # Where the expressions aren't shared, the names in the template 
+        # expressions are replaced with the instance's signals. One 
+        # VariableExpression is created per name and the constants are 
+        # shared with the template.
+        mapping: dict[str, Expression] = None
+        for ta in template.assignments:
+            if shared and ta.relocatable:
+                global_exp = InstanceExpression(ta, template, prefix, base)
+            elif ta.has_calls:
+                # The names of the functions need to be globalized too
+                global_exp = ta.exp.globalize(prefix, [])
+            else:
+                if mapping is None:
+                    mapping = {}
+                    for local_name in template.references:
+                        mapping[local_name] = VariableExpression(globalize_name_if_necessary(prefix, [], local_name))
+                global_exp = ta.exp.substitute(mapping)
+            context.signal_reg.add_assignment(join_name(prefix, ta.name), global_exp)
 
         # Setup the triggers
         for tp in self.triggered_procedures:
             # Elaborate the procedure for this context
             # TODO: LOCAL VARIABLES?
-            elaborated_pb = tp.procedure_block.elaborate(join_name(path, name), [], context)      
+            elaborated_pb = tp.procedure_block.elaborate(prefix, [], context)      
             # Setup a trigger for each name in the sensitivity list
             for id in tp.identifiers:
-                global_net_name = join_name(path, name, id)
+                global_net_name = join_name(prefix, id)
                 context.signal_reg.add_triggered_procedure(global_net_name, elaborated_pb)
 
+        for ip in self.initial_procedures:
+            context.initial_blocks.append(ip.procedure_block.elaborate(prefix, [], context))
+
         # Deal with next level down of modules
         for mi in self.module_instantiations:
             module_def = module_defs[mi.name]
@@ -930,8 +1984,8 @@ class ModuleDefinition:
             # actual signal names.
             child_param_map = {}
             for port in mi.ports:
-                child_param_map[port.inside_name] = join_name(path, name, port.outside_name)
-            module_def.elaborate(join_name(path, name), mi.instance_name,
+                child_param_map[port.inside_name] = join_name(prefix, port.outside_name)
+            module_def.elaborate(prefix, mi.instance_name,
                 child_param_map, module_defs, context)
 
     def __repr__(self):
@@ -955,54 +2009,263 @@ class ModuleDefinition:
             s = s + str(mi) + ";\n"
         for tp in self.triggered_procedures:
             s = s + str(tp) 
+        for ip in self.initial_procedures:
+            s = s + str(ip) 
         s = s + "endmodule"
         return s
 
+# ===== Graph Utilities =======================================================
+
+# Tarjan's algorithm, written without recursion so that long chains of 
+# nets don't run into the Python recursion limit. The components are 
+# returned in reverse topological order (i.e. sinks first).
+def find_strongly_connected_components(nodes: list, get_successors) -> list[list]:
+
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    result = []
+    counter = 0
+
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = counter
+        lowlink[root] = counter
+        counter = counter + 1
+        stack.append(root)
+        on_stack.add(root)
+        # Each work item is a node and an iterator over its successors
+        work = [ (root, iter(get_successors(root))) ]
+
+        while len(work) > 0:
+            node, successors = work[-1]
+            descended = False
+            for successor in successors:
+                if not successor in index:
+                    index[successor] = counter
+                    lowlink[successor] = counter
+                    counter = counter + 1
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(get_successors(successor))))
+                    descended = True
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            if descended:
+                continue
+
+            # All successors have been visited
+            work.pop()
+            if len(work) > 0:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+            # Is this node the root of a component?
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component.append(member)
+                    if member is node:
+                        break
+                result.append(component)
+
+    return result
+
 # ===== Simulation Engine =====================================================
 
 class ValueState:
 
     def __init__(self):
-        self.state: dict[str, Value] = {}
+        # Each signal is resolved to an integer slot when it is first 
+        # declared. Names are only needed at the API boundary.
+        self.slots: dict[str, int] = {}
+        # Values are stored as codes (see encode_value()), indexed by slot
+        self.codes = array("q")
+
+    # Returns the slot for the name, creating one (with an X value) if needed
+    def allocate_slot(self, name: str) -> int:
+        if not name in self.slots:
+            self.slots[name] = len(self.codes)
+            self.codes.append(CODE_X)
+        return self.slots[name]
+
+    # Reserves a number of consecutive slots (with X values) and returns 
+    # the first one. See bind_slot().
+    def allocate_block(self, count: int) -> int:
+        base = len(self.codes)
+        self.codes.extend([CODE_X] * count)
+        return base
+
+    # Gives the name a slot that was reserved with allocate_block()
+    def bind_slot(self, name: str, slot: int):
+        self.slots[name] = slot
+        self.codes[slot] = CODE_X
+
+    def get_slot(self, name: str) -> int:
+        if not name in self.slots:
+            raise Exception("No value available for " + name)
+        return self.slots[name]
 
     # Sets a value and returns an indication of whether the value was changed
     # as a result.
     def set_value(self, name: str, value: Value) -> bool:
-        changed = (not name in self.state) or (not self.state[name] == value)
-        self.state[name] = value
-        return changed
+        return self.set_code(name, encode_value(value))
+
+    def set_code(self, name: str, code: int) -> bool:
+        if not name in self.slots:
+            self.allocate_slot(name)
+            self.codes[self.slots[name]] = code
+            return True
+        return self.set_slot_code(self.slots[name], code)
+
+    def set_slot_code(self, slot: int, code: int) -> bool:
+        if self.codes[slot] == code:
+            return False
+        self.codes[slot] = code
+        return True
 
     def get_value(self, name: str) -> Value: 
-        if not name in self.state:
-            return LOGIC_X
+        return decode_value(self.get_code(name))
+
+    def get_code(self, name: str) -> int: 
+        if not name in self.slots:
+            return CODE_X
         else:
-            return self.state[name]
+            return self.codes[self.slots[name]]
 
     def is_value_available(self, name: str) -> bool: 
-        return name in self.state
+        return name in self.slots
 
 class SignalInformation:
 
-    def __init__(self, name: str, data_type: DataType, net_type: NetType, var_type: VariableType):
+    def __init__(self, name: str, data_type: DataType, net_type: NetType, var_type: VariableType,
+                 slot: int):
         self.name = name
+        self.slot = slot
         self.data_type = data_type 
         self.net_type = net_type
         self.var_type = var_type
         self.assignments: list[Expression] = []
         self.dirty: bool = True  
+        # Callable that computes the resolved value of the net from all of 
+        # its drivers. Filled in by EvalContext.compile().
+        self.evaluator = None
         # These are procedure blocks that should be executed 
         # whenever the net is changed.
         self.triggered_procedure_blocks: list[ProcedureBlock] = []
+        # The nets that read this signal. Filled in from the registry's 
+        # fanout index by EvalContext.compile().
+        self.fanout: list[SignalInformation] = []
+        # The rank of the net in the static schedule (see EvalContext.levelize())
+        self.level: int = 0
+        # Indicates that the net is part of a combinational loop
+        self.cyclic: bool = False
+        # The SignalWatches that need to hear about changes
+        self.watches: list[SignalWatch] = []
+        # Set when the optimizer has collapsed this net into another signal.
+        # The name is kept as a view of the other signal's slot.
+        self.alias: SignalInformation = None
+        # Version of the evaluator for when there are no X/Z values around, 
+        # or None if the net always needs the four-state version (see 
+        # EvalContext.two_state).
+        self.two_state_evaluator = None
+        # Indicates that the signal counts towards EvalContext.xz_count
+        self.xz_tracked: bool = False
+        # The signals that the net reads
+        self.fanin: list[SignalInformation] = []
+        # Set when the net is outside of the cone of the observed signals.
+        # A lazy net is only recomputed when it's read (see 
+        # EvalContext.limit_to_cone()).
+        self.lazy: bool = False
 
     def has_any_drivers(self) -> bool:
         return len(self.assignments) > 0
 
+class SignalNameTreeNode:
+
+    def __init__(self):
+        self.children: dict[str, SignalNameTreeNode] = {}
+        # The signal whose full name ends at this node, if any
+        self.signal_info: SignalInformation = None
+
+# Index of the signals by the parts of their hierarchical names (i.e. 
+# "tw.r4.state" is stored under "tw", then "r4", then "state") so that 
+# a query only looks at the part of the hierarchy it is interested in.
+class SignalNameTree:
+
+    def __init__(self):
+        self.root = SignalNameTreeNode()
+
+    def add(self, name: str, signal_info: SignalInformation):
+        node = self.root
+        for part in name.split("."):
+            if not part in node.children:
+                node.children[part] = SignalNameTreeNode()
+            node = node.children[part]
+        node.signal_info = signal_info
+
+    def remove(self, name: str):
+        node = self.root
+        for part in name.split("."):
+            if not part in node.children:
+                return
+            node = node.children[part]
+        node.signal_info = None
+
+    # Returns the signals that match a pattern. The pattern is matched one 
+    # part of the name at a time, using glob-style wildcards (*, ?, [...]) 
+    # within each part. A part of "**" matches any number of levels. For
+    # example: "tw.*_sw", "tw.r4.*" or "**.state".
+    def find(self, pattern: str) -> list[SignalInformation]:
+        result: dict[SignalInformation, bool] = {}
+        self.match(self.root, pattern.split("."), 0, result)
+        return list(result.keys())
+
+    # Returns the signal with the name and everything below it in the 
+    # hierarchy.
+    def find_prefix(self, prefix: str) -> list[SignalInformation]:
+        return self.find(prefix + ".**")
+
+    # Returns the signals with names that end with the suffix
+    def find_suffix(self, suffix: str) -> list[SignalInformation]:
+        return self.find("**.*" + suffix)
+
+    def match(self, node: SignalNameTreeNode, parts: list[str], i: int, 
+              result: dict[SignalInformation, bool]):
+        if i == len(parts):
+            if node.signal_info is not None:
+                result[node.signal_info] = True
+            return
+        part = parts[i]
+        if part == "**":
+            # Try matching nothing, and then one more level
+            self.match(node, parts, i + 1, result)
+            for child in node.children.values():
+                self.match(child, parts, i, result)
+        elif "*" in part or "?" in part or "[" in part:
+            for child_name, child in node.children.items():
+                if fnmatch.fnmatchcase(child_name, part):
+                    self.match(child, parts, i + 1, result)
+        elif part in node.children:
+            self.match(node.children[part], parts, i + 1, result)
+
 # Used for storing net types and assignments
 class SignalRegistry:
 
     def __init__(self, value_state: ValueState):
         self.value_state = value_state
         self.reg: dict[str, SignalInformation] = {}
+        # Fanout index: maps the name of each signal to the nets that read 
+        # it in one of their assignments. This is built up during elaboration
+        # so that a value change only needs to visit its real dependents.
+        # (The readers are kept as the keys of a dict to weed out duplicates.)
+        self.fanout: dict[str, dict[SignalInformation, bool]] = {}
+        self.name_tree = SignalNameTree()
 
     def get_names(self) -> list[str]:
         return [x for x in self.reg.keys()]
@@ -1010,28 +2273,70 @@ class SignalRegistry:
     def is_valid_signal(self, name: str) -> bool:
         return name in self.reg
 
-    def declare_net(self, name: str, net_type: NetType):
-        self.reg[name] = SignalInformation(name, DataType.NET, net_type, None)
+    # A slot can be provided if one was reserved for the signal (see 
+    # ValueState.allocate_block())
+    def declare_net(self, name: str, net_type: NetType, slot: int = None):
+        if slot is None:
+            slot = self.value_state.allocate_slot(name)
+        else:
+            self.value_state.bind_slot(name, slot)
+        self.reg[name] = SignalInformation(name, DataType.NET, net_type, None, slot)
+        self.name_tree.add(name, self.reg[name])
         # Initial value
         self.value_state.set_value(name, LOGIC_X)
 
     def is_net(self, name: str) -> bool:
         return name in self.reg and self.reg[name].data_type == DataType.NET
 
-    def declare_variable(self, name: str, var_type: VariableType):
-        self.reg[name] = SignalInformation(name, DataType.VARIABLE, None, var_type)
+    def declare_variable(self, name: str, var_type: VariableType, slot: int = None):
+        if slot is None:
+            slot = self.value_state.allocate_slot(name)
+        else:
+            self.value_state.bind_slot(name, slot)
+        self.reg[name] = SignalInformation(name, DataType.VARIABLE, None, var_type, slot)
+        self.name_tree.add(name, self.reg[name])
         # Initial value
         self.value_state.set_value(name, LOGIC_X)
 
     def is_variable(self, name: str) -> bool:
         return name in self.reg and self.reg[name].data_type == DataType.VARIABLE
 
+    # Forgets about a signal. The slot is left alone. The fanout index needs
+    # to be rebuilt afterwards.
+    def remove(self, name: str):
+        del self.reg[name]
+        del self.value_state.slots[name]
+        self.name_tree.remove(name)
+
     def add_assignment(self, name: str, exp: Expression):
         if not name in self.reg:
             raise Exception("Attempt to add assignment to undeclared net " + name)
         if self.reg[name].data_type != DataType.NET:
             raise Exception("Attempt to assign value to register")
-        self.reg[name].assignments.append(exp)
+        net_info = self.reg[name]
+        net_info.assignments.append(exp)
+        self.add_reader(net_info, exp)
+
+    # Record the net as a reader of everything the expression references.
+    # NOTE: The referenced signals may not have been declared yet.
+    def add_reader(self, net_info: SignalInformation, exp: Expression):
+        for ref_name in exp.get_references():
+            if not ref_name in self.fanout:
+                self.fanout[ref_name] = {}
+            self.fanout[ref_name][net_info] = True
+
+    # Used after the assignments have been rewritten
+    def rebuild_fanout(self):
+        self.fanout = {}
+        for net_info in self.reg.values():
+            for exp in net_info.assignments:
+                self.add_reader(net_info, exp)
+
+    # Returns the nets that need to be recomputed when the named signal changes
+    def get_fanout(self, name: str) -> list[SignalInformation]:
+        if not name in self.fanout:
+            return []
+        return list(self.fanout[name])
 
     def add_triggered_procedure(self, name: str, procedure_block: ProcedureBlock):
         if not name in self.reg:
@@ -1064,14 +2369,310 @@ class FunctionDefinitionRegistry:
         return self.reg[name]
 
 
-class EvalContext:
+# Activity counters maintained by the scheduler
+class SchedulerStats:
 
     def __init__(self):
+        # Number of passes through the scheduler that had work to do
+        self.delta_cycles = 0
+        # Number of nets that were recomputed
+        self.net_evaluations = 0
+        # Number of triggered procedure blocks that were executed
+        self.procedure_executions = 0
+        # Number of times that a shared expression was already evaluated 
+        # in the same delta cycle (see EvalContext.share_expressions())
+        self.shared_hits = 0
+        # Number of net evaluations that used the two-state evaluator
+        self.two_state_evaluations = 0
+        # Number of lazy nets that were recomputed because they were read
+        self.lazy_evaluations = 0
+
+    def __repr__(self) -> str:
+        return "delta_cycles=" + str(self.delta_cycles) + \
+            " net_evaluations=" + str(self.net_evaluations) + \
+            " procedure_executions=" + str(self.procedure_executions) + \
+            " shared_hits=" + str(self.shared_hits) + \
+            " two_state_evaluations=" + str(self.two_state_evaluations) + \
+            " lazy_evaluations=" + str(self.lazy_evaluations)
+
+# Counters for finding the parts of a design that take up the time (see 
+# EvalContext.start_profile()). The evaluators of the nets and the blocks 
+# are wrapped while the profiler is attached, so nothing is paid for it the
+# rest of the time.
+class Profiler:
+
+    def __init__(self, context: EvalContext):
+        self.context = context
+        # Number of times each net was evaluated and changed
+        self.net_evaluations: dict[SignalInformation, int] = {}
+        self.changes: dict[SignalInformation, int] = {}
+        # Number of times each block was run and the total time spent in 
+        # it (in seconds). The time after a delay isn't included.
+        self.block_executions: dict[ProcedureBlock, int] = {}
+        self.block_times: dict[ProcedureBlock, float] = {}
+        self.block_names: dict[ProcedureBlock, str] = {}
+        # Maps a number of delta cycles to the number of ticks that took 
+        # that many
+        self.delta_cycles_per_tick: dict[int, int] = {}
+        self.ticks = 0
+        # The evaluators that were wrapped, so they can be put back
+        self.evaluators: dict[SignalInformation, tuple] = {}
+        self.blocks: dict[ProcedureBlock, object] = {}
+
+    # The counters carry on from where they were if the profiler is 
+    # attached again (see Engine.activate())
+    def attach(self):
+        naming = len(self.block_names) == 0
+        reg = self.context.signal_reg.reg
+        for signal_info in reg.values():
+            if signal_info.alias is not None:
+                continue
+            if signal_info.evaluator is not None:
+                self.evaluators[signal_info] = (signal_info.evaluator, signal_info.two_state_evaluator)
+                self.net_evaluations.setdefault(signal_info, 0)
+                signal_info.evaluator = self.wrap_net(signal_info, signal_info.evaluator)
+                if signal_info.two_state_evaluator is not None:
+                    signal_info.two_state_evaluator = self.wrap_net(signal_info, signal_info.two_state_evaluator)
+            self.changes.setdefault(signal_info, 0)
+            signal_info.watches.append(self)
+            if not naming:
+                continue
+            for pb in signal_info.triggered_procedure_blocks:
+                if not pb in self.block_names:
+                    self.block_names[pb] = "always @("
+                else:
+                    self.block_names[pb] = self.block_names[pb] + ", "
+                self.block_names[pb] = self.block_names[pb] + signal_info.name
+        for pb in self.block_names:
+            if naming:
+                self.block_names[pb] = self.block_names[pb] + ")"
+            self.blocks[pb] = pb.compiled
+            self.block_executions.setdefault(pb, 0)
+            self.block_times.setdefault(pb, 0.0)
+            pb.compiled = self.wrap_block(pb, pb.compiled)
+
+    def detach(self):
+        for signal_info, (evaluator, two_state_evaluator) in self.evaluators.items():
+            signal_info.evaluator = evaluator
+            signal_info.two_state_evaluator = two_state_evaluator
+        for signal_info in self.changes:
+            signal_info.watches.remove(self)
+        for pb, compiled in self.blocks.items():
+            pb.compiled = compiled
+
+    def wrap_net(self, signal_info: SignalInformation, f):
+        counts = self.net_evaluations
+        def g():
+            counts[signal_info] = counts[signal_info] + 1
+            return f()
+        return g
+
+    def wrap_block(self, pb: ProcedureBlock, f):
+        executions = self.block_executions
+        times = self.block_times
+        def g():
+            start = time.perf_counter()
+            f()
+            times[pb] = times[pb] + time.perf_counter() - start
+            executions[pb] = executions[pb] + 1
+        return g
+
+    # Called on each change, like a SignalWatch
+    def notify(self, signal_info: SignalInformation):
+        self.changes[signal_info] = self.changes[signal_info] + 1
+
+    def end_tick(self, stats: SchedulerStats):
+        self.ticks = self.ticks + 1
+        n = stats.delta_cycles
+        self.delta_cycles_per_tick[n] = self.delta_cycles_per_tick.get(n, 0) + 1
+
+    # Returns (name, evaluations, changes) for the nets that were evaluated
+    # the most
+    def get_hot_nets(self, count: int = 10) -> list[tuple[str, int, int]]:
+        signal_infos = sorted(self.net_evaluations, key=lambda s: self.net_evaluations[s], reverse=True)
+        return [(s.name, self.net_evaluations[s], self.changes[s]) for s in signal_infos[:count]]
+
+    # Returns (name, changes) for the signals that changed the most
+    def get_busy_signals(self, count: int = 10) -> list[tuple[str, int]]:
+        signal_infos = sorted(self.changes, key=lambda s: self.changes[s], reverse=True)
+        return [(s.name, self.changes[s]) for s in signal_infos[:count]]
+
+    # Returns (name, executions, seconds) for the blocks that took the most 
+    # time
+    def get_hot_blocks(self, count: int = 10) -> list[tuple[str, int, float]]:
+        blocks = sorted(self.block_times, key=lambda pb: self.block_times[pb], reverse=True)
+        return [(self.block_names[pb], self.block_executions[pb], self.block_times[pb]) 
+                for pb in blocks[:count]]
+
+    def report(self, count: int = 10) -> str:
+        lines = []
+        lines.append("Nets by evaluations (evaluations, changes, name):")
+        for name, evaluations, changes in self.get_hot_nets(count):
+            lines.append(str(evaluations).rjust(12) + str(changes).rjust(12) + "  " + name)
+        lines.append("Signals by changes (changes, name):")
+        for name, changes in self.get_busy_signals(count):
+            lines.append(str(changes).rjust(12) + "  " + name)
+        lines.append("Blocks by time (ms, executions, triggers):")
+        for name, executions, seconds in self.get_hot_blocks(count):
+            lines.append("{:12.3f}".format(seconds * 1000) + str(executions).rjust(12) + "  " + name)
+        lines.append("Delta cycles per tick (delta cycles, ticks):")
+        for n in sorted(self.delta_cycles_per_tick):
+            lines.append(str(n).rjust(12) + str(self.delta_cycles_per_tick[n]).rjust(12))
+        return "\n".join(lines)
+
+# What the netlist optimizer did (see EvalContext.optimize())
+class OptimizerStats:
+
+    def __init__(self):
+        # Number of operators that were evaluated ahead of time
+        self.folded_constants = 0
+        # Number of nets that turned out to have a constant value
+        self.constant_nets = 0
+        # Number of nets that were collapsed into the signal they copy
+        self.aliases = 0
+        # Number of !! that were removed
+        self.double_negations = 0
+        # Number of nets, variables and procedure blocks that were removed 
+        # because nothing could see them (see EvalContext.eliminate_dead_logic())
+        self.dead_nets = 0
+        self.dead_variables = 0
+        self.dead_blocks = 0
+
+    def __repr__(self) -> str:
+        return "folded_constants=" + str(self.folded_constants) + \
+            " constant_nets=" + str(self.constant_nets) + \
+            " aliases=" + str(self.aliases) + \
+            " double_negations=" + str(self.double_negations) + \
+            " dead_nets=" + str(self.dead_nets) + \
+            " dead_variables=" + str(self.dead_variables) + \
+            " dead_blocks=" + str(self.dead_blocks)
+
+# Raised when the design doesn't settle down (see 
+# EvalContext.report_oscillation()). The names of the signals that kept 
+# changing and of the feedback loops they are part of are included.
+class OscillationError(Exception):
+
+    def __init__(self, delta_limit: int, signals: list[str], loops: list[list[str]]):
+        self.signals = signals
+        self.loops = loops
+        message = "Design did not settle within " + str(delta_limit) + " delta cycles, changing: " + \
+            ", ".join(signals)
+        for loop in loops:
+            message = message + "\nFeedback loop: " + ", ".join(loop)
+        super().__init__(message)
+
+# A timed event (see EvalContext.schedule_at()) that continues a suspended
+# block. The block and statement are kept (rather than a closure) so that 
+# the event can be carried over to another engine (see Snapshot).
+class ResumeEvent:
+
+    def __init__(self, procedure_block: ProcedureBlock, step: int):
+        self.procedure_block = procedure_block
+        self.step = step
+
+    def __call__(self):
+        self.procedure_block.resume(self.step)
+
+# The state of a running design, in a form that doesn't depend on any 
+# particular EvalContext (see EvalContext.snapshot()). The signals are 
+# identified by slot and the procedure blocks by their position in 
+# EvalContext.blocks, so a snapshot can be restored into any context that 
+# was built the same way from the same sources.
+class Snapshot:
+
+    def __init__(self):
+        self.codes = array("q")
+        # Pairs of slot and code
+        self.non_blocking_queue = array("q")
+        self.triggered_queue = array("q")
+        # The slots of the nets that are waiting to be recomputed
+        self.dirty = array("q")
+        self.suspended = array("q")
+        # (time, sequence, block, statement) for each delay in progress
+        self.timed_queue: list[tuple[int, int, int, int]] = []
+        self.time = 0
+        self.timed_sequence = 0
+        self.finished = False
+        self.xz_count = 0
+
+class EvalContext:
+
+    # When compiled is False the scheduler walks the expression trees 
+    # directly, which is useful for debugging. When optimize is True the 
+    # netlist is simplified before it is compiled (see optimize()). When
+    # two_state is True the nets are evaluated without the X/Z handling 
+    # whenever there are no X/Z values around (compiled only).
+    def __init__(self, compiled: bool = True, optimize: bool = False, two_state: bool = False):
+        self.compiled = compiled
+        self.optimize_netlist = optimize
+        self.two_state = two_state and compiled
+        # Number of signals read by nets that are currently X or Z. The 
+        # two-state evaluators are used when this is zero. This never gets
+        # to zero when two_state is False.
+        self.xz_count = 1
+        # Maximum number of delta cycles (and rounds of a combinational loop,
+        # and rounds of non-blocking updates) before giving up on the design
+        # settling down (see report_oscillation()).
+        self.delta_limit = DEFAULT_DELTA_LIMIT
+        # The initial blocks, which run once at the start
+        self.initial_blocks: list[ProcedureBlock] = []
+        # The simulation time, and the timed events (the resumption of 
+        # blocks that are waiting out a delay) as a heap of (time, sequence, 
+        # callable). The sequence keeps events at the same time in order.
+        self.time = 0
+        self.timed_queue: list[tuple] = []
+        self.timed_sequence = 0
+        # Set by $finish
+        self.finished = False
+        self.optimizer_stats = OptimizerStats()
         self.value_state: ValueState = ValueState()
         self.func_def_reg = FunctionDefinitionRegistry()
         self.signal_reg = SignalRegistry(self.value_state)
         self.non_blocking_queue: list[UpdateEvent] = []
         self.triggered_queue: list[ProcedureBlock] = []
+        # Worklist of nets that need to be recomputed, bucketed by the 
+        # level of the net. A net is on this list if and only if its dirty 
+        # flag is set. The heap holds the levels that have pending work.
+        self.level_queues: list[list[SignalInformation]] = []
+        self.dirty_levels: list[int] = []
+        self.stats = SchedulerStats()
+        # Number of function calls replaced by inline_functions()
+        self.inlined_calls = 0
+        # The distinct expressions of the design (see share_expressions())
+        self.expression_table = ExpressionTable()
+        # The expressions that are evaluated once per delta cycle and the
+        # cached result of each one. The delta cycle that a result was 
+        # computed in is kept alongside it.
+        self.shared_slots: dict[Expression, int] = {}
+        self.shared_codes = array("q")
+        self.shared_cycles = array("q")
+        self.cycle = array("q", [ 0 ])
+        # The names (or patterns, see SignalNameTree.find()) of the signals 
+        # that the client reads. When provided, the nets that can't affect
+        # these signals are only evaluated on demand (see limit_to_cone()).
+        self.observed: list[str] = None
+        # Number of nets that limit_to_cone() made lazy
+        self.lazy_count = 0
+        # When eliminate_dead is True the logic that has no effect on the 
+        # kept (or observed) signals is removed (see eliminate_dead_logic()).
+        # The names of the removed signals are recorded.
+        self.eliminate_dead = False
+        self.keep: list[str] = []
+        self.removed_signals: list[str] = []
+        # Set while profiling (see start_profile())
+        self.profiler: Profiler = None
+        # All of the procedure blocks, in a fixed order (see Snapshot). 
+        # Filled in by compile().
+        self.blocks: list[ProcedureBlock] = []
+        # The number of instances of each module (see 
+        # ModuleDefinition.elaborate()) and the compiled form of each 
+        # template expression that the instances share (see 
+        # InstanceExpression)
+        self.instance_counts: dict[str, int] = None
+        self.template_code: dict[TemplateAssignment, object] = {}
+        # The engine whose state is currently in the context. A context can
+        # be shared by several engines (see Engine.fork()).
+        self.owner: Engine = None
     
     def is_valid_signal(self, name) -> bool:
         return self.signal_reg.is_valid_signal(name)
@@ -1082,121 +2683,1219 @@ class EvalContext:
     def is_net(self, name) -> bool:
         return self.signal_reg.is_net(name)
 
+    # Prepares the elaborated design for evaluation. Each net gets a single
+    # callable that combines all of its drivers and each triggered procedure
+    # block gets a callable that runs its statements.
+    def compile(self):
+        self.inline_functions()
+        if self.optimize_netlist:
+            self.optimize()
+        if self.eliminate_dead:
+            self.eliminate_dead_logic()
+        for signal_info in self.signal_reg.reg.values():
+            signal_info.fanout = self.signal_reg.get_fanout(signal_info.name)
+        self.levelize()
+        if self.observed is not None:
+            self.limit_to_cone()
+        if self.compiled:
+            self.share_expressions()
+        for signal_info in self.signal_reg.reg.values():
+            if signal_info.data_type == DataType.NET and signal_info.has_any_drivers():
+                signal_info.evaluator = self.compile_net(signal_info)
+                if self.two_state:
+                    signal_info.two_state_evaluator = self.compile_net_two_state(signal_info)
+            for pb in signal_info.triggered_procedure_blocks:
+                if pb.compiled is None:
+                    self.compile_block(pb)
+        for pb in self.initial_blocks:
+            self.compile_block(pb)
+        if self.two_state:
+            self.count_xz()
+        blocks: dict[ProcedureBlock, bool] = dict.fromkeys(self.initial_blocks, True)
+        for signal_info in self.signal_reg.reg.values():
+            for pb in signal_info.triggered_procedure_blocks:
+                blocks[pb] = True
+        self.blocks = list(blocks)
+
+    # A pass over the elaborated design that replaces calls to small 
+    # functions with the bodies of the functions. An inlined body may read 
+    # signals that the call didn't, so the fanout index is rebuilt.
+    def inline_functions(self):
+        if len(self.func_def_reg.reg) == 0:
+            return
+        # A block can be triggered by more than one signal
+        blocks: dict[ProcedureBlock, bool] = dict.fromkeys(self.initial_blocks, True)
+        for signal_info in self.signal_reg.reg.values():
+            signal_info.assignments = [exp.inline_functions(self) for exp in signal_info.assignments]
+            for pb in signal_info.triggered_procedure_blocks:
+                blocks[pb] = True
+        for pb in blocks:
+            pb.statements = [statement.inline_functions(self) for statement in pb.statements]
+        self.signal_reg.rebuild_fanout()
+
+    # A pass over the elaborated netlist that:
+    #
+    # * Folds constant expressions and propagates the values of constant 
+    #   nets into their readers.
+    # * Collapses nets that just copy another signal (i.e. port wiring and 
+    #   "wire a = b") into the slot of that signal. The readers move over to
+    #   the other signal and the name of the net stays valid as a view of 
+    #   the shared slot. Nets that trigger blocks are left alone since the 
+    #   copy changes (from X) when the design starts even if the original 
+    #   doesn't, and the blocks need to see that.
+    # * Removes double negations.
+    #
+    # This changes what happens when a driven net is forced with a 
+    # set_value() (the copy and the original are now the same thing, and 
+    # readers of a constant net no longer look at it) so it is optional.
+    def optimize(self):
+        stats = self.optimizer_stats
+        reg = self.signal_reg.reg
+        # What each optimized net is replaced by: a ConstantExpression or a 
+        # VariableExpression that refers to the signal being copied.
+        mapping: dict[str, Expression] = {}
+
+        def resolve(exp: Expression) -> Expression:
+            # Replacements can refer to signals that were replaced later on
+            while True:
+                found = False
+                for name in exp.get_references():
+                    if name in mapping:
+                        found = True
+                if not found:
+                    break
+                exp = exp.substitute(mapping)
+            return exp.simplify(stats)
+
+        work = [signal_info for signal_info in reg.values() 
+                if signal_info.data_type == DataType.NET and signal_info.has_any_drivers()]
+        queued = set(work)
+        while len(work) > 0:
+            signal_info = work.pop()
+            queued.remove(signal_info)
+            signal_info.assignments = [resolve(exp) for exp in signal_info.assignments]
+            # The rewritten expressions may read other signals, which need to
+            # know to come back here if they get replaced
+            for exp in signal_info.assignments:
+                self.signal_reg.add_reader(signal_info, exp)
+            if signal_info.name in mapping or len(signal_info.assignments) != 1 or \
+               signal_info.net_type != NetType.WIRE:
+                continue
+            exp = signal_info.assignments[0]
+            if type(exp) is ConstantExpression:
+                mapping[signal_info.name] = exp
+            elif type(exp) is VariableExpression and exp.name != signal_info.name and \
+                 exp.name in reg and len(signal_info.triggered_procedure_blocks) == 0:
+                mapping[signal_info.name] = exp
+            else:
+                continue
+            for reader in self.signal_reg.get_fanout(signal_info.name):
+                if not reader in queued:
+                    queued.add(reader)
+                    work.append(reader)
+
+        # Constant nets keep their (constant) driver so that they still get 
+        # their value when the design starts. Copies give up their drivers 
+        # and share the slot of the signal they copy.
+        for name, exp in mapping.items():
+            signal_info = reg[name]
+            exp = resolve(exp)
+            if type(exp) is ConstantExpression:
+                signal_info.assignments = [ exp ]
+                stats.constant_nets = stats.constant_nets + 1
+            else:
+                target = reg[exp.name]
+                signal_info.assignments = []
+                signal_info.alias = target
+                signal_info.slot = target.slot
+                self.value_state.slots[name] = target.slot
+                stats.aliases = stats.aliases + 1
+
+        # The procedure blocks can read the replacements too
+        blocks: dict[ProcedureBlock, bool] = dict.fromkeys(self.initial_blocks, True)
+        for signal_info in reg.values():
+            for pb in signal_info.triggered_procedure_blocks:
+                blocks[pb] = True
+        for pb in blocks:
+            statements = []
+            for statement in pb.statements:
+                if type(statement) is ProcedureAssignment:
+                    statement = ProcedureAssignment(statement.lhs, resolve(statement.rhs), statement.blocking)
+                statements.append(statement)
+            pb.statements = statements
+
+        self.signal_reg.rebuild_fanout()
+
+    # Ranks the continuous assignments so that each net is evaluated after 
+    # all of the nets it reads. Nets that are part of a combinational loop 
+    # (a strongly connected component) share a single rank and are iterated
+    # until they settle.
+    def levelize(self):
+
+        nets = [signal_info for signal_info in self.signal_reg.reg.values() 
+                if signal_info.data_type == DataType.NET]
+        components = find_strongly_connected_components(nets, lambda n: n.fanout)
+
+        # Tarjan produces the components sinks-first, so walk them backwards.
+        # By the time a component is reached all of its predecessors have
+        # pushed its rank up as far as it needs to go.
+        max_level = 0
+        for component in reversed(components):
+            members = set(component)
+            level = max([member.level for member in component])
+            cyclic = len(component) > 1 or component[0] in component[0].fanout
+            for member in component:
+                member.level = level
+                member.cyclic = cyclic
+            # Push the readers of this component to a higher rank
+            for member in component:
+                for reader in member.fanout:
+                    if not reader in members:
+                        reader.level = max(reader.level, level + 1)
+            max_level = max(max_level, level)
+
+        self.level_queues = [[] for _ in range(0, max_level + 1)]
+
+    # Looks up a list of names and/or patterns (see SignalNameTree.find()).
+    # The signals that hold the values are returned (see optimize()).
+    def find_signals(self, names: list[str]) -> list[SignalInformation]:
+        result: list[SignalInformation] = []
+        for name in names:
+            if self.is_valid_signal(name):
+                result.append(self.get_signal_info(name))
+            else:
+                signal_infos = self.signal_reg.name_tree.find(name)
+                if len(signal_infos) == 0:
+                    raise Exception("No signals match " + name)
+                result.extend([signal_info.alias or signal_info for signal_info in signal_infos])
+        return result
+
+    # Removes the logic that can't affect the kept (or observed) signals. 
+    # Starting from those, everything they depend on is marked: the signals
+    # that a net reads, the blocks that assign a signal, and the signals 
+    # that a block reads or is triggered by. A block with a $finish is 
+    # always kept. The driven nets and the assigned variables that don't 
+    # get marked are removed, along with the blocks that don't get marked.
+    #
+    # Signals that aren't driven by anything are left alone since the 
+    # client may be setting them. A variable that a kept block assigns is 
+    # left alone too, even if nothing reads it.
+    #
+    # A removed signal can't be read through the Engine any more, so this 
+    # is optional.
+    def eliminate_dead_logic(self):
+        # Without anything to keep, everything would go
+        if len(self.keep) == 0 and not self.observed:
+            raise Exception("Dead logic elimination needs signals to keep (or observe)")
+        stats = self.optimizer_stats
+        reg = self.signal_reg.reg
+
+        # The signals that trigger each block, and the blocks that assign 
+        # each signal
+        triggers: dict[ProcedureBlock, list[SignalInformation]] = {}
+        for pb in self.initial_blocks:
+            triggers[pb] = []
+        for signal_info in reg.values():
+            for pb in signal_info.triggered_procedure_blocks:
+                if not pb in triggers:
+                    triggers[pb] = []
+                triggers[pb].append(signal_info)
+        writers: dict[SignalInformation, list[ProcedureBlock]] = {}
+        for pb in triggers:
+            for statement in pb.statements:
+                if type(statement) is ProcedureAssignment:
+                    signal_info = self.get_signal_info(statement.lhs)
+                    if not signal_info in writers:
+                        writers[signal_info] = []
+                    writers[signal_info].append(pb)
+
+        # Mark
+        live: dict[object, bool] = {}
+        stack: list = self.find_signals(self.keep)
+        if self.observed is not None:
+            stack.extend(self.find_signals(self.observed))
+        for pb in triggers:
+            for statement in pb.statements:
+                if type(statement) is ProcedureFinish:
+                    stack.append(pb)
+        while len(stack) > 0:
+            item = stack.pop()
+            if item in live:
+                continue
+            live[item] = True
+            if type(item) is ProcedureBlock:
+                stack.extend(triggers[item])
+                names = item.get_references()
+            else:
+                stack.extend(writers.get(item, []))
+                names = []
+                for exp in item.assignments:
+                    names.extend(exp.get_references())
+            for name in names:
+                if name in reg:
+                    stack.append(self.get_signal_info(name))
+
+        # Sweep
+        for pb in triggers:
+            if not pb in live:
+                stats.dead_blocks = stats.dead_blocks + 1
+        for signal_info in reg.values():
+            signal_info.triggered_procedure_blocks = [pb for pb in signal_info.triggered_procedure_blocks
+                                                      if pb in live]
+        self.initial_blocks = [pb for pb in self.initial_blocks if pb in live]
+        for name, signal_info in list(reg.items()):
+            target = signal_info.alias or signal_info
+            if target in live:
+                continue
+            if target.data_type == DataType.NET:
+                if not target.has_any_drivers():
+                    continue
+                stats.dead_nets = stats.dead_nets + 1
+            else:
+                if not target in writers:
+                    continue
+                stats.dead_variables = stats.dead_variables + 1
+            self.signal_reg.remove(name)
+            self.removed_signals.append(name)
+        self.signal_reg.rebuild_fanout()
+
+    # Works out the cone of influence of the observed signals (everything 
+    # that they depend on) and makes the nets outside of it lazy. A lazy 
+    # net is never scheduled. A change to one of its inputs just marks it 
+    # stale, and it is recomputed when the client reads it (see refresh()).
+    #
+    # The procedure blocks keep state, so they can't be put off. They always
+    # run and everything they read is part of the cone. The combinational 
+    # loops are kept in the cone too since they need to be iterated.
+    def limit_to_cone(self):
+        roots = self.find_signals(self.observed)
+        blocks: dict[ProcedureBlock, bool] = dict.fromkeys(self.initial_blocks, True)
+        nets = []
+        for signal_info in self.signal_reg.reg.values():
+            if len(signal_info.triggered_procedure_blocks) > 0:
+                roots.append(signal_info)
+            for pb in signal_info.triggered_procedure_blocks:
+                blocks[pb] = True
+            if signal_info.data_type == DataType.NET and signal_info.alias is None:
+                signal_info.fanin = []
+                for exp in signal_info.assignments:
+                    for name in exp.get_references():
+                        fanin_info = self.get_signal_info(name)
+                        if not fanin_info in signal_info.fanin:
+                            signal_info.fanin.append(fanin_info)
+                nets.append(signal_info)
+                if signal_info.cyclic:
+                    roots.append(signal_info)
+        for pb in blocks:
+            for name in pb.get_references():
+                roots.append(self.get_signal_info(name))
+        # Walk back from the roots
+        cone: dict[SignalInformation, bool] = {}
+        stack = roots
+        while len(stack) > 0:
+            signal_info = stack.pop()
+            if not signal_info in cone:
+                cone[signal_info] = True
+                stack.extend(signal_info.fanin)
+        self.lazy_count = 0
+        for signal_info in nets:
+            signal_info.lazy = signal_info.has_any_drivers() and not signal_info in cone
+            if signal_info.lazy:
+                self.lazy_count = self.lazy_count + 1
+
+    # Brings a lazy net (and the stale nets that it reads) up to date. The 
+    # stale nets are evaluated in rank order, which is safe because lazy 
+    # nets are never part of a combinational loop. The delta cycle count 
+    # is bumped so that no shared expression results are reused from 
+    # before.
+    def refresh(self, signal_info: SignalInformation):
+        stale: dict[SignalInformation, bool] = {}
+        stack = [ signal_info ]
+        while len(stack) > 0:
+            s = stack.pop()
+            if s.lazy and s.dirty and not s in stale:
+                stale[s] = True
+                stack.extend(s.fanin)
+        self.cycle[0] = self.cycle[0] + 1
+        codes = self.value_state.codes
+        for s in sorted(stale, key=lambda s: s.level):
+            s.dirty = False
+            code = s.evaluator()
+            self.stats.lazy_evaluations = self.stats.lazy_evaluations + 1
+            if codes[s.slot] != code:
+                codes[s.slot] = code
+                for watch in s.watches:
+                    watch.notify(s)
+
+    # Common subexpression elimination. The expressions of the nets are 
+    # merged into a DAG (see ExpressionTable) and the parts that are read 
+    # more than once are evaluated once per delta cycle, with the result
+    # cached for the other readers. 
+    #
+    # This relies on the nets being evaluated in rank order: everything a 
+    # shared expression reads has settled by the time the first reader is 
+    # evaluated and can't change again in the same delta cycle. That isn't
+    # true for the nets in a combinational loop (which are evaluated until
+    # they settle) or for the procedure blocks (which run before the nets
+    # are updated), so their expressions are left alone.
+    def share_expressions(self):
+        table = self.expression_table
+        # Number of references to each expression of the DAG
+        uses: dict[Expression, int] = {}
+        def count(exp: Expression):
+            uses[exp] = uses.get(exp, 0) + 1
+            # The operands of a shared expression are only counted once
+            if uses[exp] == 1:
+                if type(exp) is BinaryExpression:
+                    count(exp.lhs)
+                    count(exp.rhs)
+                elif type(exp) is UnaryExpression:
+                    count(exp.lhs)
+        for signal_info in self.signal_reg.reg.values():
+            if signal_info.data_type == DataType.NET and not signal_info.cyclic:
+                signal_info.assignments = [exp.intern(table) for exp in signal_info.assignments]
+                for exp in signal_info.assignments:
+                    count(exp)
+        for exp, n in uses.items():
+            if n > 1 and (type(exp) is BinaryExpression or type(exp) is UnaryExpression):
+                self.shared_slots[exp] = len(self.shared_codes)
+                self.shared_codes.append(CODE_X)
+                self.shared_cycles.append(-1)
+        table.shared = len(self.shared_slots)
+
+    # Wraps the compiled form of an expression so that a shared expression
+    # (see share_expressions()) is only evaluated once per delta cycle
+    def share(self, exp: Expression, f):
+        if not exp in self.shared_slots:
+            return f
+        slot = self.shared_slots[exp]
+        codes = self.shared_codes
+        cycles = self.shared_cycles
+        cycle = self.cycle
+        def g():
+            if cycles[slot] == cycle[0]:
+                self.stats.shared_hits = self.stats.shared_hits + 1
+                return codes[slot]
+            code = f()
+            codes[slot] = code
+            cycles[slot] = cycle[0]
+            return code
+        return g
+
+    def compile_net(self, signal_info: SignalInformation):
+        net_type = signal_info.net_type
+        if self.compiled:
+            drivers = [assignment.compile(self) for assignment in signal_info.assignments]
+            # The common case of a plain wire with one driver needs no resolution
+            if len(drivers) == 1 and net_type == NetType.WIRE:
+                return drivers[0]
+            def f():
+                return wire_code_eval([driver() for driver in drivers], net_type)
+            return f
+        else:
+            assignments = signal_info.assignments
+            def f():
+                return encode_value(wire_logic_eval(
+                    [assignment.evaluate(self) for assignment in assignments], net_type))
+            return f
+
+    # Returns None if any of the drivers need the four-state evaluation
+    # (i.e. they use an X/Z constant or call a function)
+    def compile_net_two_state(self, signal_info: SignalInformation):
+        net_type = signal_info.net_type
+        drivers = [assignment.compile_two_state(self) for assignment in signal_info.assignments]
+        if None in drivers:
+            return None
+        if len(drivers) == 1 and net_type == NetType.WIRE:
+            return drivers[0]
+        # Drivers that disagree still resolve to X
+        def f():
+            return wire_code_eval([driver() for driver in drivers], net_type)
+        return f
+
+    # Works out which signals can hold up the two-state evaluation and how 
+    # many of them are X/Z right now. Only the signals read by nets matter 
+    # (the procedure blocks always use the four-state evaluation), the 
+    # nets that the optimizer collapsed don't have a slot of their own and
+    # the lazy nets are only read by other lazy nets.
+    def count_xz(self):
+        codes = self.value_state.codes
+        self.xz_count = 0
+        for signal_info in self.signal_reg.reg.values():
+            signal_info.xz_tracked = len(signal_info.fanout) > 0 and signal_info.alias is None and \
+                not signal_info.lazy
+            if signal_info.xz_tracked and is_xz_code(codes[signal_info.slot]):
+                self.xz_count = self.xz_count + 1
+
+    def compile_block(self, pb: ProcedureBlock):
+        if self.compiled:
+            pb.compiled = pb.compile(self)
+        else:
+            pb.compiled = self.make_interpreted_block(pb)
+
+    def make_interpreted_block(self, pb: ProcedureBlock):
+        steps = []
+        for statement in pb.statements:
+            if type(statement) is ProcedureDelay:
+                steps.append(None)
+            else:
+                steps.append(lambda statement = statement: statement.execute(self))
+        return pb.make_process(self, steps)
+
     def start(self):
+        self.compile()
         # Evaluate everything once to make sure all initial conditions are
-        # reflected properly.
+        # reflected properly. Nets are created dirty, so they all get 
+        # scheduled here.
+        for signal_info in self.signal_reg.reg.values():
+            if signal_info.data_type == DataType.NET and signal_info.dirty and not signal_info.lazy:
+                self.schedule(signal_info)
+        # The initial blocks run in the first delta cycle
+        for pb in self.initial_blocks:
+            pb.queued = True
+            self.triggered_queue.append(pb)
         self.update_dirty_signals()
         self.process_non_blocking_queue()
 
+    # Captures the state of the design (see Snapshot)
+    def snapshot(self) -> Snapshot:
+        snapshot = Snapshot()
+        snapshot.codes = array("q", self.value_state.codes)
+        for event in self.non_blocking_queue:
+            snapshot.non_blocking_queue.append(event.signal_info.slot)
+            snapshot.non_blocking_queue.append(event.code)
+        block_indexes = { pb: i for i, pb in enumerate(self.blocks) }
+        for pb in self.triggered_queue:
+            snapshot.triggered_queue.append(block_indexes[pb])
+        for signal_info in self.signal_reg.reg.values():
+            if signal_info.dirty and signal_info.alias is None:
+                snapshot.dirty.append(signal_info.slot)
+        for pb in self.blocks:
+            if pb.suspended:
+                snapshot.suspended.append(block_indexes[pb])
+        for (time, sequence, action) in self.timed_queue:
+            snapshot.timed_queue.append((time, sequence, block_indexes[action.procedure_block], action.step))
+        snapshot.time = self.time
+        snapshot.timed_sequence = self.timed_sequence
+        snapshot.finished = self.finished
+        snapshot.xz_count = self.xz_count
+        return snapshot
+
+    # Puts the design back into the state of the snapshot. The values are 
+    # copied into the existing array since the compiled closures hold on to
+    # it. The watches are told about the signals that change.
+    def restore(self, snapshot: Snapshot):
+        codes = self.value_state.codes
+        if len(snapshot.codes) != len(codes):
+            raise Exception("Snapshot is from a different design")
+        reg = self.signal_reg.reg
+        slot_infos: dict[int, SignalInformation] = {}
+        watched: dict[SignalInformation, int] = {}
+        for signal_info in reg.values():
+            if signal_info.alias is None:
+                slot_infos[signal_info.slot] = signal_info
+                signal_info.dirty = False
+                if len(signal_info.watches) > 0:
+                    watched[signal_info] = codes[signal_info.slot]
+        codes[:] = snapshot.codes
+
+        self.level_queues = [[] for _ in self.level_queues]
+        self.dirty_levels = []
+        for slot in snapshot.dirty:
+            signal_info = slot_infos[slot]
+            signal_info.dirty = True
+            if not signal_info.lazy:
+                self.schedule(signal_info)
+        self.non_blocking_queue = []
+        for i in range(0, len(snapshot.non_blocking_queue), 2):
+            self.non_blocking_queue.append(UpdateEvent(slot_infos[snapshot.non_blocking_queue[i]], 
+                                                       snapshot.non_blocking_queue[i + 1]))
+        for pb in self.blocks:
+            pb.queued = False
+            pb.suspended = False
+        self.triggered_queue = [self.blocks[i] for i in snapshot.triggered_queue]
+        for pb in self.triggered_queue:
+            pb.queued = True
+        for i in snapshot.suspended:
+            self.blocks[i].suspended = True
+        # The order of the list is kept, so it's still a heap
+        self.timed_queue = [(time, sequence, ResumeEvent(self.blocks[block], step)) 
+                            for (time, sequence, block, step) in snapshot.timed_queue]
+        self.time = snapshot.time
+        self.timed_sequence = snapshot.timed_sequence
+        self.finished = snapshot.finished
+        self.xz_count = snapshot.xz_count
+        # Invalidates the shared expression results
+        self.cycle[0] = self.cycle[0] + 1
+
+        for signal_info, code in watched.items():
+            if codes[signal_info.slot] != code:
+                for watch in signal_info.watches:
+                    watch.notify(signal_info)
+
+    # Makes sure that the state of the owner is the one in the context (see
+    # Engine.fork()). Nothing is done for objects that aren't tied to an 
+    # engine.
+    def claim(self, owner: Engine):
+        if owner is not None and self.owner is not owner:
+            owner.activate()
+
+    # Starts counting the activity of each net and block (see Profiler). 
+    # Must be called after start().
+    def start_profile(self) -> Profiler:
+        if self.profiler is not None:
+            raise Exception("Already profiling")
+        self.profiler = Profiler(self)
+        self.profiler.attach()
+        return self.profiler
+
+    def stop_profile(self) -> Profiler:
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.detach()
+            self.profiler = None
+        return profiler
+
+    # Arranges for the callable to be called when the time is reached (see
+    # advance_time())
+    def schedule_at(self, time: int, action):
+        heapq.heappush(self.timed_queue, (time, self.timed_sequence, action))
+        self.timed_sequence = self.timed_sequence + 1
+
+    # Moves the simulation time forward, running the timed events along the
+    # way. The time jumps straight from one event to the next, so idle 
+    # stretches cost nothing. The design is settled after each time step.
+    # Nothing more happens after a $finish.
+    def advance_time(self, time: int):
+        timed_queue = self.timed_queue
+        while len(timed_queue) > 0 and timed_queue[0][0] <= time and not self.finished:
+            self.time = timed_queue[0][0]
+            while len(timed_queue) > 0 and timed_queue[0][0] == self.time and not self.finished:
+                _, _, action = heapq.heappop(timed_queue)
+                action()
+            self.update_dirty_signals()
+            self.process_non_blocking_queue()
+        if not self.finished:
+            self.time = max(self.time, time)
+
+    def finish(self):
+        self.finished = True
+
     def get_value(self, name: str):
         if not self.value_state.is_value_available(name):
             raise Exception("No value available for " + name)
+        if self.is_valid_signal(name):
+            signal_info = self.get_signal_info(name)
+            if signal_info.lazy and signal_info.dirty:
+                self.refresh(signal_info)
         return self.value_state.get_value(name)
     
     def set_value_blocking(self, name: str, value: Value):
-        self.set_value_internal(name, value)
+        self.set_code_blocking(name, encode_value(value))
+
+    def set_code_blocking(self, name: str, code: int):
+        self.set_signal_code_blocking(self.get_signal_info(name), code)
+
+    def set_signal_code_blocking(self, signal_info: SignalInformation, code: int):
+        self.set_signal_code(signal_info, code)
         self.update_dirty_signals()
 
     def set_value_non_blocking(self, name: str, value: Value):
-        self.non_blocking_queue.append(UpdateEvent(name, value))
+        self.set_code_non_blocking(name, encode_value(value))
+
+    def set_code_non_blocking(self, name: str, code: int):
+        self.set_signal_code_non_blocking(self.get_signal_info(name), code)
+
+    def set_signal_code_non_blocking(self, signal_info: SignalInformation, code: int):
+        self.non_blocking_queue.append(UpdateEvent(signal_info, code))
 
     def process_non_blocking_queue(self):
+        rounds = 0
         while len(self.non_blocking_queue) > 0:
-            non_blocking_queue = self.non_blocking_queue.copy()
-            self.non_blocking_queue.clear()
-            for event in non_blocking_queue:
-                self.set_value_internal(event.name, event.value)
-            self.update_dirty_signals()
+            rounds = rounds + 1
+            if rounds > self.delta_limit:
+                self.report_oscillation(self.run_non_blocking_round)
+            self.run_non_blocking_round()
+
+    def run_non_blocking_round(self):
+        non_blocking_queue = self.non_blocking_queue.copy()
+        self.non_blocking_queue.clear()
+        for event in non_blocking_queue:
+            self.set_signal_code(event.signal_info, event.code)
+        self.update_dirty_signals()
 
-    def set_value_internal(self, name: str, value: Value):
+    # NOTE: For a net that the optimizer has collapsed into another signal,
+    # this returns the other signal (which is where the value lives).
+    def get_signal_info(self, name: str) -> SignalInformation:
+        if not self.is_valid_signal(name):
+            raise Exception("Signal not defined " + name)
+        signal_info = self.signal_reg.reg[name]
+        if signal_info.alias is not None:
+            return signal_info.alias
+        return signal_info
 
+    # Same as get_signal_info(), but always returns the signal by that name
+    def get_declared_signal_info(self, name: str) -> SignalInformation:
         if not self.is_valid_signal(name):
             raise Exception("Signal not defined " + name)
+        return self.signal_reg.reg[name]
+
+    def set_value_internal(self, name: str, value: Value):
+        self.set_signal_code(self.get_signal_info(name), encode_value(value))
+
+    def set_code_internal(self, name: str, code: int):
+        self.set_signal_code(self.get_signal_info(name), code)
+
+    def set_signal_code(self, signal_info: SignalInformation, code: int):
 
         # Save and check to see if this value has changed since the last time
-        changed = self.value_state.set_value(name, value)
-        if changed:
-            #print("Setting", name, "<-", value)
-            # Figure out which nets need to be recomputed now as a result
-            for net_name, net_info in self.signal_reg.reg.items():
-                # Each signal can have multiple assignments contributing to it
-                for assignment in net_info.assignments:
-                    if name in assignment.get_references():
-                        net_info.dirty = True
+        codes = self.value_state.codes
+        slot = signal_info.slot
+        if codes[slot] != code:
+            if signal_info.xz_tracked:
+                if codes[slot] == CODE_X or codes[slot] == CODE_Z:
+                    self.xz_count = self.xz_count - 1
+                if code == CODE_X or code == CODE_Z:
+                    self.xz_count = self.xz_count + 1
+            codes[slot] = code
+            # Figure out which nets need to be recomputed now as a result. The 
+            # fanout index was built during elaboration.
+            for net_info in signal_info.fanout:
+                self.mark_dirty(net_info)
 
             # Figure out what blocks need to be triggered now as a result of 
             # this change. There is no need to queue the same procedure block
             # more than once.
-            for pb in self.signal_reg.reg[name].triggered_procedure_blocks:
-                if not pb in self.triggered_queue:
+            for pb in signal_info.triggered_procedure_blocks:
+                if not pb.queued:
+                    pb.queued = True
                     self.triggered_queue.append(pb)
 
+            for watch in signal_info.watches:
+                watch.notify(signal_info)
+
+    # Schedules a net for recomputation
+    def mark_dirty(self, signal_info: SignalInformation):
+        if not signal_info.dirty:
+            signal_info.dirty = True
+            if signal_info.lazy:
+                self.mark_stale(signal_info)
+            else:
+                self.schedule(signal_info)
+
+    # A lazy net isn't recomputed, so the nets that read it are marked 
+    # dirty right away. They are all lazy too.
+    def mark_stale(self, signal_info: SignalInformation):
+        stack = [ signal_info ]
+        while len(stack) > 0:
+            for net_info in stack.pop().fanout:
+                if not net_info.dirty:
+                    net_info.dirty = True
+                    stack.append(net_info)
+
+    def schedule(self, signal_info: SignalInformation):
+        queue = self.level_queues[signal_info.level]
+        if len(queue) == 0:
+            heapq.heappush(self.dirty_levels, signal_info.level)
+        queue.append(signal_info)
+
     def update_dirty_signals(self):
 
         # We keep looping here because each set may cause other signals to 
-        # require a recomputation.        
-        while True:
-
-            # Fire off any triggers that are pending
-            triggered_queue = self.triggered_queue.copy()
-            self.triggered_queue.clear()
-            for triggered in triggered_queue:
-                triggered.execute(self)
-
-            # Now deal with propagation of values
-            dirty_count = 0
-
-            for net_name, signal_info in self.signal_reg.reg.items():
-                if signal_info.data_type == DataType.NET and signal_info.dirty:
-                    dirty_count = dirty_count + 1
-                    if signal_info.has_any_drivers():
-                        # The net may have more than one driver, so evaluate them all
-                        driving_values = []
-                        for assignment in signal_info.assignments:
-                            driving_value = assignment.evaluate(self)
-                            driving_values.append(driving_value)
-                        # Combine the values of the drivers to a single value
-                        new_value = wire_logic_eval(driving_values, signal_info.net_type)
-                        self.set_value_internal(net_name, new_value)
-
-                    # Clear dirty flag
-                    signal_info.dirty = False
-
-            if dirty_count == 0:
-                return
+        # require a recomputation. Each pass is a delta cycle and only 
+        # touches the blocks and nets that were scheduled.
+        delta_cycles = 0
+        while len(self.triggered_queue) > 0 or len(self.dirty_levels) > 0:
+            delta_cycles = delta_cycles + 1
+            if delta_cycles > self.delta_limit:
+                self.report_oscillation(self.run_delta_cycle)
+            self.run_delta_cycle()
+
+    def run_delta_cycle(self):
+
+        self.stats.delta_cycles = self.stats.delta_cycles + 1
+        # Invalidates the shared expression results
+        self.cycle[0] = self.cycle[0] + 1
+
+        # Fire off any triggers that are pending
+        triggered_queue = self.triggered_queue
+        self.triggered_queue = []
+        for triggered in triggered_queue:
+            triggered.queued = False
+            triggered.compiled()
+            self.stats.procedure_executions = self.stats.procedure_executions + 1
+
+        # Now deal with propagation of values in rank order. A net 
+        # only gets evaluated after everything it reads has settled, 
+        # so the acyclic parts of the design are evaluated once.
+        while len(self.dirty_levels) > 0:
+            level = heapq.heappop(self.dirty_levels)
+            # The members of a combinational loop share a level, so 
+            # this keeps going until the loop settles.
+            rounds = 0
+            while len(self.level_queues[level]) > 0:
+                rounds = rounds + 1
+                if rounds > self.delta_limit:
+                    self.report_oscillation(lambda: self.evaluate_level(level))
+                self.evaluate_level(level)
+
+    # Evaluates the nets that are scheduled at a level. Anything that gets 
+    # scheduled at the same level in the meantime (i.e. in a combinational 
+    # loop) is left for the next round.
+    def evaluate_level(self, level: int):
+        queue = self.level_queues[level]
+        self.level_queues[level] = []
+        for signal_info in reversed(queue):
+            # Clear dirty flag first so that the net can be re-scheduled
+            # by the changes that result from its own evaluation.
+            signal_info.dirty = False
+            if signal_info.has_any_drivers():
+                # The net may have more than one driver. The evaluator 
+                # combines the values of the drivers to a single value.
+                # An X/Z that shows up switches back to the four-state
+                # evaluators right away, and so does an integer used as a 
+                # logic value.
+                if self.xz_count == 0 and signal_info.two_state_evaluator is not None:
+                    try:
+                        new_code = signal_info.two_state_evaluator()
+                        self.stats.two_state_evaluations = self.stats.two_state_evaluations + 1
+                    except TwoStateFallback:
+                        new_code = signal_info.evaluator()
+                else:
+                    new_code = signal_info.evaluator()
+                self.stats.net_evaluations = self.stats.net_evaluations + 1
+                self.set_signal_code(signal_info, new_code)
+
+    # Called when the design hasn't settled within the delta cycle limit. 
+    # A few more rounds are run to see which signals keep changing, and 
+    # then an OscillationError is raised. The state of the design is left
+    # part way through the update.
+    def report_oscillation(self, step):
+        codes = self.value_state.codes
+        changed: dict[int, bool] = {}
+        for _ in range(0, OSCILLATION_SAMPLE_ROUNDS):
+            before = array("q", codes)
+            step()
+            for slot in range(0, len(codes)):
+                if codes[slot] != before[slot]:
+                    changed[slot] = True
+        raise self.make_oscillation_error([signal_info for signal_info in self.signal_reg.reg.values() 
+                                           if signal_info.alias is None and signal_info.slot in changed])
+
+    def make_oscillation_error(self, signal_infos: list[SignalInformation]) -> OscillationError:
+        loops = []
+        for loop in self.find_feedback_loops():
+            for signal_info in signal_infos:
+                if signal_info in loop:
+                    loops.append([member.name for member in loop])
+                    break
+        return OscillationError(self.delta_limit, [signal_info.name for signal_info in signal_infos], loops)
+
+    # Returns the groups of signals that feed back on themselves (strongly 
+    # connected components), either through nets or through the variables
+    # assigned by the procedure blocks they trigger (i.e. relay hold coils).
+    # These are the places where the design can oscillate.
+    def find_feedback_loops(self) -> list[list[SignalInformation]]:
+        reg = self.signal_reg.reg
+        def get_successors(signal_info: SignalInformation) -> list[SignalInformation]:
+            result = list(signal_info.fanout)
+            for pb in signal_info.triggered_procedure_blocks:
+                for statement in pb.statements:
+                    if type(statement) is ProcedureAssignment:
+                        result.append(reg[statement.lhs])
+            return result
+        signal_infos = [signal_info for signal_info in reg.values() if signal_info.alias is None]
+        loops = []
+        for component in find_strongly_connected_components(signal_infos, get_successors):
+            if len(component) > 1 or component[0] in get_successors(component[0]):
+                loops.append(component)
+        return loops
 
     def get_function_def(self, name:str):
         return self.func_def_reg.get_function_def(name)
 
+# Gives direct access to the value of a signal without any name lookups
+class SignalHandle:
+
+    def __init__(self, context: EvalContext, signal_info: SignalInformation, owner: Engine = None):
+        self.name = signal_info.name
+        self.signal_info = signal_info
+        self.context = context
+        self.owner = owner
+        self.codes = context.value_state.codes
+        self.slot = signal_info.slot
+        # The signal that holds the value
+        self.target = signal_info.alias or signal_info
+        self.lazy = self.target.lazy
+
+    def get_code(self) -> int:
+        if self.context.owner is not self.owner:
+            self.context.claim(self.owner)
+        if self.lazy and self.target.dirty:
+            self.context.refresh(self.target)
+        return self.codes[self.slot]
+
+    def get_value(self) -> Value:
+        return decode_value(self.get_code())
+
+    def get_int(self) -> int:
+        return self.get_value().get_int()
+
+    def get_bool(self) -> bool:
+        return self.get_value().get_bool()
+
+    def __repr__(self) -> str:
+        return self.name
+
+# Keeps track of changes to a set of signals so that a client can find out 
+# what changed without looking at everything (see Engine.watch()).
+class SignalWatch:
+
+    def __init__(self, context: EvalContext, signal_infos: list[SignalInformation], callback = None,
+                 owner: Engine = None):
+        self.context = context
+        self.owner = owner
+        self.signal_infos = signal_infos
+        self.callback = callback
+        # The signals that have changed since the last poll (a dict is used 
+        # to keep the order stable). Everything is reported on the first 
+        # poll.
+        self.pending: dict[SignalInformation, bool] = dict.fromkeys(signal_infos, True)
+        # The code of each signal as of the last time it was reported
+        self.reported: dict[SignalInformation, int] = {}
+        # The changes are seen on the signal that holds the value, which 
+        # is a different one for the nets that have been collapsed by the 
+        # optimizer.
+        self.views: dict[SignalInformation, list[SignalInformation]] = {}
+        for signal_info in signal_infos:
+            target = signal_info.alias or signal_info
+            if not target in self.views:
+                self.views[target] = []
+                target.watches.append(self)
+            self.views[target].append(signal_info)
+
+    def notify(self, signal_info: SignalInformation):
+        for view in self.views[signal_info]:
+            self.pending[view] = True
+
+    # Returns the current values of the signals that are different from 
+    # what was reported on the last poll. A signal that changed and then 
+    # changed back in the meantime is not included.
+    def poll(self) -> dict[str, Value]:
+        self.context.claim(self.owner)
+        codes = self.context.value_state.codes
+        pending = self.pending
+        self.pending = {}
+        result = {}
+        for signal_info in pending:
+            code = codes[signal_info.slot]
+            if self.reported.get(signal_info) != code:
+                self.reported[signal_info] = code
+                result[signal_info.name] = decode_value(code)
+        return result
+
+    # Calls the callback for each change since the last poll
+    def dispatch(self):
+        for name, value in self.poll().items():
+            self.callback(name, value)
+
+    def close(self):
+        self.context.claim(self.owner)
+        for target in self.views:
+            target.watches.remove(self)
+
+# Writes the changes to a set of signals to a VCD (value change dump) file
+# as they happen, so nothing is kept in memory (see Engine.dump_vcd()). 
+# Like a SignalWatch, the writer hangs off of the signals it's interested in
+# and the rest of the design doesn't pay anything for it.
+class VCDWriter:
+
+    # Number of records that are collected before they are written out
+    BUFFER_RECORDS = 8192
+
+    def __init__(self, context: EvalContext, signal_infos: list[SignalInformation], 
+                 file_name: str, top_name: str, owner: Engine = None):
+        self.context = context
+        self.owner = owner
+        self.codes = context.value_state.codes
+        self.file = open(file_name, "w", buffering=1 << 20)
+        self.buffer: list[str] = []
+        self.time = None
+        # Each signal that holds a value gets an identifier, which is shared
+        # by all of its names (see EvalContext.optimize())
+        self.ids: dict[SignalInformation, str] = {}
+        # The code of each signal as of the last record
+        self.written: dict[SignalInformation, int] = {}
+        for signal_info in signal_infos:
+            target = signal_info.alias or signal_info
+            if not target in self.ids:
+                self.ids[target] = make_vcd_id(len(self.ids))
+                target.watches.append(self)
+        self.write_header(signal_infos, top_name)
+        # The starting values
+        self.write_time()
+        self.buffer.append("$dumpvars\n")
+        for target in self.ids:
+            self.write_change(target, self.codes[target.slot])
+        self.buffer.append("$end\n")
+
+    def write_header(self, signal_infos: list[SignalInformation], top_name: str):
+        self.buffer.append("$version sim2 $end\n")
+        self.buffer.append("$timescale 1ns $end\n")
+        self.buffer.append("$scope module " + top_name + " $end\n")
+        # The signals are sorted so that each scope only needs to be 
+        # opened once
+        scope = []
+        for signal_info in sorted(signal_infos, key=lambda s: s.name.split(".")):
+            parts = signal_info.name.split(".")
+            common = 0
+            while common < len(scope) and common < len(parts) - 1 and scope[common] == parts[common]:
+                common = common + 1
+            for _ in range(common, len(scope)):
+                self.buffer.append("$upscope $end\n")
+            for part in parts[common:-1]:
+                self.buffer.append("$scope module " + part + " $end\n")
+            scope = parts[:-1]
+            target = signal_info.alias or signal_info
+            if signal_info.var_type == VariableType.INTEGER:
+                kind = "integer 32"
+            elif signal_info.var_type == VariableType.REG:
+                kind = "reg 1"
+            else:
+                kind = signal_info.net_type.name.lower() + " 1"
+            self.buffer.append("$var " + kind + " " + self.ids[target] + " " + parts[-1] + " $end\n")
+        for _ in scope:
+            self.buffer.append("$upscope $end\n")
+        self.buffer.append("$upscope $end\n")
+        self.buffer.append("$enddefinitions $end\n")
+
+    def write_time(self):
+        self.time = self.context.time
+        self.buffer.append("#" + str(self.time) + "\n")
+
+    def write_change(self, signal_info: SignalInformation, code: int):
+        self.written[signal_info] = code
+        if signal_info.var_type == VariableType.INTEGER:
+            if code == CODE_X:
+                text = "bx "
+            elif code == CODE_Z:
+                text = "bz "
+            else:
+                text = "b" + format(decode_value(code).get_int() & 0xffffffff, "b") + " "
+        elif code == CODE_X:
+            text = "x"
+        elif code == CODE_Z:
+            text = "z"
+        elif code == CODE_0:
+            text = "0"
+        else:
+            text = "1"
+        self.buffer.append(text + self.ids[signal_info] + "\n")
+        if len(self.buffer) >= VCDWriter.BUFFER_RECORDS:
+            self.flush()
+
+    def notify(self, signal_info: SignalInformation):
+        code = self.codes[signal_info.slot]
+        # A signal that goes back and forth within a delta cycle can end up
+        # where it was
+        if self.written[signal_info] == code:
+            return
+        if self.context.time != self.time:
+            self.write_time()
+        self.write_change(signal_info, code)
+
+    def flush(self):
+        self.file.write("".join(self.buffer))
+        self.buffer = []
+
+    # Stops recording. The end time is written so that the last values 
+    # show up with the right length.
+    def close(self):
+        self.context.claim(self.owner)
+        for target in self.ids:
+            target.watches.remove(self)
+        if self.context.time != self.time:
+            self.write_time()
+        self.flush()
+        self.file.close()
+
+# VCD identifiers are made from the printable characters
+def make_vcd_id(n: int) -> str:
+    result = ""
+    while True:
+        result = result + chr(33 + n % 94)
+        n = n // 94
+        if n == 0:
+            return result
+
 class UpdateEvent:
 
-    def __init__(self, name: str, value: Value):
-        self.name = name
-        self.value = value
+    def __init__(self, signal_info: SignalInformation, code: int):
+        self.signal_info = signal_info
+        self.code = code
 
     def __repr__(self) -> str:
-        return "UpdateEvent: " + self.name + " = " + str(self.value)
+        return "UpdateEvent: " + self.signal_info.name + " = " + str(decode_value(self.code))
+
+GRAMMAR_FILE_NAME = "./sim2.lark"
+
+# An on-disk store of pickled objects that are expensive to build (i.e. 
+# parsed modules and elaborated designs). Entries are found by a key that 
+# is a hash of everything that went into building them, so there's never
+# any need to invalidate anything.
+class DesignCache:
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        # The grammar, the generated parser and this file all affect the 
+        # pickled objects
+        self.base_key = make_cache_key([ open(GRAMMAR_FILE_NAME).read(), open(sim2_parser.__file__).read(),
+                                         open(__file__).read() ])
+
+    def make_key(self, parts: list[str]) -> str:
+        return make_cache_key([ self.base_key ] + parts)
+
+    def get_file_name(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".pickle")
+
+    # Returns None if there is nothing in the cache for the key
+    def load(self, key: str):
+        file_name = self.get_file_name(key)
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, key: str, obj):
+        # Write to the side and then move into place so that a reader never
+        # sees a partial file
+        file_name = self.get_file_name(key)
+        temp_file_name = file_name + "." + str(os.getpid()) + ".tmp"
+        with open(temp_file_name, "wb") as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file_name, file_name)
+
+def make_cache_key(parts: list[str]) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        # The length keeps the boundaries between the parts unambiguous
+        h.update(str(len(part)).encode("utf-8"))
+        h.update(b":")
+        h.update(part.encode("utf-8"))
+    return h.hexdigest()
 
 class Engine:
 
-    def __init__(self):
-        self.parser = lark.Lark.open("./sim2.lark")
+    # Set compiled to False to run the expression interpreter instead of 
+    # the compiled closures (for debugging). If a cache_dir is provided 
+    # the parsed modules and the elaborated design are cached there (see
+    # DesignCache) so that later runs on the same sources skip the parser
+    # and the elaboration. Set optimize to True to simplify the netlist 
+    # (see EvalContext.optimize()). Set two_state to True to use faster 
+    # evaluators whenever the design is free of X/Z values (see 
+    # EvalContext.two_state). The delta_limit is the number of delta cycles
+    # to wait for the design to settle before raising an OscillationError.
+    # If the names (or patterns) of the observed signals are provided, the 
+    # logic that doesn't feed them is only evaluated when it's read (see 
+    # EvalContext.limit_to_cone()). Watches only see the changes to these
+    # lazy signals when they are read. Set eliminate_dead to True to remove
+    # the logic that has no effect on the kept (or observed) signals (see 
+    # EvalContext.eliminate_dead_logic()). 
+    def __init__(self, compiled: bool = True, cache_dir: str = None, optimize: bool = False,
+                 two_state: bool = False, delta_limit: int = DEFAULT_DELTA_LIMIT,
+                 observed: list[str] = None, eliminate_dead: bool = False, keep: list[str] = None):
+        self.compiled = compiled
+        self.delta_limit = delta_limit
+        self.observed = observed
+        self.eliminate_dead = eliminate_dead
+        self.keep = keep or []
+        self.optimize = optimize
+        self.two_state = two_state
+        # The parser is only built when something actually needs parsing
+        self.parser = None
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = DesignCache(cache_dir)
         self.module_defs: dict[str, ModuleDefinition] = {}
         self.first_module_name = None 
+        # The source text of everything that has been loaded, used to 
+        # build the cache key of the elaborated design
+        self.sources: list[str] = []
+        # Number of deferred_updates() blocks that are currently open
+        self.defer_depth = 0
+        self.watches: list[SignalWatch] = []
+        # The elaborated and compiled design, which may be shared with forks
+        # (see fork()). While another engine is using it, the state of this 
+        # one is set aside here (see deactivate()).
+        self.context: EvalContext = None
+        self.saved_state: Snapshot = None
+        self.saved_stats: SchedulerStats = None
+        self.saved_watches: dict[SignalInformation, list] = {}
+        self.saved_profiler: Profiler = None
+
+    # The context, with the state of this engine in it
+    @property
+    def eval_context(self) -> EvalContext:
+        context = self.context
+        if context is not None and context.owner is not self:
+            self.activate()
+        return context
+
+    # Puts the state of this engine into the shared context, setting aside 
+    # the state of the engine that was using it. This is a copy of the 
+    # values and the queues, and there's no elaboration or compiling.
+    def activate(self):
+        context = self.context
+        if context.owner is not None:
+            context.owner.deactivate()
+        context.owner = self
+        # The watches are put back afterwards so that they aren't told 
+        # about the switch
+        context.restore(self.saved_state)
+        context.stats = self.saved_stats
+        for signal_info, watches in self.saved_watches.items():
+            signal_info.watches = watches
+        if self.saved_profiler is not None:
+            context.profiler = self.saved_profiler
+            context.profiler.attach()
+        self.saved_state = None
+        self.saved_stats = None
+        self.saved_watches = {}
+        self.saved_profiler = None
+
+    def deactivate(self):
+        context = self.context
+        self.saved_profiler = context.stop_profile()
+        for signal_info in context.signal_reg.reg.values():
+            if len(signal_info.watches) > 0:
+                self.saved_watches[signal_info] = signal_info.watches
+                signal_info.watches = []
+        self.saved_state = context.snapshot()
+        self.saved_stats = context.stats
+        context.owner = None
+
+    # The standalone parser transforms as it goes, so parse() returns a 
+    # list of ModuleDefinitions.
+    def get_parser(self):
+        if self.parser is None:
+            self.parser = sim2_parser.Lark_StandAlone(transformer=Transformer())
+        return self.parser
 
     def load_module_files(self, file_names: list[str]):
         for name in file_names:
-            tree = self.parser.parse(open(name).read())
-            result = Transformer().transform(tree)
-            # Move the modules into a map
-            for module_def in result:
-                if self.first_module_name == None:
-                    self.first_module_name = module_def.get_name()
-                self.module_defs[module_def.get_name()] = module_def
+            self.load_module_from_text(open(name).read())
 
     def load_module_from_text(self, text: str):
-        tree = self.parser.parse(text)
-        result = Transformer().transform(tree)
+        self.sources.append(text)
+        result = None
+        if self.cache is not None:
+            key = self.cache.make_key([ "modules", text ])
+            result = self.cache.load(key)
+        if result is None:
+            result = self.get_parser().parse(text)
+            if self.cache is not None:
+                self.cache.save(key, result)
         # Move the modules into a map
         for module_def in result:
             if self.first_module_name == None:
@@ -1213,34 +3912,625 @@ class Engine:
         return self.eval_context.get_value(name).get_bool()
 
     def set_value(self, name: str, value: Value):
-        return self.eval_context.set_value_blocking(name, value)
+        if self.defer_depth > 0:
+            # The change is recorded, but not propagated yet
+            self.eval_context.set_value_internal(name, value)
+        else:
+            self.eval_context.set_value_blocking(name, value)
+
+    # Applies all of the values and then settles the design once
+    def set_values(self, values: dict[str, Value]):
+        with self.deferred_updates():
+            for name, value in values.items():
+                self.set_value(name, value)
+
+    # Used in a with statement. The set_value() calls made inside of the 
+    # block only record the new values and the design is settled once at 
+    # the end. This gives the same result as settling after each call 
+    # unless a procedure block reads back a variable that it assigns with a 
+    # blocking assignment, or the same signal is set more than once (only 
+    # the last value is seen).
+    @contextlib.contextmanager
+    def deferred_updates(self):
+        self.defer_depth = self.defer_depth + 1
+        try:
+            yield self
+        finally:
+            self.defer_depth = self.defer_depth - 1
+            if self.defer_depth == 0:
+                self.eval_context.update_dirty_signals()
 
     def get_signal_names(self) -> list[str]:
         return self.eval_context.signal_reg.get_names()
+
+    def get_handle(self, name: str) -> SignalHandle:
+        return SignalHandle(self.eval_context, self.eval_context.get_declared_signal_info(name), self)
+
+    # Returns handles for the signals that match the pattern (see 
+    # SignalNameTree.find())
+    def find_signals(self, pattern: str) -> list[SignalHandle]:
+        return self.make_handles(self.eval_context.signal_reg.name_tree.find(pattern))
+
+    def find_signals_with_prefix(self, prefix: str) -> list[SignalHandle]:
+        return self.make_handles(self.eval_context.signal_reg.name_tree.find_prefix(prefix))
+
+    def find_signals_with_suffix(self, suffix: str) -> list[SignalHandle]:
+        return self.make_handles(self.eval_context.signal_reg.name_tree.find_suffix(suffix))
+
+    def make_handles(self, signal_infos: list[SignalInformation]) -> list[SignalHandle]:
+        return [SignalHandle(self.eval_context, signal_info, self) for signal_info in signal_infos]
     
     def is_valid_signal(self, name: str) -> bool:
         return self.eval_context.is_valid_signal(name)
 
     def start(self):     
 
-        self.eval_context = EvalContext()
-
-        # Elaboration
-        param_map = {}
-
-        self.module_defs[self.first_module_name].elaborate(None, 
-            #self.first_module_name,
-            None,
-            param_map, 
-            self.module_defs, 
-            self.eval_context)
-
-        self.eval_context.signal_reg.debug()
-        self.eval_context.start()
+        # A context shared with a fork is left to the fork
+        if self.context is not None and self.context.owner is self:
+            self.deactivate()
+
+        # The elaborated design is cached before it is compiled since the 
+        # compiled closures can't be pickled.
+        context = None
+        if self.cache is not None:
+            key = self.cache.make_key([ "design", str(self.compiled), str(self.optimize), 
+                                        str(self.two_state), self.first_module_name ] + 
+                                      self.sources)
+            context = self.cache.load(key)
+
+        if context is None:
+            context = EvalContext(self.compiled, self.optimize, self.two_state)
+
+            # Elaboration
+            param_map = {}
+
+            self.module_defs[self.first_module_name].elaborate(None, 
+                #self.first_module_name,
+                None,
+                param_map, 
+                self.module_defs, 
+                context)
+
+            if self.cache is not None:
+                self.cache.save(key, context)
+
+        context.delta_limit = self.delta_limit
+        context.observed = self.observed
+        context.eliminate_dead = self.eliminate_dead
+        context.keep = self.keep
+        context.start()
+        context.owner = self
+        self.context = context
+        self.saved_state = None
+        self.saved_stats = None
+        self.saved_watches = {}
+        self.saved_profiler = None
+        self.watches = []
+        # The initial settling is reported as if it were a tick
+        self.last_tick_stats = context.stats
+        self.eval_context.stats = SchedulerStats()
         
+    # Moves the simulation time forward by one unit
     def tick(self):
+        self.run_until(self.eval_context.time + 1)
+
+    # Moves the simulation time forward to the given time. Stretches of 
+    # time with nothing scheduled are skipped. Stops early if the design 
+    # reaches a $finish.
+    def run_until(self, time: int):
         # Clean up from the previous cycle
         self.eval_context.process_non_blocking_queue()
+        self.eval_context.advance_time(time)
+        # Tell the watchers with callbacks what changed 
+        for watch in self.watches:
+            if watch.callback is not None:
+                watch.dispatch()
+        # Close out the statistics for this tick. These include all of the 
+        # activity since the previous tick (i.e. the set_value() calls too).
+        self.last_tick_stats = self.eval_context.stats
+        self.eval_context.stats = SchedulerStats()
+        if self.eval_context.profiler is not None:
+            self.eval_context.profiler.end_tick(self.last_tick_stats)
+
+    def get_time(self) -> int:
+        return self.eval_context.time
+
+    # Indicates that the design has reached a $finish
+    def is_finished(self) -> bool:
+        return self.eval_context.finished
+
+    # Returns the names of the signals that were removed as dead logic (see
+    # EvalContext.eliminate_dead_logic())
+    def get_removed_signals(self) -> list[str]:
+        return self.eval_context.removed_signals
+
+    # Captures the state of the design so that it can be restored later, 
+    # either into this engine or into another one that was built from the
+    # same sources with the same settings (see Snapshot)
+    def snapshot(self) -> Snapshot:
+        return self.eval_context.snapshot()
+
+    def restore(self, snapshot: Snapshot):
+        self.eval_context.restore(snapshot)
+
+    # Returns a new engine that starts out in the same state as this one and
+    # then goes its own way. The elaborated and compiled design is shared, 
+    # so a fork only costs a copy of the state. The closures work on the 
+    # values in the shared context, so the engines take turns: using one 
+    # swaps its state in (see activate()). Calling start() on a fork gives
+    # it a design of its own.
+    def fork(self) -> Engine:
+        engine = Engine(self.compiled, None, self.optimize, self.two_state, self.delta_limit,
+                        self.observed, self.eliminate_dead, self.keep)
+        engine.cache = self.cache
+        # The modules are shared, but a module loaded into one engine mustn't
+        # show up in the other
+        engine.module_defs = dict(self.module_defs)
+        engine.first_module_name = self.first_module_name
+        engine.sources = list(self.sources)
+        context = self.eval_context
+        engine.context = context
+        engine.saved_state = context.snapshot()
+        engine.saved_stats = SchedulerStats()
+        engine.last_tick_stats = self.last_tick_stats
+        return engine
+
+    # Starts collecting the per-net and per-block counters (see Profiler)
+    def start_profile(self) -> Profiler:
+        return self.eval_context.start_profile()
+
+    # Stops collecting and returns the counters
+    def stop_profile(self) -> Profiler:
+        return self.eval_context.stop_profile()
+
+    # Returns the scheduler activity counters for the most recent tick
+    def get_tick_stats(self) -> SchedulerStats:
+        return self.last_tick_stats
+
+    # Returns the names of the signals in each of the feedback loops of the
+    # design (see EvalContext.find_feedback_loops())
+    def get_feedback_loops(self) -> list[list[str]]:
+        return [[signal_info.name for signal_info in loop] 
+                for loop in self.eval_context.find_feedback_loops()]
+
+    # Starts watching the named signals and/or the signals with names that 
+    # match a pattern (i.e. "tw.*_sw", see SignalNameTree.find()). Use 
+    # poll() on the watch to get the signals that have changed, or provide
+    # a callback that is called with the name and value of each change at 
+    # the end of each tick. The first poll reports all of the signals. 
+    def watch(self, names: list[str] = None, pattern: str = None, callback = None) -> SignalWatch:
+        signal_infos = []
+        if names is not None:
+            for name in names:
+                signal_infos.append(self.eval_context.get_declared_signal_info(name))
+        if pattern is not None:
+            for signal_info in self.eval_context.signal_reg.name_tree.find(pattern):
+                if not signal_info in signal_infos:
+                    signal_infos.append(signal_info)
+        watch = SignalWatch(self.eval_context, signal_infos, callback, self)
+        self.watches.append(watch)
+        return watch
+
+    def unwatch(self, watch: SignalWatch):
+        watch.close()
+        self.watches.remove(watch)
+
+    # Starts writing the changes to the named signals and/or the signals 
+    # with names that match the patterns (i.e. "tw.r4_*" or "tw.**") to a 
+    # VCD file. Everything is written if no names are provided. Call close()
+    # on the writer to finish the file. The lazy signals (see 
+    # EvalContext.limit_to_cone()) only change when they are read, so they 
+    # should be observed if they are written. 
+    def dump_vcd(self, file_name: str, names: list[str] = None) -> VCDWriter:
+        if names is None:
+            names = [ "**" ]
+        signal_infos: dict[SignalInformation, bool] = {}
+        for name in names:
+            if self.eval_context.is_valid_signal(name):
+                signal_infos[self.eval_context.get_declared_signal_info(name)] = True
+            else:
+                for signal_info in self.eval_context.signal_reg.name_tree.find(name):
+                    signal_infos[signal_info] = True
+        return VCDWriter(self.eval_context, list(signal_infos), file_name, self.first_module_name, self)
+
+    # Runs one tick for each item of the stimulus and samples the observed
+    # signals at the end of each tick. An item is either a map of signal 
+    # values or, if the input names are provided, a sequence with a value 
+    # for each input (i.e. a row of a NumPy array). The values can be Values
+    # or plain integers. The stimulus can be a generator, so a long run 
+    # never needs to be built up front. Stops early if the design reaches a 
+    # $finish. Returns a NumPy masked array with a row for each tick and a 
+    # column for each observed signal. It holds 0/1 for the logic values and
+    # the value of the integers, with the X and Z values masked (see 
+    # decode_code_array()).
+    def run(self, stimulus, observe: list[str], inputs: list[str] = None) -> np.ma.MaskedArray:
+        context = self.eval_context
+        codes = context.value_state.codes
+        # All of the names are resolved up front
+        observe_slots = [context.get_declared_signal_info(name).slot for name in observe]
+        lazy_infos = [context.get_signal_info(name) for name in observe 
+                      if context.get_signal_info(name).lazy]
+        input_infos = None
+        if inputs is not None:
+            input_infos = [context.get_signal_info(name) for name in inputs]
+        samples = array("q")
+        tick_count = 0
+        for item in stimulus:
+            # The stimulus may have used a fork in the meantime
+            context.claim(self)
+            if context.finished:
+                break
+            # The inputs are applied together and the design is settled once
+            if input_infos is None:
+                for name, value in item.items():
+                    context.set_signal_code(context.get_signal_info(name), encode_stimulus(value))
+            else:
+                for i in range(0, len(input_infos)):
+                    context.set_signal_code(input_infos[i], encode_stimulus(item[i]))
+            context.update_dirty_signals()
+            self.tick()
+            for signal_info in lazy_infos:
+                if signal_info.dirty:
+                    context.refresh(signal_info)
+            for slot in observe_slots:
+                samples.append(codes[slot])
+            tick_count = tick_count + 1
+        return decode_code_array(np.frombuffer(samples, dtype=np.int64).reshape(tick_count, len(observe)))
+
+    # Simulates a batch of independent scenarios side by side (see 
+    # BatchEvalContext). Each scenario is a list of steps and each step is a
+    # map of signal values that are applied together before a tick. All of
+    # the scenarios start from the current state of the engine, which is 
+    # left unchanged. Returns the values of the observed signals after each
+    # step of each scenario.
+    def run_batch(self, scenarios: list[list[dict[str, Value]]], 
+                  observe: list[str]) -> list[list[dict[str, Value]]]:
+        if len(scenarios) == 0:
+            return []
+        batch = BatchEvalContext(self.eval_context, len(scenarios))
+        step_count = max([len(scenario) for scenario in scenarios])
+        results = [[] for _ in scenarios]
+        for step in range(0, step_count):
+            for lane in range(0, len(scenarios)):
+                if step < len(scenarios[lane]):
+                    for name, value in scenarios[lane][step].items():
+                        batch.set_lane_value(name, lane, value)
+            batch.update_dirty_signals()
+            batch.process_non_blocking_queue()
+            for lane in range(0, len(scenarios)):
+                results[lane].append({ name: batch.get_lane_value(name, lane) for name in observe })
+        return results
+
+# ===== Bit-Parallel Batch Evaluation =========================================
+#
+# In batch mode every signal carries the values of many independent scenarios
+# (lanes) at once. A four-state value is split across two integers, or 
+# "planes", with lane i held in bit i of each plane. The planes are the two
+# bits of the value code (see encode_value()):
+#
+#   code  lo  hi
+#   0     0   0
+#   1     1   0
+#   X     0   1
+#   Z     1   1
+#
+# so each logic operator is a handful of bitwise operations, no matter how 
+# many lanes there are. Integers don't fit in the planes and are carried as 
+# a list of codes (one per lane) instead.
+
+def planes_to_lanes(lo: int, hi: int, lane_count: int) -> list[int]:
+    return [((lo >> lane) & 1) | (((hi >> lane) & 1) << 1) for lane in range(0, lane_count)]
+
+# Integers are treated as X, like encode_logic()
+def lanes_to_planes(codes: list[int]) -> tuple[int, int]:
+    lo = 0
+    hi = 0
+    bit = 1
+    for code in codes:
+        if code == CODE_1:
+            lo = lo | bit
+        elif code == CODE_Z:
+            lo = lo | bit
+            hi = hi | bit
+        elif code != CODE_0:
+            hi = hi | bit
+        bit = bit << 1
+    return (lo, hi)
+
+# The mask has a bit set for each lane. It is needed because ~ works on 
+# an unlimited number of bits.
+
+def plane_not(a: tuple[int, int], mask: int) -> tuple[int, int]:
+    lo, hi = a
+    return (~(lo | hi) & mask, hi)
+
+def plane_or(a: tuple[int, int], b: tuple[int, int], mask: int) -> tuple[int, int]:
+    a_lo, a_hi = a
+    b_lo, b_hi = b
+    one = (a_lo & ~a_hi) | (b_lo & ~b_hi)
+    zero = ~(a_lo | a_hi | b_lo | b_hi) & mask
+    return (one, ~(one | zero) & mask)
+
+def plane_and(a: tuple[int, int], b: tuple[int, int], mask: int) -> tuple[int, int]:
+    a_lo, a_hi = a
+    b_lo, b_hi = b
+    one = a_lo & ~a_hi & b_lo & ~b_hi
+    zero = (~(a_lo | a_hi) | ~(b_lo | b_hi)) & mask
+    return (one, ~(one | zero) & mask)
+
+def plane_xor(a: tuple[int, int], b: tuple[int, int], mask: int) -> tuple[int, int]:
+    a_lo, a_hi = a
+    b_lo, b_hi = b
+    unknown = a_hi | b_hi
+    return ((a_lo ^ b_lo) & ~unknown, unknown)
+
+def plane_eq(a: tuple[int, int], b: tuple[int, int], mask: int) -> tuple[int, int]:
+    a_lo, a_hi = a
+    b_lo, b_hi = b
+    unknown = a_hi | b_hi
+    return (~((a_lo ^ b_lo) | unknown) & mask, unknown)
+
+def plane_case_eq(a: tuple[int, int], b: tuple[int, int], mask: int) -> tuple[int, int]:
+    a_lo, a_hi = a
+    b_lo, b_hi = b
+    return (~((a_lo ^ b_lo) | (a_hi ^ b_hi)) & mask, 0)
+
+def plane_case_neq(a: tuple[int, int], b: tuple[int, int], mask: int) -> tuple[int, int]:
+    a_lo, a_hi = a
+    b_lo, b_hi = b
+    return ((a_lo ^ b_lo) | (a_hi ^ b_hi), 0)
+
+# The operators of a BinaryExpression that can be evaluated on the planes.
+# Logical inequality is the same thing as XOR.
+PLANE_OPERATORS = {
+    "|": plane_or,
+    "&": plane_and,
+    "^": plane_xor,
+    "==": plane_eq,
+    "!=": plane_xor,
+    "===": plane_case_eq,
+    "!==": plane_case_neq
+}
+
+# Presents a single lane of a batch as a normal context so that function
+# bodies can be interpreted.
+class BatchLaneContext:
+
+    def __init__(self, batch: BatchEvalContext, lane: int):
+        self.batch = batch
+        self.lane = lane
+
+    def get_value(self, name: str) -> Value:
+        return self.batch.get_lane_value(name, self.lane)
+
+    def set_value_blocking(self, name: str, value: Value):
+        raise Exception("Functions can't assign to " + name + " in batch mode")
+
+    def get_function_def(self, name: str):
+        return self.batch.context.get_function_def(name)
+
+class BatchEvalContext:
+
+    # Builds a batch evaluator for an EvalContext that has already been
+    # elaborated and started. The nets and blocks are compiled again to work
+    # on the planes, but the levels are borrowed from the context. Every lane
+    # starts out with the current state of the context.
+    def __init__(self, context: EvalContext, lane_count: int):
+        self.context = context
+        self.lane_count = lane_count
+        self.mask = (1 << lane_count) - 1
+        self.stats = SchedulerStats()
+
+        # The lanes start from the values of the lazy nets too, so they are
+        # brought up to date (see EvalContext.limit_to_cone()). The batch 
+        # evaluation itself doesn't bother with laziness.
+        for signal_info in context.signal_reg.reg.values():
+            if signal_info.lazy and signal_info.dirty:
+                context.refresh(signal_info)
+
+        # The planes, indexed by slot. The slots of integer-valued signals
+        # hold a list of codes in wide instead.
+        codes = context.value_state.codes
+        self.lo: list[int] = []
+        self.hi: list[int] = []
+        self.wide: list[list[int]] = [None] * len(codes)
+        for code in codes:
+            lo, hi = lanes_to_planes([code] * lane_count)
+            self.lo.append(lo)
+            self.hi.append(hi)
+        self.wide_signals: dict[str, bool] = {}
+        signal_infos = context.signal_reg.reg.values()
+        for signal_info in signal_infos:
+            if self.is_wide_signal(signal_info):
+                self.wide[signal_info.slot] = [codes[signal_info.slot]] * lane_count
+
+        # Scheduling state, in the same form as the EvalContext
+        self.dirty: list[bool] = [False] * len(codes)
+        self.level_queues: list[list[SignalInformation]] = [[] for _ in context.level_queues]
+        self.dirty_levels: list[int] = []
+        # Maps each triggered block to the lanes it needs to run in
+        self.triggered: dict[ProcedureBlock, int] = {}
+        self.non_blocking_queue: list[BatchUpdateEvent] = []
+
+        self.evaluators = [None] * len(codes)
+        self.blocks: dict[ProcedureBlock, object] = {}
+        for signal_info in signal_infos:
+            if signal_info.data_type == DataType.NET and signal_info.has_any_drivers():
+                self.evaluators[signal_info.slot] = self.compile_net(signal_info)
+            for pb in signal_info.triggered_procedure_blocks:
+                if not pb in self.blocks:
+                    self.blocks[pb] = pb.compile_batch(self)
+
+    def get_slot(self, name: str) -> int:
+        return self.context.value_state.get_slot(name)
+
+    # Integer variables are carried as lists of codes, along with any plain 
+    # wire that is driven by something that may produce an integer.
+    def is_wide_signal(self, signal_info: SignalInformation) -> bool:
+        name = signal_info.name
+        if not name in self.wide_signals:
+            # Assume not while looking, in case of a loop
+            self.wide_signals[name] = False
+            if signal_info.data_type == DataType.VARIABLE:
+                wide = signal_info.var_type == VariableType.INTEGER
+            else:
+                wide = signal_info.net_type == NetType.WIRE and \
+                    len(signal_info.assignments) == 1 and \
+                    signal_info.assignments[0].is_batch_wide(self)
+            self.wide_signals[name] = wide
+        return self.wide_signals[name]
+
+    def compile_net(self, signal_info: SignalInformation):
+        if self.wide[signal_info.slot] is not None:
+            return signal_info.assignments[0].compile_batch_lanes(self)
+        drivers = [assignment.compile_batch(self) for assignment in signal_info.assignments]
+        net_type = signal_info.net_type
+        mask = self.mask
+        if net_type == NetType.WIRE:
+            if len(drivers) == 1:
+                return drivers[0]
+            # Conflicting drivers 
+            x = (0, mask)
+            def f():
+                return x
+            return f
+        elif net_type == NetType.WOR or net_type == NetType.WAND:
+            if net_type == NetType.WOR:
+                op = plane_or
+            else:
+                op = plane_and
+            def f():
+                result = drivers[0]()
+                for i in range(1, len(drivers)):
+                    result = op(result, drivers[i](), mask)
+                return result
+            return f
+        else:
+            raise Exception("Not allowed to drive a supply net")
+
+    def get_lane_code(self, name: str, lane: int) -> int:
+        slot = self.get_slot(name)
+        if self.wide[slot] is not None:
+            return self.wide[slot][lane]
+        return ((self.lo[slot] >> lane) & 1) | (((self.hi[slot] >> lane) & 1) << 1)
+
+    def get_lane_value(self, name: str, lane: int) -> Value:
+        return decode_value(self.get_lane_code(name, lane))
+
+    # Changes the value of a signal in one lane. The change isn't propagated
+    # until update_dirty_signals() is called.
+    def set_lane_value(self, name: str, lane: int, value: Value):
+        signal_info = self.context.get_signal_info(name)
+        code = encode_value(value)
+        if self.wide[signal_info.slot] is not None:
+            lanes = [code] * self.lane_count
+            self.set_signal(signal_info, lanes, 1 << lane)
+        else:
+            self.set_signal(signal_info, lanes_to_planes([code] * self.lane_count), 1 << lane)
+
+    def set_signal_blocking(self, signal_info: SignalInformation, value, mask: int):
+        self.set_signal(signal_info, value, mask)
+        self.update_dirty_signals()
+
+    def set_signal_non_blocking(self, signal_info: SignalInformation, value, mask: int):
+        self.non_blocking_queue.append(BatchUpdateEvent(signal_info, value, mask))
+
+    def process_non_blocking_queue(self):
+        rounds = 0
+        while len(self.non_blocking_queue) > 0:
+            rounds = rounds + 1
+            if rounds > self.context.delta_limit:
+                raise self.context.make_oscillation_error(
+                    [event.signal_info for event in self.non_blocking_queue])
+            non_blocking_queue = self.non_blocking_queue
+            self.non_blocking_queue = []
+            for event in non_blocking_queue:
+                self.set_signal(event.signal_info, event.value, event.mask)
+            self.update_dirty_signals()
+
+    # Stores the value (planes or a list of codes, depending on the signal)
+    # into the lanes selected by the mask. Readers are only scheduled for 
+    # the lanes that actually changed.
+    def set_signal(self, signal_info: SignalInformation, value, mask: int):
+        slot = signal_info.slot
+        wide = self.wide[slot]
+        if wide is None:
+            lo, hi = value
+            old_lo = self.lo[slot]
+            old_hi = self.hi[slot]
+            new_lo = (old_lo & ~mask) | (lo & mask)
+            new_hi = (old_hi & ~mask) | (hi & mask)
+            changed = (old_lo ^ new_lo) | (old_hi ^ new_hi)
+            if changed == 0:
+                return
+            self.lo[slot] = new_lo
+            self.hi[slot] = new_hi
+        else:
+            changed = 0
+            # The list may be shared with an expression, so it is replaced 
+            # rather than modified
+            new_wide = list(wide)
+            for lane in range(0, self.lane_count):
+                if (mask >> lane) & 1 and new_wide[lane] != value[lane]:
+                    new_wide[lane] = value[lane]
+                    changed = changed | (1 << lane)
+            if changed == 0:
+                return
+            self.wide[slot] = new_wide
+
+        for net_info in signal_info.fanout:
+            if not self.dirty[net_info.slot]:
+                self.dirty[net_info.slot] = True
+                queue = self.level_queues[net_info.level]
+                if len(queue) == 0:
+                    heapq.heappush(self.dirty_levels, net_info.level)
+                queue.append(net_info)
+        for pb in signal_info.triggered_procedure_blocks:
+            self.triggered[pb] = self.triggered.get(pb, 0) | changed
+
+    # Same as EvalContext.update_dirty_signals(), but the procedure blocks
+    # only run in the lanes where one of their triggers changed.
+    # The oscillation checks just report the pending signals.
+    def update_dirty_signals(self):
+        delta_cycles = 0
+        while len(self.triggered) > 0 or len(self.dirty_levels) > 0:
+
+            delta_cycles = delta_cycles + 1
+            if delta_cycles > self.context.delta_limit:
+                pending = [self.context.signal_reg.reg[statement.lhs] 
+                           for pb in self.triggered for statement in pb.statements
+                           if type(statement) is ProcedureAssignment]
+                raise self.context.make_oscillation_error(pending)
+            self.stats.delta_cycles = self.stats.delta_cycles + 1
+
+            triggered = self.triggered
+            self.triggered = {}
+            for pb, mask in triggered.items():
+                self.blocks[pb](mask)
+                self.stats.procedure_executions = self.stats.procedure_executions + 1
+
+            while len(self.dirty_levels) > 0:
+                level = heapq.heappop(self.dirty_levels)
+                rounds = 0
+                while len(self.level_queues[level]) > 0:
+                    rounds = rounds + 1
+                    if rounds > self.context.delta_limit:
+                        raise self.context.make_oscillation_error(self.level_queues[level])
+                    queue = self.level_queues[level]
+                    self.level_queues[level] = []
+                    for signal_info in reversed(queue):
+                        self.dirty[signal_info.slot] = False
+                        evaluator = self.evaluators[signal_info.slot]
+                        if evaluator is not None:
+                            self.stats.net_evaluations = self.stats.net_evaluations + 1
+                            self.set_signal(signal_info, evaluator(), self.mask)
+
+class BatchUpdateEvent:
+
+    def __init__(self, signal_info: SignalInformation, value, mask: int):
+        self.signal_info = signal_info
+        self.value = value
+        self.mask = mask
 
 # ===== Lark Transformer ======================================================
 
@@ -1256,30 +4546,27 @@ class MultiVariableDeclaration:
         self.var_type = var_type
         self.ids = ids
 
+# Used to convert the keyword tokens, by terminal name
+TOKEN_TYPES = {
+    "WIRE": NetType.WIRE,
+    "TRI": NetType.WIRE,
+    "WAND": NetType.WAND,
+    "WOR": NetType.WOR,
+    "SUPPLY0": NetType.SUPPLY0,
+    "SUPPLY1": NetType.SUPPLY1,
+    "REG": VariableType.REG,
+    "INTEGER": VariableType.INTEGER,
+    "INPUT": PortType.INPUT,
+    "OUTPUT": PortType.OUTPUT
+}
+
+# This is used on the trees that come out of a lark.Lark parser and also 
+# directly by the standalone parser in sim2_parser.py (which calls the rule 
+# methods as it goes). The standalone parser would run any methods named 
+# after terminals as lexer callbacks, so the tokens are converted by the 
+# rules instead.
 class Transformer(lark.visitors.Transformer):
 
-    def IDENTIFIER(self, items):
-        return str(items)
-
-    def BINARY_CONSTANT(self, items):
-        return parse_binary_constant(str(items))
-
-    def SIGNED_NUMBER(self, items):
-        return int(str(items))
-
-    def WIRE(self, items): return NetType.WIRE
-    def TRI(self, items): return NetType.WIRE
-    def WAND(self, items): return NetType.WAND
-    def WOR(self, items): return NetType.WOR
-    def SUPPLY0(self, items): return NetType.SUPPLY0
-    def SUPPLY1(self, items): return NetType.SUPPLY1
-
-    def REG(self, items): return VariableType.REG
-    def INTEGER(self, items): return VariableType.INTEGER
-
-    def INPUT(self, items): return PortType.INPUT
-    def OUTPUT(self, items): return PortType.OUTPUT
-
     def start(self, items) -> list[ModuleDefinition]:
         # Return an array of ModuleDefinitions
         return items
@@ -1291,6 +4578,7 @@ class Transformer(lark.visitors.Transformer):
         fds = []
         vds = []
         tps = []
+        ips = []
         # Distribute the module statements into the proper buckets
         for statement in items[2]:
             if type(statement) is NetDeclaration:
@@ -1314,18 +4602,20 @@ class Transformer(lark.visitors.Transformer):
                     vds.append(VariableDeclaration(statement.var_type, id))
             elif type(statement) is TriggeredProcedure:
                 tps.append(statement)
+            elif type(statement) is InitialProcedure:
+                ips.append(statement)
             else:
                 raise Exception("Unrecognized statement type " + str(type(statement)))
-        return ModuleDefinition(items[0], items[1], nds, nas, mis, fds, vds, tps)
+        return ModuleDefinition(str(items[0]), items[1], nds, nas, mis, fds, vds, tps, ips)
 
     def portdeclarations(self, items):
         return items
 
     def portdeclaration(self, items):
-        return PortDeclaration(items[1], items[0])
+        return PortDeclaration(str(items[1]), items[0])
 
     def porttype(self, items):
-        return items[0]
+        return TOKEN_TYPES[items[0].type]
 
     def modulestatements(self, items):
         return items
@@ -1347,49 +4637,49 @@ class Transformer(lark.visitors.Transformer):
     
     def identifier_with_init(self, items):
         # items[0] is the identifier name
-        return IdentifierWithInit(items[0], None)
+        return IdentifierWithInit(str(items[0]), None)
 
     def identifier_with_init_exp(self, items):
         # items[0] is the identifier name
         # items[1] is the expression
-        return IdentifierWithInit(items[0], items[1])
+        return IdentifierWithInit(str(items[0]), items[1])
 
     def identifiers(self, items) -> list[str]:
-        return items
+        return [str(item) for item in items]
 
     def netdeclaration_assign(self, items):
-        return NetDeclaration(items[1], items[0], items[2]) 
+        return NetDeclaration(str(items[1]), items[0], items[2]) 
 
     def netassignment(self, items):
-        return NetAssignment(items[0], items[1])
+        return NetAssignment(str(items[0]), items[1])
 
     def functiondeclaration(self, items):
         local_variables = []
-        return FunctionDefinition(items[0], items[1], local_variables, ProcedureBlock(items[2]))
+        return FunctionDefinition(str(items[0]), items[1], local_variables, ProcedureBlock(items[2]))
 
     def paramdeclarations(self, items):
         return items
 
     def paramdeclaration(self, items):
-        return FunctionParameterDeclaration(items[1], items[0])
+        return FunctionParameterDeclaration(str(items[1]), items[0])
 
     def moduleinstantiation(self, items):
-        return ModuleInstantiation(items[0], items[1], items[2])
+        return ModuleInstantiation(str(items[0]), str(items[1]), items[2])
 
     def nettype(self, items):
-        return items[0]
+        return TOKEN_TYPES[items[0].type]
 
     def variabletype(self, items):
-        return items[0]
+        return TOKEN_TYPES[items[0].type]
 
     def port_assignments(self, items):
         return items
 
-    def port_assignment_id(self, items):
-        return PortAssignment(items[0], items[1])
-
-    def port_assignment_exp(self, items):
-        raise Exception("Not supported yet")   
+    def port_assignment(self, items):
+        # Only plain connections to a net are supported
+        if not type(items[1]) is VariableExpression:
+            raise Exception("Not supported yet")   
+        return PortAssignment(str(items[0]), items[1].name)
 
     def functionbody_single(self, items):
         return [ items[0] ]
@@ -1406,23 +4696,43 @@ class Transformer(lark.visitors.Transformer):
     def functionstatement(self, items):
         return items[0]
       
+    # A delay in front of an assignment comes through as a list of two 
+    # statements
     def procedurestatements(self, items):
-        return items
+        result = []
+        for item in items:
+            if type(item) is list:
+                result.extend(item)
+            else:
+                result.append(item)
+        return result
     
     def procedurestatement(self, items):
         return items[0]
 
     def procedureassignment_blocking(self, items):
-        return ProcedureAssignment(items[0], items[1], True)
+        return ProcedureAssignment(str(items[0]), items[1], True)
 
     def procedureassignment_non_blocking(self, items):
-        return ProcedureAssignment(items[0], items[1], False)
+        return ProcedureAssignment(str(items[0]), items[1], False)
+
+    def procedure_delay(self, items):
+        return ProcedureDelay(int(str(items[0])))
+
+    def procedure_delay_assignment(self, items):
+        return [ ProcedureDelay(int(str(items[0]))), items[1] ]
+
+    def procedure_finish(self, items):
+        return ProcedureFinish()
 
     def always(self, items):
         # items[0] - identifiers
         # items[1] - procedurestatements
         return TriggeredProcedure(items[0], ProcedureBlock(items[1]))        
 
+    def initial(self, items):
+        return InitialProcedure(ProcedureBlock(items[0]))
+
     # ----- Expression Stuff --------------------------------------------------
 
     def exps(self, items):
@@ -1468,13 +4778,13 @@ class Transformer(lark.visitors.Transformer):
         return tree[0]
 
     def exp_func(self, items):
-        return FunctionExpression(items[0], items[1])
+        return FunctionExpression(str(items[0]), items[1])
 
     def exp_id(self, items):
-        return VariableExpression(items[0])
+        return VariableExpression(str(items[0]))
 
     def exp_binary_constant(self, items):
-        return ConstantExpression(items[0])
+        return ConstantExpression(parse_binary_constant(str(items[0])))
     
     def exp_signed_number(self, items):
-        return ConstantExpression(Value(items[0]))
+        return ConstantExpression(Value(int(str(items[0]))))
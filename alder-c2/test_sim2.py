@@ -1,4 +1,7 @@
+import os
+import tempfile
 import lark
+import numpy as np
 import sim2 
 
 def test_1():
@@ -568,6 +571,1631 @@ def test_11():
   engine.set_value("tw._angle", sim2.Value(100))
   assert engine.get_value("tw.crcb_3no_sw") == sim2.LOGIC_1
 
+# Fanout index built during elaboration
+def test_12():
+
+  print("----- test_12 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b, c, d;
+  assign b = !a;
+  assign c = a & b;
+  assign d = c;
+endmodule
+"""
+    )
+
+  engine.start()
+
+  reg = engine.eval_context.signal_reg
+  assert sorted([x.name for x in reg.get_fanout("a")]) == [ "b", "c" ]
+  assert [x.name for x in reg.get_fanout("b")] == [ "c" ]
+  assert [x.name for x in reg.get_fanout("c")] == [ "d" ]
+  assert reg.get_fanout("d") == []
+
+  engine.set_value("a", sim2.LOGIC_1)
+  assert engine.get_value("b") == sim2.LOGIC_0
+  assert engine.get_value("d") == sim2.LOGIC_0
+
+# Worklist scheduler statistics
+def test_13():
+
+  print("----- test_13 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  engine.start() 
+
+  # Nothing has changed, so the tick has nothing to do
+  engine.tick()
+  assert engine.get_tick_stats().net_evaluations == 0
+  assert engine.get_tick_stats().delta_cycles == 0
+
+  # Picking a relay only touches the relay and its switches
+  engine.set_value("tw.r6_pick_coil", sim2.LOGIC_1)
+  engine.tick()
+  assert engine.get_value("tw.r6_1no_sw") == sim2.LOGIC_1
+  stats = engine.get_tick_stats()
+  assert stats.procedure_executions == 1
+  assert stats.delta_cycles > 0
+  assert stats.net_evaluations < 20
+
+# Compiled and interpreted evaluation must agree
+def test_14():
+
+  print("----- test_14 ------------------------------------------------------")
+
+  engines = []
+  for compiled in [ True, False ]:
+    engine = sim2.Engine(compiled)
+    engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+    engine.start() 
+    engines.append(engine)
+
+  for engine in engines:
+    engine.set_value("tw._angle", sim2.Value(100))
+    engine.set_value("tw.r1_pick_coil", sim2.LOGIC_0)
+    engine.set_value("tw.r1_trip_coil", sim2.LOGIC_0)
+    engine.set_value("tw.r1_pick_coil", sim2.LOGIC_1)
+    engine.set_value("tw.r6_pick_coil", sim2.LOGIC_1)
+    engine.tick()
+    engine.set_value("tw.r1_pick_coil", sim2.LOGIC_0)
+    engine.tick()
+
+  assert engines[0].get_value("tw.r1_1no_sw") == sim2.LOGIC_1
+  for name in engines[0].get_signal_names():
+    assert engines[0].get_value(name) == engines[1].get_value(name)
+
+# Compact value encoding
+def test_15():
+
+  print("----- test_15 ------------------------------------------------------")
+
+  # Round trips, including integers that would collide with the X/Z codes
+  for v in [ sim2.LOGIC_0, sim2.LOGIC_1, sim2.LOGIC_X, sim2.LOGIC_Z, 
+             sim2.Value(2), sim2.Value(3), sim2.Value(100), sim2.Value(-5) ]:
+    assert sim2.decode_value(sim2.encode_value(v)) == v
+  assert sim2.encode_value(sim2.Value(True)) == sim2.CODE_1
+
+  # The encoding preserves integer ordering
+  assert sim2.code_eval_lt(sim2.encode_value(sim2.Value(1)), 
+                           sim2.encode_value(sim2.Value(2))) == sim2.CODE_1
+  assert sim2.code_eval_gte(sim2.encode_value(sim2.Value(-1)), 
+                            sim2.encode_value(sim2.Value(0))) == sim2.CODE_0
+  assert sim2.code_eval_eq(sim2.encode_value(sim2.Value(100)), 
+                           sim2.encode_value(sim2.Value(100))) == sim2.CODE_1
+  assert sim2.code_eval_eq(sim2.CODE_X, 
+                           sim2.encode_value(sim2.Value(100))) == sim2.CODE_X
+
+  assert sim2.logic_eval_xor(sim2.LOGIC_1, sim2.LOGIC_1) == sim2.LOGIC_0
+  assert sim2.logic_eval_xor(sim2.LOGIC_1, sim2.LOGIC_Z) == sim2.LOGIC_X
+  assert sim2.logic_eval_not(sim2.LOGIC_Z) == sim2.LOGIC_X
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b, c;
+  integer i;
+  assign c = (a ^ b) | (i > 2);
+endmodule
+"""
+    )
+  engine.start()
+  assert engine.get_value("c") == sim2.LOGIC_X
+  engine.set_value("a", sim2.LOGIC_1)
+  engine.set_value("b", sim2.LOGIC_0)
+  assert engine.get_value("c") == sim2.LOGIC_1
+  engine.set_value("b", sim2.LOGIC_1)
+  engine.set_value("i", sim2.Value(2))
+  assert engine.get_value("c") == sim2.LOGIC_0
+  engine.set_value("i", sim2.Value(3))
+  assert engine.get_value("c") == sim2.LOGIC_1
+  assert engine.get_int("i") == 3
+
+# Slot-indexed value storage
+def test_16():
+
+  print("----- test_16 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b;
+  reg r = 1'b1;
+  assign b = !a;
+endmodule
+"""
+    )
+  engine.start()
+
+  value_state = engine.eval_context.value_state
+  reg = engine.eval_context.signal_reg
+  # Every signal has its own slot
+  slots = [ reg.reg[name].slot for name in [ "a", "b", "r" ] ]
+  assert sorted(slots) == [ 0, 1, 2 ]
+  assert value_state.get_slot("r") == reg.reg["r"].slot
+  assert value_state.codes[reg.reg["r"].slot] == sim2.CODE_1
+
+  engine.set_value("a", sim2.LOGIC_0)
+  assert value_state.codes[reg.reg["b"].slot] == sim2.CODE_1
+  assert engine.get_value("b") == sim2.LOGIC_1
+
+# Levelized scheduling
+def test_17():
+
+  print("----- test_17 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b, c, d;
+  assign b = !a;
+  assign c = b & a;
+  assign d = c | b;
+  // A latch made from a combinational loop
+  wire s, r, q, qn;
+  assign q = !(s | qn);
+  assign qn = !(r | q);
+endmodule
+"""
+    )
+  engine.start()
+  engine.tick()
+
+  reg = engine.eval_context.signal_reg.reg
+  assert [ reg[n].level for n in [ "a", "b", "c", "d" ] ] == [ 0, 1, 2, 3 ]
+  assert not reg["d"].cyclic
+  assert reg["q"].cyclic and reg["qn"].cyclic
+  assert reg["q"].level == reg["qn"].level
+
+  # Each net in the acyclic chain is evaluated exactly once
+  engine.set_value("a", sim2.LOGIC_1)
+  engine.tick()
+  assert engine.get_value("d") == sim2.LOGIC_0
+  assert engine.get_tick_stats().net_evaluations == 3
+  assert engine.get_tick_stats().delta_cycles == 1
+
+  # The loop falls back to iteration
+  engine.set_value("s", sim2.LOGIC_0)
+  engine.set_value("r", sim2.LOGIC_1)
+  assert engine.get_value("q") == sim2.LOGIC_1
+  assert engine.get_value("qn") == sim2.LOGIC_0
+  engine.set_value("r", sim2.LOGIC_0)
+  assert engine.get_value("q") == sim2.LOGIC_1
+  engine.set_value("s", sim2.LOGIC_1)
+  assert engine.get_value("q") == sim2.LOGIC_0
+  assert engine.get_value("qn") == sim2.LOGIC_1
+
+# Bit-parallel batch mode
+def test_18():
+
+  print("----- test_18 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b;
+  wire w_or, w_and, w_xor, w_not, w_eq, w_neq, w_ceq, w_cneq;
+  assign w_or = a | b;
+  assign w_and = a & b;
+  assign w_xor = a ^ b;
+  assign w_not = !a;
+  assign w_eq = a == b;
+  assign w_neq = a != b;
+  assign w_ceq = a === b;
+  assign w_cneq = a !== b;
+  integer i;
+  wire w_gt = i > 2;
+endmodule
+"""
+    )
+  engine.start()
+
+  # One lane for every combination of the four logic values
+  values = [ sim2.LOGIC_0, sim2.LOGIC_1, sim2.LOGIC_X, sim2.LOGIC_Z ]
+  scenarios = []
+  for a in values:
+    for b in values:
+      scenarios.append([ { "a": a, "b": b, "i": sim2.Value(len(scenarios)) } ])
+  observe = [ "w_or", "w_and", "w_xor", "w_not", "w_eq", "w_neq", "w_ceq", "w_cneq", "w_gt" ]
+  results = engine.run_batch(scenarios, observe)
+  assert len(results) == 16
+
+  for lane in range(0, 16):
+    a = scenarios[lane][0]["a"]
+    b = scenarios[lane][0]["b"]
+    result = results[lane][0]
+    assert result["w_or"] == sim2.logic_eval_or(a, b)
+    assert result["w_and"] == sim2.logic_eval_and(a, b)
+    assert result["w_xor"] == sim2.logic_eval_xor(a, b)
+    assert result["w_not"] == sim2.logic_eval_not(a)
+    assert result["w_eq"] == sim2.logic_eval_eq(a, b)
+    assert result["w_neq"] == sim2.logic_eval_neq(a, b)
+    assert result["w_ceq"] == sim2.case_eval_eq(a, b)
+    assert result["w_cneq"] == sim2.case_eval_neq(a, b)
+    assert result["w_gt"] == sim2.Value(lane > 2)
+
+  # The engine itself is left alone
+  assert engine.get_value("w_or") == sim2.LOGIC_X
+
+  # The relays, run as a batch and one scenario at a time
+  engine = sim2.Engine()
+  engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  engine.start() 
+  scenarios = [
+    [ { "tw.r6_pick_coil": sim2.LOGIC_1 }, 
+      { "tw.r6_pick_coil": sim2.LOGIC_0, "tw.r6_hold_coil": sim2.LOGIC_0 } ],
+    [ { "tw.r6_pick_coil": sim2.LOGIC_1 }, 
+      { "tw.r6_pick_coil": sim2.LOGIC_0, "tw.r6_hold_coil": sim2.LOGIC_1 } ],
+    [ { "tw.r1_pick_coil": sim2.LOGIC_1, "tw.r1_trip_coil": sim2.LOGIC_0 }, 
+      { "tw.r1_pick_coil": sim2.LOGIC_0 }, 
+      { "tw.r1_trip_coil": sim2.LOGIC_1 } ],
+    [ { "tw._angle": sim2.Value(100) } ]
+  ]
+  observe = [ "tw.r6_1no_sw", "tw.r1_1no_sw", "tw.crcb_3no_sw" ]
+  results = engine.run_batch(scenarios, observe)
+
+  for lane in range(0, len(scenarios)):
+    single = sim2.Engine()
+    single.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+    single.start() 
+    for step in range(0, len(scenarios[lane])):
+      for name, value in scenarios[lane][step].items():
+        single.set_value(name, value)
+      single.tick()
+      for name in observe:
+        assert results[lane][step][name] == single.get_value(name)
+
+  assert results[0][0]["tw.r6_1no_sw"] == sim2.LOGIC_1
+  assert results[0][1]["tw.r6_1no_sw"] == sim2.LOGIC_0
+  assert results[1][1]["tw.r6_1no_sw"] == sim2.LOGIC_1
+  assert results[3][0]["tw.crcb_3no_sw"] == sim2.LOGIC_1
+
+# On-disk design cache
+def test_19():
+
+  print("----- test_19 ------------------------------------------------------")
+
+  with tempfile.TemporaryDirectory() as cache_dir:
+
+    # Cold start fills the cache
+    cold = sim2.Engine(cache_dir=cache_dir)
+    cold.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+    cold.start()
+    assert cold.parser is not None
+    # One entry per file and one for the elaborated design
+    assert len(os.listdir(cache_dir)) == 3
+
+    # Warm start never builds the parser
+    warm = sim2.Engine(cache_dir=cache_dir)
+    warm.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+    warm.start()
+    assert warm.parser is None
+    assert len(os.listdir(cache_dir)) == 3
+
+    for engine in [ cold, warm ]:
+      engine.set_value("tw.r6_pick_coil", sim2.LOGIC_1)
+      engine.tick()
+    assert warm.get_value("tw.r6_1no_sw") == sim2.LOGIC_1
+    assert sorted(cold.get_signal_names()) == sorted(warm.get_signal_names())
+    for name in cold.get_signal_names():
+      assert cold.get_value(name) == warm.get_value(name)
+
+    # Different sources don't collide
+    other = sim2.Engine(cache_dir=cache_dir)
+    other.load_module_from_text(
+"""
+module mod0();
+  wire a, b;
+  assign b = !a;
+endmodule
+"""
+      )
+    other.start()
+    assert other.parser is not None
+
+    # A regenerated parser doesn't reuse the old entries
+    parser_file_name = sim2.sim2_parser.__file__
+    changed_file_name = os.path.join(cache_dir, "sim2_parser.py")
+    with open(changed_file_name, "w") as f:
+      f.write(open(parser_file_name).read() + "\n# Regenerated\n")
+    base_key = sim2.DesignCache(cache_dir).base_key
+    try:
+      sim2.sim2_parser.__file__ = changed_file_name
+      assert sim2.DesignCache(cache_dir).base_key != base_key
+    finally:
+      sim2.sim2_parser.__file__ = parser_file_name
+    other.set_value("a", sim2.LOGIC_0)
+    assert other.get_value("b") == sim2.LOGIC_1
+
+# Operator precedence in the LALR grammar
+def test_20():
+
+  print("----- test_20 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b, c, d;
+  wire p0 = a | b & c;
+  wire p1 = a & b | c;
+  wire p2 = !a == b;
+  wire p3 = a == b & c != d;
+  wire p4 = a ^ b | c ^ d;
+  wire p5 = a < b == c;
+  wire p6 = a | b | c;
+  wire p7 = !!a & (b | c);
+  reg r;
+  always @(a) begin r <= a <= b; end
+endmodule
+"""
+    )
+  module_def = engine.module_defs["mod0"]
+  exps = {}
+  for nd in module_def.net_declarations:
+    if nd.exp is not None:
+      exps[nd.name] = str(nd.exp)
+  assert exps["p0"] == "(a | (b & c))"
+  assert exps["p1"] == "((a & b) | c)"
+  assert exps["p2"] == "((!a) == b)"
+  assert exps["p3"] == "((a == b) & (c != d))"
+  assert exps["p4"] == "((a ^ b) | (c ^ d))"
+  assert exps["p5"] == "((a < b) == c)"
+  assert exps["p6"] == "((a | b) | c)"
+  assert exps["p7"] == "((!(!a)) & (b | c))"
+  tp = module_def.triggered_procedures[0]
+  assert str(tp.procedure_block.statements[0]) == "r <= (a <= b)"
+
+  # Binary constants aren't mistaken for numbers
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a = 1'b1;
+  wire b = 1'bz;
+  wire c = 10;
+endmodule
+"""
+    )
+  engine.start()
+  assert engine.get_value("a") == sim2.LOGIC_1
+  assert engine.get_value("b") == sim2.LOGIC_Z
+  assert engine.get_int("c") == 10
+
+# Bulk inputs are settled once
+def test_21():
+
+  print("----- test_21 ------------------------------------------------------")
+
+  engines = []
+  for i in range(0, 3):
+    engine = sim2.Engine()
+    engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+    engine.start() 
+    engines.append(engine)
+
+  steps = [
+    { "tw._angle": sim2.Value(100), "tw._cycle": sim2.Value(0),
+      "tw.r1_pick_coil": sim2.LOGIC_1, "tw.r1_trip_coil": sim2.LOGIC_0, 
+      "tw.r6_pick_coil": sim2.LOGIC_1, "tw.r6_hold_coil": sim2.LOGIC_0 },
+    { "tw._angle": sim2.Value(50), "tw.r1_pick_coil": sim2.LOGIC_0, 
+      "tw.r6_pick_coil": sim2.LOGIC_0, "tw.r6_hold_coil": sim2.LOGIC_1 },
+    { "tw.r1_trip_coil": sim2.LOGIC_1, "tw.r6_hold_coil": sim2.LOGIC_0 }
+  ]
+
+  evaluations = [ 0, 0, 0 ]
+  for step in steps:
+    # One call at a time
+    for name, value in step.items():
+      engines[0].set_value(name, value)
+    # All at once
+    engines[1].set_values(step)
+    # Using the context manager
+    with engines[2].deferred_updates():
+      for name, value in step.items():
+        engines[2].set_value(name, value)
+    for i in range(0, 3):
+      engines[i].tick()
+      evaluations[i] = evaluations[i] + engines[i].get_tick_stats().net_evaluations
+    for name in engines[0].get_signal_names():
+      assert engines[0].get_value(name) == engines[1].get_value(name)
+      assert engines[0].get_value(name) == engines[2].get_value(name)
+
+  assert engines[1].get_value("tw.r1_1no_sw") == sim2.LOGIC_0
+  assert evaluations[1] < evaluations[0]
+  assert evaluations[2] == evaluations[1]
+
+  # Values are visible inside the block, but not their effects
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b;
+  assign b = !a;
+endmodule
+"""
+    )
+  engine.start()
+  with engine.deferred_updates():
+    engine.set_value("a", sim2.LOGIC_1)
+    assert engine.get_value("a") == sim2.LOGIC_1
+    assert engine.get_value("b") == sim2.LOGIC_X
+  assert engine.get_value("b") == sim2.LOGIC_0
+
+# Watching for signal changes
+def test_22():
+
+  print("----- test_22 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  engine.start() 
+
+  switch_watch = engine.watch(pattern="tw.*_sw")
+  switch_names = [ name for name in engine.get_signal_names() 
+                   if name.startswith("tw.") and name.endswith("_sw") ]
+  changes = []
+  coil_watch = engine.watch(names=[ "tw.r6_1no_sw" ], 
+                            callback=lambda name, value: changes.append((name, value)))
+
+  # Everything is reported the first time
+  first = switch_watch.poll()
+  assert sorted(first.keys()) == sorted(switch_names)
+  # Nothing has happened since
+  assert switch_watch.poll() == {}
+
+  engine.set_value("tw.r6_pick_coil", sim2.LOGIC_1)
+  engine.tick()
+  changed = switch_watch.poll()
+  assert changed["tw.r6_1no_sw"] == sim2.LOGIC_1
+  for name, value in changed.items():
+    assert value != first[name]
+    assert value == engine.get_value(name)
+  assert len(changed) < len(switch_names)
+  # The callback has seen the initial value and the change
+  assert changes[-1] == ("tw.r6_1no_sw", sim2.LOGIC_1)
+
+  # A change that is undone before the poll isn't reported
+  engine.set_value("tw._angle", sim2.Value(0))
+  switch_watch.poll()
+  engine.set_value("tw._angle", sim2.Value(100))
+  engine.set_value("tw._angle", sim2.Value(0))
+  assert switch_watch.poll() == {}
+
+  changes.clear()
+  engine.unwatch(coil_watch)
+  engine.set_value("tw.r6_pick_coil", sim2.LOGIC_0)
+  engine.set_value("tw.r6_hold_coil", sim2.LOGIC_0)
+  engine.tick()
+  assert changes == []
+  assert switch_watch.poll()["tw.r6_1no_sw"] == sim2.LOGIC_0
+
+# Hierarchical name queries
+def test_23():
+
+  print("----- test_23 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b_sw;
+  relay r4(.coil(a));
+  relay r5(.coil(b_sw));
+endmodule
+
+module relay(input coil);
+  wire state_sw;
+  assign state_sw = coil;
+endmodule
+"""
+    )
+  engine.start()
+
+  def names(handles):
+    return sorted([ h.name for h in handles ])
+
+  assert names(engine.find_signals("r4.*")) == [ "r4.coil", "r4.state_sw" ]
+  assert names(engine.find_signals("*.*_sw")) == [ "r4.state_sw", "r5.state_sw" ]
+  assert names(engine.find_signals("*_sw")) == [ "b_sw" ]
+  assert names(engine.find_signals("**.state_sw")) == [ "r4.state_sw", "r5.state_sw" ]
+  assert names(engine.find_signals("r[45].coil")) == [ "r4.coil", "r5.coil" ]
+  assert names(engine.find_signals("r6.*")) == []
+  assert names(engine.find_signals_with_prefix("r5")) == [ "r5.coil", "r5.state_sw" ]
+  assert names(engine.find_signals_with_suffix("_sw")) == [ "b_sw", "r4.state_sw", "r5.state_sw" ]
+  assert len(engine.find_signals("**")) == len(engine.get_signal_names())
+
+  # The handles follow the values
+  handle = engine.get_handle("r4.state_sw")
+  assert handle.get_value() == sim2.LOGIC_X
+  engine.set_value("a", sim2.LOGIC_1)
+  assert handle.get_value() == sim2.LOGIC_1
+  assert handle.get_bool()
+  assert handle.get_code() == sim2.CODE_1
+
+  # Same results on a real design
+  engine = sim2.Engine()
+  engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  engine.start() 
+  expected = [ name for name in engine.get_signal_names() 
+               if name.startswith("tw.") and name.endswith("_sw") ]
+  assert names(engine.find_signals("tw.*_sw")) == sorted(expected)
+
+# Function inlining and memoization
+def test_24():
+
+  print("----- test_24 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b, c;
+  wire y0, y1, y2, y3;
+  card m0(.x(a), .y(b), .z(c), .q0(y0), .q1(y1), .q2(y2), .q3(y3));
+endmodule
+module card(input x, input y, input z, output q0, output q1, output q2, output q3);
+  reg r;
+  always @(x, y) begin r <= nand2(x, y); end
+  function nand2(input p, input q);
+    begin
+      nand2 = !(p & q);
+    end
+  endfunction
+  // Uses a temporary and another function
+  function mux(input s, input p, input q);
+    begin
+      mux = s & p;
+      mux = mux | (!s & q);
+      mux = nand2(mux, mux);
+    end
+  endfunction
+  // Too big to be inlined
+  function big(input p, input q);
+    begin
+      big = p ^ q;
+      big = (big & p) | (big & q) | (big ^ p);
+      big = (big & p) | (big & q) | (big ^ p);
+      big = (big & p) | (big & q) | (big ^ p);
+    end
+  endfunction
+  assign q0 = nand2(x, y);
+  assign q1 = mux(x, y, z);
+  assign q2 = big(x, y);
+  assign q3 = nand2(big(x, y), z);
+endmodule
+"""
+    )
+  engine.start()
+
+  context = engine.eval_context
+  reg = context.signal_reg.reg
+  assert type(reg["m0.q0"].assignments[0]) is sim2.UnaryExpression
+  assert type(reg["m0.q1"].assignments[0]) is sim2.UnaryExpression
+  assert type(reg["m0.q2"].assignments[0]) is sim2.FunctionExpression
+  assert type(reg["m0.q3"].assignments[0]) is sim2.UnaryExpression
+  assert context.inlined_calls > 0
+
+  # A function with a side effect
+  touch = sim2.FunctionDefinition("touch", 
+    [ sim2.FunctionParameterDeclaration("p", sim2.PortType.INPUT) ], [],
+    sim2.ProcedureBlock([ 
+      sim2.ProcedureAssignment("touch", sim2.VariableExpression("p"), True),
+      sim2.ProcedureAssignment("m0.r", sim2.VariableExpression("p"), True) ]))
+  assert touch.inline([ sim2.VariableExpression("a") ]) is None
+  assert not touch.is_pure(context)
+  big = context.get_function_def("m0.big")
+  assert big.is_pure(context)
+
+  # Compare against the interpreted function calls
+  def big_eval(p, q):
+    t = sim2.logic_eval_xor(p, q)
+    for i in range(0, 3):
+      t = sim2.logic_eval_or(sim2.logic_eval_or(sim2.logic_eval_and(t, p), sim2.logic_eval_and(t, q)), 
+                             sim2.logic_eval_xor(t, p))
+    return t
+
+  values = [ sim2.LOGIC_0, sim2.LOGIC_1, sim2.LOGIC_X ]
+  for a in values:
+    for b in values:
+      for c in values:
+        engine.set_values({ "a": a, "b": b, "c": c })
+        engine.tick()
+        assert engine.get_value("y0") == sim2.logic_eval_not(sim2.logic_eval_and(a, b))
+        m = sim2.logic_eval_or(sim2.logic_eval_and(a, b), 
+                               sim2.logic_eval_and(sim2.logic_eval_not(a), c))
+        assert engine.get_value("y1") == sim2.logic_eval_not(m)
+        assert engine.get_value("y2") == big_eval(a, b)
+        assert engine.get_value("y3") == sim2.logic_eval_not(sim2.logic_eval_and(big_eval(a, b), c))
+        assert engine.get_value("m0.r") == sim2.logic_eval_not(sim2.logic_eval_and(a, b))
+
+  # Only one result is remembered for each combination of arguments
+  assert 0 < len(big.memo) <= 9
+
+# Netlist optimizer
+def test_25():
+
+  print("----- test_25 ------------------------------------------------------")
+
+  engine = sim2.Engine(optimize=True)
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b;
+  wire c = a;
+  wire d = c;
+  wire e = !(!(a & b));
+  wire f = 1 & 0;
+  wire g = f | b;
+  wire h = b & f;
+  relay r4(.coil(d));
+endmodule
+
+module relay(input coil);
+  wire state_sw;
+  assign state_sw = coil;
+endmodule
+"""
+    )
+  engine.start()
+
+  stats = engine.eval_context.optimizer_stats
+  # c, d, r4.coil and r4.state_sw all become views of a
+  assert stats.aliases == 4
+  # f folds to 0, which makes h 0 and g a copy of b
+  assert stats.constant_nets == 2
+  assert stats.double_negations == 1
+
+  engine.set_value("a", sim2.LOGIC_1)
+  engine.set_value("b", sim2.LOGIC_0)
+  for name in [ "c", "d", "r4.coil", "r4.state_sw" ]:
+    assert engine.get_value(name) == sim2.LOGIC_1
+  assert engine.get_value("e") == sim2.LOGIC_0
+  assert engine.get_value("f") == sim2.LOGIC_0
+  assert engine.get_value("g") == sim2.LOGIC_0
+  assert engine.get_value("h") == sim2.LOGIC_0
+  engine.set_value("b", sim2.LOGIC_1)
+  assert engine.get_value("e") == sim2.LOGIC_1
+  assert engine.get_value("g") == sim2.LOGIC_1
+
+  # Watches report the original names
+  watch = engine.watch([ "r4.state_sw" ])
+  watch.poll()
+  engine.set_value("a", sim2.LOGIC_0)
+  assert watch.poll() == { "r4.state_sw": sim2.LOGIC_0 }
+
+  # Same results on a real design, with less work
+  engines = []
+  evaluations = []
+  for optimize in [ False, True ]:
+    engine = sim2.Engine(optimize=optimize)
+    engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+    engine.start() 
+    count = 0
+    for angle in [ 0, 50, 100, 150 ]:
+      engine.set_value("tw._angle", sim2.Value(angle))
+      engine.set_value("tw.r1_pick_coil", sim2.LOGIC_1)
+      engine.set_value("tw.r6_pick_coil", sim2.LOGIC_1)
+      engine.tick()
+      count = count + engine.get_tick_stats().net_evaluations
+      engine.set_value("tw.r1_pick_coil", sim2.LOGIC_0)
+      engine.tick()
+      count = count + engine.get_tick_stats().net_evaluations
+    engines.append(engine)
+    evaluations.append(count)
+
+  assert engines[1].eval_context.optimizer_stats.aliases > 0
+  for name in engines[0].get_signal_names():
+    assert engines[0].get_value(name) == engines[1].get_value(name)
+  assert evaluations[1] < evaluations[0]
+
+# Common subexpression elimination
+def test_26():
+
+  print("----- test_26 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b, s;
+  wire c = (a | b) & s;
+  wire d = !(b | a);
+  wire e = (a | b) ^ !(b | a);
+  // A loop, which is left alone
+  wire f = g | (a | b);
+  wire g = f & s;
+endmodule
+"""
+    )
+  engine.start()
+
+  table = engine.eval_context.expression_table
+  # (a | b) and !(b | a) are each evaluated once
+  assert table.shared == 2
+  assert table.duplicates > 0
+
+  for a in [ sim2.LOGIC_0, sim2.LOGIC_1 ]:
+    for b in [ sim2.LOGIC_0, sim2.LOGIC_1 ]:
+      engine.set_values({ "a": a, "b": b, "s": sim2.LOGIC_1 })
+      engine.tick()
+      either = a == sim2.LOGIC_1 or b == sim2.LOGIC_1
+      assert engine.get_bool("c") == either
+      assert engine.get_bool("d") == (not either)
+      assert engine.get_bool("e")
+      assert engine.get_tick_stats().shared_hits > 0
+  assert engine.get_bool("f")
+
+  # Same results on a real design
+  engines = []
+  for compiled in [ True, False ]:
+    engine = sim2.Engine(compiled, optimize=True)
+    engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+    engine.start() 
+    for angle in [ 0, 50, 100, 150 ]:
+      engine.set_value("tw._angle", sim2.Value(angle))
+      engine.set_value("tw.r1_pick_coil", sim2.LOGIC_1)
+      engine.set_value("tw.r6_pick_coil", sim2.LOGIC_1)
+      engine.tick()
+      engine.set_value("tw.r1_pick_coil", sim2.LOGIC_0)
+      engine.tick()
+    engines.append(engine)
+  assert engines[0].eval_context.expression_table.shared > 0
+  for name in engines[0].get_signal_names():
+    assert engines[0].get_value(name) == engines[1].get_value(name)
+
+# Module templates
+def test_27():
+
+  print("----- test_27 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire a, b, y1, y2;
+  card c1(.a(a), .b(b), .y(y1));
+  card c2(.a(b), .b(a), .y(y2));
+  card c3(.a(a));
+endmodule
+
+module card(input a, input b, output y);
+  wire a;
+  wire n1 = !(a & b);
+  reg q = 1;
+  always @(a) begin q <= n1; end
+  assign y = q & 1'b1;
+endmodule
+"""
+    )
+  engine.start()
+
+  # Each instance is laid out the same way
+  reg = engine.eval_context.signal_reg.reg
+  for name in [ "b", "n1", "q" ]:
+    assert reg["c1." + name].slot - reg["c1.a"].slot == reg["c2." + name].slot - reg["c2.a"].slot
+  template = engine.module_defs["card"].get_template()
+  assert len(template.signals) == 5
+  # Unconnected ports are still declared
+  assert engine.is_valid_signal("c3.b")
+  assert engine.get_value("c3.b") == sim2.LOGIC_X
+
+  assert engine.get_value("c1.q") == sim2.LOGIC_1
+  engine.set_values({ "a": sim2.LOGIC_1, "b": sim2.LOGIC_0 })
+  engine.tick()
+  # The port that is also declared as a wire is still connected
+  assert engine.get_value("c1.a") == sim2.LOGIC_1
+  assert engine.get_value("c1.n1") == sim2.LOGIC_1
+  assert engine.get_value("y1") == sim2.LOGIC_1
+  engine.set_value("b", sim2.LOGIC_1)
+  engine.set_value("a", sim2.LOGIC_0)
+  engine.set_value("a", sim2.LOGIC_1)
+  engine.tick()
+  assert engine.get_value("y1") == sim2.LOGIC_0
+  assert engine.get_value("y2") == sim2.LOGIC_0
+
+  # The instances share the expressions and their compiled form
+  context = engine.eval_context
+  reg = context.signal_reg.reg
+  for name in [ "n1", "y" ]:
+    exps = [ reg["c" + str(i) + "." + name].assignments[0] for i in [ 1, 2, 3 ] ]
+    assert all([ type(exp) is sim2.InstanceExpression for exp in exps ])
+    assert exps[0].assignment is exps[1].assignment and exps[1].assignment is exps[2].assignment
+  assert context.signal_reg.get_fanout("c2.b") == [ reg["c2.n1"] ]
+  assert len(context.template_code) == 2
+
+  # ... and give the same results as the copies
+  text = engine.sources[0]
+  engines = []
+  for settings in [ {}, { "compiled": False }, { "optimize": True }, { "two_state": True } ]:
+    e = sim2.Engine(**settings)
+    e.load_module_from_text(text)
+    e.start()
+    engines.append(e)
+  assert type(engines[1].eval_context.signal_reg.reg["c1.n1"].assignments[0]) is not sim2.InstanceExpression
+  for a, b in [ (0, 0), (1, 0), (1, 1), (0, 1), (1, 1) ]:
+    results = []
+    for e in engines:
+      e.set_values({ "a": sim2.Value(a), "b": sim2.Value(b) })
+      e.tick()
+      results.append([ e.get_value(name) for name in [ "c1.n1", "c2.n1", "c3.n1", "y1", "y2", "c3.y" ] ])
+    assert all([ result == results[0] for result in results ])
+
+# Two-state evaluation
+def test_28():
+
+  print("----- test_28 ------------------------------------------------------")
+
+  text = """
+module mod0();
+  wire a, b;
+  wire angle;
+  wire c = !(a & b) ^ a;
+  wire d = (a | b) == 1'b1;
+  wire e = (angle > 10) & (angle <= 20);
+  wire f = b | 1'bx;
+  wire g = c != d;
+endmodule
+"""
+  engines = []
+  for two_state in [ False, True ]:
+    engine = sim2.Engine(two_state=two_state)
+    engine.load_module_from_text(text)
+    engine.start()
+    engines.append(engine)
+  context = engines[1].eval_context
+  assert context.xz_count > 0
+
+  def check(values, two_state_expected):
+    for engine in engines:
+      engine.set_values(values)
+      engine.tick()
+    stats = engines[1].get_tick_stats()
+    if two_state_expected is not None:
+      assert (stats.two_state_evaluations > 0) == two_state_expected
+    for name in engines[0].get_signal_names():
+      assert engines[0].get_value(name) == engines[1].get_value(name)
+
+  # Still X around
+  check({ "a": sim2.LOGIC_1 }, False)
+  # Everything is known from here (the switch happens part way through)
+  check({ "b": sim2.LOGIC_0, "angle": sim2.Value(15) }, None)
+  assert context.xz_count == 0
+  check({ "b": sim2.LOGIC_1, "angle": sim2.Value(25) }, True)
+  check({ "a": sim2.LOGIC_0 }, True)
+  assert engines[1].get_value("e") == sim2.LOGIC_0
+  assert engines[1].get_value("g") == sim2.LOGIC_0
+  # The X constant always needs the four-state version
+  assert context.get_signal_info("f").two_state_evaluator is None
+  # Back to four-state when an X shows up
+  check({ "a": sim2.LOGIC_X, "b": sim2.LOGIC_1 }, False)
+  assert context.xz_count > 0
+  assert engines[1].get_value("d") == sim2.LOGIC_1
+  check({ "a": sim2.LOGIC_1 }, True)
+
+# Oscillation detection
+def test_29():
+
+  print("----- test_29 ------------------------------------------------------")
+
+  engine = sim2.Engine(delta_limit=50)
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire en, b;
+  // A ring oscillator when enabled
+  wire a = !(b & en);
+  assign b = a;
+  // A latch, which is a loop that settles
+  wire s, r;
+  wire q = !(r | qn);
+  wire qn = !(s | q);
+  // Feedback through a procedure block
+  wire go;
+  reg t;
+  always @(t, go) begin t <= !t & go; end
+endmodule
+"""
+    )
+  engine.start()
+
+  loops = [ sorted(loop) for loop in engine.get_feedback_loops() ]
+  assert [ "a", "b" ] in loops
+  assert [ "q", "qn" ] in loops
+  assert [ "t" ] in loops
+
+  engine.set_values({ "s": sim2.LOGIC_1, "r": sim2.LOGIC_0, "en": sim2.LOGIC_0, "go": sim2.LOGIC_0 })
+  engine.tick()
+  assert engine.get_value("q") == sim2.LOGIC_1
+  engine.set_value("s", sim2.LOGIC_0)
+  assert engine.get_value("q") == sim2.LOGIC_1
+
+  try:
+    engine.set_value("en", sim2.LOGIC_1)
+    assert False
+  except sim2.OscillationError as e:
+    assert sorted(e.signals) == [ "a", "b" ]
+    assert [ "a", "b" ] in [ sorted(loop) for loop in e.loops ]
+
+  engine = sim2.Engine(delta_limit=50)
+  engine.load_module_from_text(
+"""
+module mod0();
+  wire go;
+  reg t;
+  always @(t, go) begin t <= !t & go; end
+endmodule
+"""
+    )
+  engine.start()
+  engine.set_value("go", sim2.LOGIC_0)
+  engine.tick()
+  engine.set_value("go", sim2.LOGIC_1)
+  try:
+    engine.tick()
+    assert False
+  except sim2.OscillationError as e:
+    assert e.signals == [ "t" ]
+    assert e.loops == [ [ "t" ] ]
+
+# Timed scheduler
+def test_30():
+
+  print("----- test_30 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  reg clk, done, late;
+  wire nclk = !clk;
+  always @(clk) begin 
+    #5 clk <= nclk; 
+  end
+  initial begin 
+    clk = 0;
+    done = 0;
+    #64; 
+    done = 1;
+    $finish;
+    late = 1;
+  end
+  initial begin
+    #1000 late = 1;
+  end
+endmodule;
+"""
+    )
+  engine.start()
+
+  assert engine.get_time() == 0
+  assert engine.get_value("clk") == sim2.LOGIC_0
+  assert engine.get_value("done") == sim2.LOGIC_0
+  engine.tick()
+  assert engine.get_time() == 1
+  engine.run_until(7)
+  assert engine.get_time() == 7
+  assert engine.get_value("clk") == sim2.LOGIC_1
+  engine.run_until(57)
+  assert engine.get_value("clk") == sim2.LOGIC_1
+  assert not engine.is_finished()
+  # Stops at the $finish
+  engine.run_until(100000)
+  assert engine.is_finished()
+  assert engine.get_time() == 64
+  assert engine.get_value("done") == sim2.LOGIC_1
+  assert engine.get_value("clk") == sim2.LOGIC_0
+  assert engine.get_value("late") == sim2.LOGIC_X
+  engine.tick()
+  assert engine.get_time() == 64
+
+  # Long idle stretches are skipped
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  reg a;
+  wire b = !a;
+  initial begin 
+    a = 0; 
+    #1000000 a = 1; 
+    #1000000; 
+    a = 0; 
+  end
+endmodule
+"""
+    )
+  engine.start()
+  engine.run_until(1500000)
+  assert engine.get_value("b") == sim2.LOGIC_0
+  assert engine.get_tick_stats().delta_cycles < 10
+  engine.run_until(3000000)
+  assert engine.get_value("b") == sim2.LOGIC_1
+  assert engine.get_time() == 3000000
+
+# Run loop
+def test_31():
+
+  print("----- test_31 ------------------------------------------------------")
+
+  text = """
+module mod0();
+  reg a, b, q;
+  wire y = a & b;
+  wire n = !y;
+  always @(a) begin 
+    q <= b; 
+  end
+endmodule
+"""
+  rows = np.array([ [ 0, 0 ], [ 1, 1 ], [ 0, 1 ], [ 1, 0 ], [ 1, 1 ], [ 0, 0 ] ])
+
+  # The same stimulus, one signal at a time
+  expected = []
+  engine = sim2.Engine()
+  engine.load_module_from_text(text)
+  engine.start()
+  for row in rows:
+    engine.set_values({ "a": sim2.Value(int(row[0])), "b": sim2.Value(int(row[1])) })
+    engine.tick()
+    expected.append([ engine.get_int(name) for name in [ "y", "n", "q" ] ])
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(text)
+  engine.start()
+  result = engine.run(rows, observe=[ "y", "n", "q" ], inputs=[ "a", "b" ])
+  assert result.shape == (6, 3)
+  assert result.dtype == np.int64
+  assert not result.mask.any()
+  assert result.tolist() == expected
+  assert engine.get_time() == 6
+
+  # A generator of maps
+  def stimulus():
+    for row in rows:
+      yield { "a": sim2.Value(int(row[0])), "b": int(row[1]) }
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(text)
+  engine.start()
+  result = engine.run(stimulus(), observe=[ "y", "n", "q" ])
+  assert result.tolist() == expected
+
+  # Stops at the $finish
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  reg a;
+  wire b = !a;
+  initial begin 
+    #3; 
+    $finish; 
+  end
+endmodule
+"""
+    )
+  engine.start()
+  result = engine.run(([ i % 2 ] for i in range(0, 1000000)), observe=[ "b" ], inputs=[ "a" ])
+  assert result.tolist() == [ [ 1 ], [ 0 ], [ 1 ] ]
+  assert engine.is_finished()
+
+  # Integers come back as themselves, and X/Z are masked
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  integer i, j;
+  reg a;
+  always @(i) begin 
+    j <= i; 
+  end
+endmodule
+"""
+    )
+  engine.start()
+  result = engine.run([ [ 5 ], [ 100 ], [ 2 ], [ 3 ], [ -4 ], [ 1 ] ], observe=[ "i", "j", "a" ], inputs=[ "i" ])
+  assert result[:, 0].tolist() == [ 5, 100, 2, 3, -4, 1 ]
+  assert result[:, 1].tolist() == [ 5, 100, 2, 3, -4, 1 ]
+  assert result[:, 2].mask.all()
+  assert sim2.decode_code_array(np.array([ sim2.CODE_0, sim2.CODE_1, sim2.CODE_X, sim2.CODE_Z, 7 ])).tolist() == \
+    [ 0, 1, None, None, 5 ]
+
+# Cone of influence
+def test_32():
+
+  print("----- test_32 ------------------------------------------------------")
+
+  text = """
+module mod0();
+  reg a, b, c, q;
+  wire y = a & b;
+  wire ny = !y;
+  wire side = a | c;
+  wire nside = !side;
+  always @(a) begin 
+    q <= b; 
+  end
+endmodule
+"""
+  engine = sim2.Engine(observed=[ "ny" ])
+  engine.load_module_from_text(text)
+  engine.start()
+  assert engine.eval_context.lazy_count == 2
+  assert engine.eval_context.get_signal_info("side").lazy
+  assert engine.eval_context.get_signal_info("nside").lazy
+  assert not engine.eval_context.get_signal_info("y").lazy
+
+  engine.set_values({ "a": sim2.LOGIC_0, "b": sim2.LOGIC_1, "c": sim2.LOGIC_0 })
+  stats = engine.eval_context.stats
+  # Only the cone was evaluated 
+  assert stats.lazy_evaluations == 0
+  assert engine.get_value("ny") == sim2.LOGIC_1
+  # The rest is computed when asked for
+  handle = engine.get_handle("nside")
+  assert handle.get_value() == sim2.LOGIC_1
+  assert stats.lazy_evaluations == 2
+  assert engine.get_value("side") == sim2.LOGIC_0
+  assert stats.lazy_evaluations == 2
+  engine.set_value("c", sim2.LOGIC_1)
+  assert engine.get_value("nside") == sim2.LOGIC_0
+  assert handle.get_value() == sim2.LOGIC_0
+  engine.set_value("a", sim2.LOGIC_1)
+  engine.tick()
+  assert engine.get_value("ny") == sim2.LOGIC_0
+  assert engine.get_value("q") == sim2.LOGIC_1
+
+  # Patterns work too
+  engine = sim2.Engine(observed=[ "n*" ])
+  engine.load_module_from_text(text)
+  engine.start()
+  assert engine.eval_context.lazy_count == 0
+
+  # Same results as the full evaluation on a real design
+  names = [ "tw.r4_1no_sw", "tw.r4_1nc_sw" ]
+  full = sim2.Engine()
+  full.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  full.start()
+  cone = sim2.Engine(observed=[ "tw.r4_1no_sw" ])
+  cone.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  cone.start()
+  assert cone.eval_context.lazy_count > 0
+  for angle in range(0, 360, 7):
+    full.set_values({ "tw._angle": sim2.Value(angle) })
+    cone.set_values({ "tw._angle": sim2.Value(angle) })
+    full.tick()
+    cone.tick()
+    assert cone.eval_context.stats.net_evaluations <= full.eval_context.stats.net_evaluations
+    for name in full.get_signal_names():
+      assert cone.get_value(name) == full.get_value(name)
+
+# Dead logic elimination
+def test_33():
+
+  print("----- test_33 ------------------------------------------------------")
+
+  text = """
+module mod0();
+  reg a, b, q, unused_q;
+  wire y = a & b;
+  wire ny = !y;
+  wire dead1 = a | b;
+  wire dead2 = !dead1;
+  wire loop1 = loop2 & a;
+  wire loop2 = loop1 | b;
+  always @(a) begin 
+    q <= b; 
+  end
+  always @(b) begin 
+    unused_q <= dead2; 
+  end
+endmodule
+"""
+  engine = sim2.Engine(eliminate_dead=True, keep=[ "ny", "q" ])
+  engine.load_module_from_text(text)
+  engine.start()
+  removed = engine.get_removed_signals()
+  assert sorted(removed) == [ "dead1", "dead2", "loop1", "loop2", "unused_q" ]
+  stats = engine.eval_context.optimizer_stats
+  assert stats.dead_nets == 4
+  assert stats.dead_variables == 1
+  assert stats.dead_blocks == 1
+  assert not engine.is_valid_signal("dead1")
+  # The inputs are still there even though they are undriven
+  assert engine.is_valid_signal("b")
+  assert engine.find_signals("dead*") == []
+
+  # There has to be something to keep
+  bad = sim2.Engine(eliminate_dead=True)
+  bad.load_module_from_text(text)
+  try:
+    bad.start()
+    assert False
+  except Exception as ex:
+    assert "keep" in str(ex)
+
+  engine.set_values({ "a": sim2.LOGIC_1, "b": sim2.LOGIC_1 })
+  engine.tick()
+  assert engine.get_value("ny") == sim2.LOGIC_0
+  assert engine.get_value("q") == sim2.LOGIC_1
+  # Nothing is evaluated on behalf of the removed logic
+  engine.set_value("b", sim2.LOGIC_0)
+  stats = engine.eval_context.stats
+  assert stats.net_evaluations == 2
+  assert stats.procedure_executions == 0
+
+  # The remaining signals of the typewriter get the same values
+  full = sim2.Engine()
+  full.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  full.start()
+  pruned = sim2.Engine(eliminate_dead=True, keep=[ "tw.r4_1no_sw" ])
+  pruned.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  pruned.start()
+  assert len(pruned.get_removed_signals()) > 0
+  for angle in range(0, 360, 7):
+    full.set_values({ "tw._angle": sim2.Value(angle) })
+    pruned.set_values({ "tw._angle": sim2.Value(angle) })
+    full.tick()
+    pruned.tick()
+    for name in pruned.get_signal_names():
+      assert pruned.get_value(name) == full.get_value(name)
+
+# VCD output
+def test_34():
+
+  print("----- test_34 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  reg clk;
+  integer count;
+  wire nclk = !clk;
+  card c1(.a(clk));
+  card c2(.a(nclk));
+  always @(clk) begin 
+    #5 clk <= nclk; 
+  end
+  initial begin 
+    clk = 0;
+    count = 3;
+    #20 count = 7;
+  end
+endmodule
+
+module card(input a);
+  wire n = !a;
+endmodule
+"""
+    )
+  engine.start()
+
+  with tempfile.TemporaryDirectory() as dir_name:
+
+    file_name = os.path.join(dir_name, "all.vcd")
+    writer = engine.dump_vcd(file_name)
+    engine.run_until(12)
+    writer.close()
+    text = open(file_name).read()
+    header, body = text.split("$enddefinitions $end\n")
+    lines = header.split("\n")
+    assert lines[2] == "$scope module mod0 $end"
+    assert "$scope module c1 $end" in lines
+    assert "$scope module c2 $end" in lines
+    assert header.count("$scope") == header.count("$upscope")
+    assert "$var integer 32 " in header
+    ids = {}
+    for line in lines:
+      if line.startswith("$var"):
+        ids[line.split(" ")[4]] = line.split(" ")[3]
+    clk = ids["clk"]
+    count = ids["count"]
+    assert body.split("\n") == [ "#0", "$dumpvars" ] + body.split("\n")[2:]
+    assert "b11 " + count in body
+    assert ("1" + clk + "\n") in body.split("#5\n")[1].split("#10\n")[0]
+    assert body.rstrip().endswith("#12")
+    # Only the changes are written
+    assert body.count("\n1" + clk + "\n") == 1
+
+    # Just part of the hierarchy
+    file_name = os.path.join(dir_name, "c1.vcd")
+    writer = engine.dump_vcd(file_name, [ "c1.*" ])
+    engine.run_until(30)
+    writer.close()
+    text = open(file_name).read()
+    assert "$scope module c1 $end" in text
+    assert not "c2" in text
+    assert not " clk " in text
+    assert text.count("$var") == 2
+    # Each change of c1.a and c1.n at 15, 20 and 25 is recorded at the right time
+    body = text.split("$enddefinitions $end\n")[1]
+    assert [ line for line in body.split("\n") if line.startswith("#") ] == [ "#12", "#15", "#20", "#25", "#30" ]
+
+# Profiling
+def test_35():
+
+  print("----- test_35 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  reg a, b, q;
+  wire y = a & b;
+  wire ny = !y;
+  always @(a, b) begin 
+    q <= y; 
+  end
+endmodule
+"""
+    )
+  engine.start()
+  evaluator = engine.eval_context.get_signal_info("y").evaluator
+  profiler = engine.start_profile()
+  engine.set_values({ "a": sim2.LOGIC_1, "b": sim2.LOGIC_0 })
+  engine.tick()
+  engine.set_value("b", sim2.LOGIC_1)
+  engine.tick()
+  engine.tick()
+  engine.set_value("a", sim2.LOGIC_0)
+  engine.tick()
+  assert engine.stop_profile() is profiler
+  # Nothing is counted after the profiler is stopped
+  assert engine.eval_context.get_signal_info("y").evaluator is evaluator
+  engine.set_value("a", sim2.LOGIC_1)
+
+  assert profiler.ticks == 4
+  assert sum(profiler.delta_cycles_per_tick.values()) == 4
+  assert profiler.delta_cycles_per_tick[0] == 1
+  nets = profiler.get_hot_nets()
+  assert nets[0] == ("y", 3, 3)
+  assert ("ny", 3, 3) in nets
+  assert ("q", 2) in profiler.get_busy_signals()
+  blocks = profiler.get_hot_blocks()
+  assert len(blocks) == 1
+  assert blocks[0][0] == "always @(a, b)"
+  assert blocks[0][1] == 3
+  assert blocks[0][2] > 0
+  report = profiler.report()
+  assert "always @(a, b)" in report
+  assert "Delta cycles per tick" in report
+
+# Snapshot, restore and fork
+def test_36():
+
+  print("----- test_36 ------------------------------------------------------")
+
+  engine = sim2.Engine()
+  engine.load_module_files([ "../daves-1f/main.v", "../daves-1f/typewriter-mechanical.v" ])
+  engine.start()
+  engine.set_values({ "tw._angle": sim2.Value(100), "tw.r6_pick_coil": sim2.LOGIC_1 })
+  engine.tick()
+  snapshot = engine.snapshot()
+  names = engine.get_signal_names()
+  start = { name: engine.get_value(name) for name in names }
+
+  # One branch 
+  watch = engine.watch([ "tw.r6_1no_sw" ])
+  watch.poll()
+  engine.set_values({ "tw.r6_pick_coil": sim2.LOGIC_0, "tw.r6_hold_coil": sim2.LOGIC_0 })
+  engine.tick()
+  assert engine.get_value("tw.r6_1no_sw") == sim2.LOGIC_0
+  assert watch.poll() == { "tw.r6_1no_sw": sim2.LOGIC_0 }
+  branch_a = { name: engine.get_value(name) for name in names }
+
+  # Back to the start
+  engine.restore(snapshot)
+  assert { name: engine.get_value(name) for name in names } == start
+  assert watch.poll() == { "tw.r6_1no_sw": sim2.LOGIC_1 }
+  assert engine.get_time() == 1
+
+  # A fork follows the same path
+  context = engine.eval_context
+  handle = engine.get_handle("tw.r6_1no_sw")
+  fork = engine.fork()
+  # The design isn't built again
+  assert fork.eval_context is context
+  assert fork.get_time() == 1
+  assert { name: fork.get_value(name) for name in names } == start
+  fork_handle = fork.get_handle("tw.r6_1no_sw")
+  fork_watch = fork.watch([ "tw.r6_1no_sw" ])
+  fork_watch.poll()
+  fork.set_values({ "tw.r6_pick_coil": sim2.LOGIC_0, "tw.r6_hold_coil": sim2.LOGIC_0 })
+  fork.tick()
+  assert { name: fork.get_value(name) for name in names } == branch_a
+  # ... without changing the original
+  assert { name: engine.get_value(name) for name in names } == start
+  assert watch.poll() == {}
+  assert handle.get_value() == sim2.LOGIC_1
+  assert fork_handle.get_value() == sim2.LOGIC_0
+  assert fork_watch.poll() == { "tw.r6_1no_sw": sim2.LOGIC_0 }
+  # Modules loaded into the fork stay there
+  fork.load_module_from_text("module extra(); wire w; endmodule")
+  assert "extra" in fork.module_defs
+  assert not "extra" in engine.module_defs
+  assert len(engine.sources) == len(fork.sources) - 1
+  # Starting the fork again gives it a design of its own
+  fork.start()
+  assert fork.eval_context is not context
+  assert fork.get_time() == 0
+  assert { name: engine.get_value(name) for name in names } == start
+
+  # The pending events are carried over too
+  engine = sim2.Engine()
+  engine.load_module_from_text(
+"""
+module mod0();
+  reg clk, done, q, a, b;
+  wire nclk = !clk;
+  always @(clk) begin 
+    #5 clk <= nclk; 
+    q = clk;
+  end
+  always @(a) begin 
+    b <= a; 
+  end
+  initial begin 
+    clk = 0;
+    done = 0;
+    #32 done = 1;
+    $finish;
+  end
+endmodule
+"""
+    )
+  engine.start()
+  engine.run_until(12)
+  # The non-blocking update of b is still in the queue 
+  engine.set_value("a", sim2.LOGIC_1)
+  assert engine.get_value("b") == sim2.LOGIC_X
+  snapshot = engine.snapshot()
+  fork = engine.fork()
+  assert fork.get_value("b") == sim2.LOGIC_X
+  history = []
+  for e in [ engine, fork ]:
+    trace = []
+    while not e.is_finished():
+      e.tick()
+      trace.append((e.get_time(), e.get_value("clk"), e.get_value("q"), e.get_value("b"), 
+                    e.get_value("done")))
+    history.append(trace)
+  assert history[0] == history[1]
+  assert history[0][0][3] == sim2.LOGIC_1
+  assert history[0][-1] == (32, sim2.LOGIC_0, sim2.LOGIC_1, sim2.LOGIC_1, sim2.LOGIC_1)
+  # Engines that share a design can take turns
+  engine.restore(snapshot)
+  fork = engine.fork()
+  traces = [[], []]
+  while not engine.is_finished():
+    for e, trace in zip([ engine, fork ], traces):
+      e.tick()
+      trace.append((e.get_time(), e.get_value("clk"), e.get_value("q"), e.get_value("b"), 
+                    e.get_value("done")))
+  assert traces == [ history[0], history[0] ]
+  engine.restore(snapshot)
+  assert not engine.is_finished()
+  engine.run_until(100)
+  assert engine.get_time() == 32
+
+# Integer operands of the logic operators
+def test_37():
+
+  print("----- test_37 ------------------------------------------------------")
+
+  text = """
+module mod0();
+  integer i;
+  reg a;
+  wire c = i | a;
+  wire d = i & a;
+  wire e = i ^ a;
+  wire f = !i;
+  wire g = !(i | a);
+  wor w;
+  wand v;
+  wor w1;
+  assign w = i;
+  assign w = a;
+  assign v = i;
+  assign v = a;
+  assign w1 = i;
+endmodule
+"""
+  engines = []
+  for compiled in [ True, False ]:
+    engine = sim2.Engine(compiled=compiled)
+    engine.load_module_from_text(text)
+    engine.start()
+    engines.append(engine)
+  for i in [ 0, 1, 5, -3 ]:
+    for a in [ sim2.LOGIC_0, sim2.LOGIC_1 ]:
+      results = []
+      for engine in engines:
+        engine.set_values({ "i": sim2.Value(i), "a": a })
+        results.append([ engine.get_value(name) for name in [ "c", "d", "e", "f", "g", "w", "v", "w1" ] ])
+      assert results[0] == results[1]
+  engine = engines[0]
+  engine.set_values({ "i": sim2.Value(5), "a": sim2.LOGIC_0 })
+  assert engine.get_value("c") == sim2.LOGIC_X
+  assert engine.get_value("d") == sim2.LOGIC_0
+  assert engine.get_value("f") == sim2.LOGIC_X
+  assert engine.get_value("w") == sim2.LOGIC_X
+  assert engine.get_value("v") == sim2.LOGIC_0
+  assert engine.get_value("w1") == sim2.LOGIC_X
+
+# Integer operands in two-state mode
+def test_38():
+
+  print("----- test_38 ------------------------------------------------------")
+
+  text = """
+module mod0();
+  integer i;
+  reg a;
+  wire c = i | a;
+  wire d = !i & !a;
+  wire e = !(i ^ a) | 1'b0;
+  wire f = (i == 5) | a;
+  wire g = a | 5;
+endmodule
+"""
+  engines = []
+  for two_state in [ True, False ]:
+    engine = sim2.Engine(two_state=two_state)
+    engine.load_module_from_text(text)
+    engine.start()
+    engines.append(engine)
+  for i in [ 0, 1, 5, 0, -3, 1 ]:
+    for a in [ sim2.LOGIC_0, sim2.LOGIC_1 ]:
+      results = []
+      for engine in engines:
+        engine.set_values({ "i": sim2.Value(i), "a": a })
+        results.append([ engine.get_value(name) for name in [ "c", "d", "e", "f", "g" ] ])
+      assert results[0] == results[1]
+  assert engines[0].eval_context.xz_count == 0
+
+# Copies that trigger blocks aren't collapsed by the optimizer
+def test_39():
+
+  print("----- test_39 ------------------------------------------------------")
+
+  text = """
+module mod0();
+  reg r1 = 1'b0;
+  reg q, q2;
+  wire w2 = r1;
+  wire w3 = w2;
+  wire w4 = w3;
+  always @(w3) begin 
+    q = !w3; 
+  end
+  always @(w4) begin 
+    q2 <= w4; 
+  end
+endmodule
+"""
+  results = []
+  for optimize in [ False, True ]:
+    engine = sim2.Engine(optimize=optimize)
+    engine.load_module_from_text(text)
+    engine.start()
+    engine.tick()
+    results.append([ engine.get_value(name) for name in [ "q", "q2" ] ])
+  assert results[0] == [ sim2.LOGIC_1, sim2.LOGIC_0 ]
+  assert results[1] == results[0]
+  # The plain copy is still collapsed
+  assert engine.eval_context.optimizer_stats.aliases == 1
+  assert engine.eval_context.get_declared_signal_info("w2").alias is not None
+
 test_1()
 test_2()
 test_3()
@@ -580,3 +2208,31 @@ test_8()
 test_9()
 test_10()
 test_11()
+test_12()
+test_13()
+test_14()
+test_15()
+test_16()
+test_17()
+test_18()
+test_19()
+test_20()
+test_21()
+test_22()
+test_23()
+test_24()
+test_25()
+test_26()
+test_27()
+test_28()
+test_29()
+test_30()
+test_31()
+test_32()
+test_33()
+test_34()
+test_35()
+test_36()
+test_37()
+test_38()
+test_39()